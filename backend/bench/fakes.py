@@ -0,0 +1,306 @@
+"""
+In-process stand-ins for Firebase Auth, Firestore, Gemini/Imagen and Stripe,
+with configurable latency and failure rates, for the offline benchmarks.
+
+`install(...)` must run before the app handles its first request: it swaps
+the fakes in at the seams the services already have (the token verifier,
+`config.db`, the model registry, the credit ledger store) and replaces the
+`stripe` module, so nothing leaves the process.
+"""
+import datetime
+import itertools
+import random
+import sys
+import threading
+import time
+import types
+import uuid
+from types import SimpleNamespace
+
+FAKE_PROJECT_ID = "bench-project"
+TOKEN_PREFIX = "bench-token-"
+
+
+class Faults:
+    """Blocking latency plus an injected failure rate for one fake backend."""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    def __call__(self, what: str):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError(f"Injected {what} failure")
+
+
+def token_for(uid: str) -> str:
+    return TOKEN_PREFIX + uid
+
+
+# --- Firebase Auth -----------------------------------------------------------
+
+class FakeCertStore:
+    def fresh(self) -> bool:
+        return True
+
+    def refresh(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def fake_verifier(faults: Faults):
+    """A TokenVerifier (so its token cache is exercised) that accepts `token_for(uid)`."""
+    from services.token_verifier import InvalidTokenError, TokenVerifier
+
+    class FakeTokenVerifier(TokenVerifier):
+        def _decode(self, token: str) -> dict:
+            faults("auth")
+            if not token.startswith(TOKEN_PREFIX):
+                raise InvalidTokenError("Not a benchmark token")
+            uid = token[len(TOKEN_PREFIX):]
+            now = int(time.time())
+            return {
+                "iss": self.issuer, "aud": self.project_id, "sub": uid,
+                "email": f"{uid}@bench.invalid", "iat": now, "exp": now + 3600,
+            }
+
+    return FakeTokenVerifier(FAKE_PROJECT_ID, cert_store=FakeCertStore())
+
+
+# --- Firestore ---------------------------------------------------------------
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _resolve(data: dict) -> dict:
+    from firebase_admin import firestore
+
+    return {k: _now() if v is firestore.SERVER_TIMESTAMP else v for k, v in data.items()}
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data, update_time=None):
+        self.id = doc_id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db, path: str, doc_id: str):
+        self._db = db
+        self.path = path
+        self.id = doc_id
+
+    def collection(self, name: str):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None, **kwargs):
+        self._db.faults("firestore")
+        with self._db.lock:
+            data, update_time = self._db.docs.get(self.path, (None, None))
+            return FakeSnapshot(self.id, data, update_time)
+
+    def set(self, data: dict, merge: bool = False):
+        self._db.faults("firestore")
+        self._db.write(self.path, data, merge)
+
+    def update(self, data: dict):
+        self._db.faults("firestore")
+        self._db.write(self.path, data, merge=True)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), orders=(), fields=None, after=None, count=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._fields = fields
+        self._after = after
+        self._count = count
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, fields=self._fields,
+                     after=self._after, count=self._count)
+        state.update(changes)
+        return FakeQuery(self._collection, **state)
+
+    def where(self, field: str, op: str, value):
+        if op not in ("==", "in"):
+            raise NotImplementedError(op)
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self._orders + [(field, direction)])
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, values: dict):
+        return self._copy(after=values)
+
+    def limit(self, count: int):
+        return self._copy(count=count)
+
+    def stream(self):
+        db = self._collection._db
+        db.faults("firestore")
+        snapshots = self._collection._snapshots()
+        for field, op, value in self._filters:
+            if op == "==":
+                snapshots = [s for s in snapshots if s._data.get(field) == value]
+            else:
+                snapshots = [s for s in snapshots if s._data.get(field) in value]
+
+        def key(snapshot, field):
+            return snapshot.id if field == "__name__" else snapshot._data.get(field)
+
+        # Stable sorts, last order first
+        for field, direction in reversed(self._orders):
+            snapshots.sort(key=lambda s: key(s, field), reverse=direction == "DESCENDING")
+        if self._after is not None:
+            cursor = tuple(self._after[field] for field, _ in self._orders)
+            for i, snapshot in enumerate(snapshots):
+                if tuple(key(snapshot, field) for field, _ in self._orders) == cursor:
+                    snapshots = snapshots[i + 1:]
+                    break
+        if self._count is not None:
+            snapshots = snapshots[:self._count]
+        if self._fields is not None:
+            snapshots = [
+                FakeSnapshot(s.id, {f: s._data[f] for f in self._fields if f in s._data}, s.update_time)
+                for s in snapshots
+            ]
+        return iter(snapshots)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path: str):
+        self._db = db
+        self.path = path
+        super().__init__(self)
+
+    def document(self, doc_id: str = None):
+        doc_id = doc_id or uuid.uuid4().hex[:20]
+        return FakeDocument(self._db, f"{self.path}/{doc_id}", doc_id)
+
+    def _snapshots(self):
+        prefix = self.path + "/"
+        with self._db.lock:
+            return [
+                FakeSnapshot(path[len(prefix):], data, update_time)
+                for path, (data, update_time) in self._db.docs.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+            ]
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, doc_ref, data: dict, merge: bool = False):
+        self._writes.append((doc_ref.path, data, merge))
+
+    def update(self, doc_ref, data: dict):
+        self._writes.append((doc_ref.path, data, True))
+
+    def commit(self):
+        self._db.faults("firestore")
+        for path, data, merge in self._writes:
+            self._db.write(path, data, merge)
+
+
+class FakeFirestore:
+    """Enough of the Firestore client for the routers: documents, simple queries and batches."""
+
+    def __init__(self, faults: Faults = None):
+        self.faults = faults or Faults()
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def collection(self, name: str):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write(self, path: str, data: dict, merge: bool = False):
+        from firebase_admin import firestore
+
+        data = _resolve(data)
+        with self.lock:
+            current = self.docs.get(path, (None, None))[0]
+            if merge and current is not None:
+                merged = dict(current)
+                for k, v in data.items():
+                    if isinstance(v, firestore.Increment):
+                        merged[k] = merged.get(k, 0) + v.value
+                    else:
+                        merged[k] = v
+                data = merged
+            self.docs[path] = (data, _now())
+
+
+# --- Stripe ------------------------------------------------------------------
+
+def fake_stripe(faults: Faults):
+    """A module object standing in for `stripe` with checkout.Session.create."""
+    module = types.ModuleType("stripe")
+    counter = itertools.count(1)
+
+    def create(**kwargs):
+        faults("stripe")
+        session_id = f"cs_bench_{next(counter)}"
+        return SimpleNamespace(id=session_id, url=f"https://checkout.stripe.invalid/{session_id}")
+
+    module.api_key = None
+    module.checkout = SimpleNamespace(Session=SimpleNamespace(create=create))
+    return module
+
+
+# --- Wiring ------------------------------------------------------------------
+
+def install(users, auth=None, firestore=None, model=None, ledger=None, stripe=None,
+            image_url="https://images.bench.invalid/generated.png", initial_credits=10 ** 6):
+    """
+    Install the fakes and seed `users` with credits. Each of `auth`,
+    `firestore`, `model`, `ledger` and `stripe` is a Faults. Returns the FakeFirestore.
+    """
+    import config
+    from services import credit_ledger, models, token_verifier
+
+    auth, firestore, model = auth or Faults(), firestore or Faults(), model or Faults()
+    ledger, stripe = ledger or Faults(), stripe or Faults()
+
+    db = FakeFirestore(firestore)
+    config.db = db
+    config._firebase_ready = True
+
+    token_verifier._verifier = fake_verifier(auth)
+    sys.modules["stripe"] = fake_stripe(stripe)
+    models.init_registry(models.ModelRegistry.fake(
+        text="A small robot with round eyes and a red scarf.\nStyle: 3D Render",
+        latency=model.latency, failure_rate=model.failure_rate, image_url=image_url,
+    ))
+
+    seed = {uid: dict(credit_ledger.INITIAL_USER, credits=initial_credits) for uid in users}
+    for uid, data in seed.items():
+        db.write(f"users/{uid}", dict(data, email=f"{uid}@bench.invalid"))
+    credit_ledger._ledger = credit_ledger.CreditLedger(
+        credit_ledger.InMemoryCreditStore(users=seed, latency=ledger.latency)
+    )
+    return db
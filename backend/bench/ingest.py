@@ -0,0 +1,93 @@
+"""
+Memory benchmark for upload decoding (services/ingest.py).
+
+Encodes a large test photo as JPEG and PNG and, each in a fresh interpreter,
+measures how much the peak RSS grows while decoding it:
+  - prepare_image: the bounded decode /analyze uses
+  - full: Image.open(...).load(), i.e. a plain full-size decode
+
+tracemalloc doesn't see Pillow's C allocations, hence RSS (Linux only).
+
+Run from backend/:
+    python bench/ingest.py
+    python bench/ingest.py --size 6000x4000 --json ingest.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE_SNIPPET = """
+import sys, time
+from PIL import Image
+from services.ingest import prepare_image
+
+def peak_rss():
+    # VmHWM, unlike ru_maxrss, doesn't carry over the forking parent's peak
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+
+mode, path = sys.argv[1], sys.argv[2]
+# From disk, like an upload past the spool's memory limit
+fp = open(path, "rb")
+before = peak_rss()
+start = time.perf_counter()
+if mode == "prepare_image":
+    image = prepare_image(fp)
+else:
+    image = Image.open(fp)
+    image.load()
+elapsed = time.perf_counter() - start
+after = peak_rss()
+print((after - before) * 1024, elapsed, *image.size)
+"""
+
+
+def make_photo(width: int, height: int):
+    """Noise, so neither encoder can compress it away, in RGB like a phone photo."""
+    from PIL import Image
+
+    return Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+
+
+def measure(mode: str, path: str) -> dict:
+    env = dict(os.environ, PREWARM="false", LOG_LEVEL="WARNING", MAX_UPLOAD_PIXELS=str(10 ** 9))
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SNIPPET, mode, path],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    peak, elapsed, width, height = output.split()
+    return {"peak_mb": round(int(peak) / 1e6, 1), "seconds": round(float(elapsed), 3),
+            "output": f"{width}x{height}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="6000x4000", help="WIDTHxHEIGHT of the test photo")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    width, height = (int(n) for n in args.size.split("x"))
+    photo = make_photo(width, height)
+    results = {"size": args.size}
+    with tempfile.TemporaryDirectory() as directory:
+        for fmt, options in (("JPEG", {"quality": 90}), ("PNG", {"compress_level": 1})):
+            path = os.path.join(directory, f"photo.{fmt.lower()}")
+            photo.save(path, fmt, **options)
+            results[fmt] = {
+                "file_mb": round(os.path.getsize(path) / 1e6, 1),
+                "prepare_image": measure("prepare_image", path),
+                "full": measure("full", path),
+            }
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
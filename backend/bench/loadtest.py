@@ -0,0 +1,329 @@
+"""
+Offline load test for the API.
+
+Boots `main.app` in-process with the fakes from bench/fakes.py (Firebase
+Auth, Firestore, Gemini/Imagen and Stripe, each with its own latency and
+failure rate), drives a weighted mix of requests through it from a pool of
+concurrent virtual users, and reports p50/p95/p99 latency and requests per
+second per route. Nothing leaves the process and no quota is used; it needs
+httpx (`pip install httpx`) on top of requirements.txt.
+
+Run from backend/:
+    python bench/loadtest.py --duration 20 --concurrency 32
+    python bench/loadtest.py --save bench/baselines/loadtest.json
+    python bench/loadtest.py --compare bench/baselines/loadtest.json
+    python bench/loadtest.py --scenario isolation --save bench/baselines/isolation.json
+
+--compare exits non-zero if a route's p95 grew, or its throughput dropped,
+by more than --tolerance against the baseline. Latencies depend on the
+machine, so compare against a baseline recorded on the same one.
+
+`--scenario isolation` checks that slow generations don't hold up cheap
+requests: a few probe users hit /health and /projects/ on their own, then
+again while --concurrency users keep /generate/character in flight. It
+exits non-zero if a probe route's p95 under load is more than --tolerance
+(plus ISOLATION_SLACK_MS) above its p95 alone.
+"""
+import os
+import sys
+
+# Settings read at import time, before anything imports config
+os.environ.setdefault("PREWARM", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Per-user limits would turn the test into a 429 benchmark; the fakes' images
+# are not fetchable, so don't try to render thumbnails for them either
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("DERIVATIVES_ENABLED", "false")
+os.environ.setdefault("BLOB_STORE", "local")
+os.environ.setdefault("BLOB_DIR", "/tmp/antigravity-bench-blobs")
+os.environ.setdefault("PROJECT_SPILL_DIR", "/tmp/antigravity-bench-project-spill")
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BACKEND_DIR, os.path.dirname(os.path.abspath(__file__))]
+
+import argparse
+import asyncio
+import io
+import json
+import math
+import platform
+import random
+import time
+from collections import defaultdict
+
+import fakes
+
+# route name -> weight; roughly what one dashboard session does, plus health checks
+DEFAULT_MIX = {
+    "health": 5,
+    "auth_me": 35,
+    "projects": 25,
+    "analyze": 15,
+    "generate_character": 15,
+    "generate_modify": 8,
+    "checkout": 2,
+}
+
+# The isolation scenario's cheap routes, and what keeps the pools busy meanwhile
+PROBE_MIX = {"health": 1, "projects": 1}
+LOAD_MIX = {"generate_character": 1}
+# Sub-millisecond routes jitter by more than any relative tolerance
+ISOLATION_SLACK_MS = 5
+
+
+def percentile(sorted_samples, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+def make_uploads(count: int):
+    """A few distinct PNGs, so /analyze sees both cache misses and hits."""
+    from PIL import Image
+
+    uploads = []
+    for i in range(count):
+        out = io.BytesIO()
+        Image.new("RGB", (512, 512), (i * 37 % 256, i * 91 % 256, i * 53 % 256)).save(out, "PNG")
+        uploads.append(out.getvalue())
+    return uploads
+
+
+class Scenario:
+    def __init__(self, client, db, uids, uploads, prompts):
+        self.client = client
+        self.db = db
+        self.uids = uids
+        self.uploads = uploads
+        self.prompts = prompts
+
+    def headers(self, uid: str) -> dict:
+        return {"Authorization": f"Bearer {fakes.token_for(uid)}"}
+
+    def project_for(self, uid: str):
+        # Straight from the fake's store: this runs on the event loop, so skip its latency
+        with self.db.lock:
+            ids = [path.split("/")[1] for path, (data, _) in self.db.docs.items()
+                   if path.startswith("projects/") and data.get("userId") == uid]
+        return random.choice(ids) if ids else None
+
+    async def health(self, uid):
+        return await self.client.get("/health")
+
+    async def auth_me(self, uid):
+        return await self.client.get("/auth/me", headers=self.headers(uid))
+
+    async def projects(self, uid):
+        return await self.client.get("/projects/", params={"limit": 20, "fields": "prompt,image_url,style"},
+                                     headers=self.headers(uid))
+
+    async def analyze(self, uid):
+        files = {"file": ("upload.png", random.choice(self.uploads), "image/png")}
+        return await self.client.post("/analyze/", files=files, headers=self.headers(uid))
+
+    async def generate_character(self, uid):
+        body = {"prompt": random.choice(self.prompts), "style": "3D Render", "type": "basic"}
+        return await self.client.post("/generate/character", json=body, headers=self.headers(uid))
+
+    async def generate_modify(self, uid):
+        body = {"modificationPrompt": "give it a hat"}
+        project_id = self.project_for(uid)
+        if project_id:
+            body["projectId"] = project_id
+        return await self.client.post("/generate/modify", json=body, headers=self.headers(uid))
+
+    async def checkout(self, uid):
+        return await self.client.post("/payments/create-checkout-session", headers=self.headers(uid))
+
+
+async def virtual_user(scenario, mix, deadline, samples, statuses):
+    routes, weights = zip(*mix.items())
+    while time.perf_counter() < deadline:
+        route = random.choices(routes, weights)[0]
+        uid = random.choice(scenario.uids)
+        start = time.perf_counter()
+        try:
+            response = await getattr(scenario, route)(uid)
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        samples[route].append(time.perf_counter() - start)
+        statuses[route][str(status)] += 1
+
+
+async def drive(scenario, groups, duration: float):
+    """Run `(mix, concurrency)` groups of virtual users together; returns (samples, statuses, elapsed)."""
+    samples = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    start = time.perf_counter()
+    await asyncio.gather(*(virtual_user(scenario, mix, start + duration, samples, statuses)
+                           for mix, concurrency in groups for _ in range(concurrency)))
+    return samples, statuses, time.perf_counter() - start
+
+
+def summarize(routes, samples, statuses, elapsed: float) -> dict:
+    summary = {}
+    for route in routes:
+        latencies = sorted(samples[route])
+        ok = sum(n for status, n in statuses[route].items() if status.isdigit() and int(status) < 400)
+        summary[route] = {
+            "requests": len(latencies),
+            "errors": len(latencies) - ok,
+            "rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "statuses": dict(statuses[route]),
+        }
+    return summary
+
+
+async def run(args) -> dict:
+    import httpx
+    import main
+
+    uids = [f"bench-user-{i}" for i in range(args.users)]
+    db = fakes.install(
+        uids,
+        auth=fakes.Faults(args.auth_latency, args.auth_failure_rate),
+        firestore=fakes.Faults(args.firestore_latency, args.firestore_failure_rate),
+        model=fakes.Faults(args.model_latency, args.model_failure_rate),
+        ledger=fakes.Faults(args.firestore_latency),
+        stripe=fakes.Faults(args.stripe_latency, args.stripe_failure_rate),
+    )
+    mix = {route: weight for route, weight in DEFAULT_MIX.items() if route not in args.skip}
+    prompts = [f"a {adjective} robot" for adjective in ("small", "tall", "shiny", "rusty", "friendly", "sleepy")]
+
+    results = {
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("save", "compare", "tolerance")
+        },
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+    }
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            scenario = Scenario(client, db, uids, make_uploads(args.distinct_uploads), prompts)
+            if args.scenario == "isolation":
+                if args.warmup:
+                    await drive(scenario, [(PROBE_MIX, args.probe_concurrency), (LOAD_MIX, args.concurrency)],
+                                args.warmup)
+                results["phases"] = {}
+                for phase, groups in (
+                    ("alone", [(PROBE_MIX, args.probe_concurrency)]),
+                    ("under_load", [(PROBE_MIX, args.probe_concurrency), (LOAD_MIX, args.concurrency)]),
+                ):
+                    samples, statuses, elapsed = await drive(scenario, groups, args.duration)
+                    routes = PROBE_MIX if phase == "alone" else {**PROBE_MIX, **LOAD_MIX}
+                    results["phases"][phase] = {"routes": summarize(routes, samples, statuses, elapsed)}
+                return results
+
+            if args.warmup:
+                await drive(scenario, [(mix, args.concurrency)], args.warmup)
+            samples, statuses, elapsed = await drive(scenario, [(mix, args.concurrency)], args.duration)
+
+    routes = summarize(mix, samples, statuses, elapsed)
+    total = sum(route["requests"] for route in routes.values())
+    results.update({
+        "duration_seconds": round(elapsed, 2),
+        "total_rps": round(total / elapsed, 2),
+        "routes": routes,
+    })
+    return results
+
+
+def print_routes(routes: dict):
+    print(f"{'route':<20}{'requests':>10}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, r in routes.items():
+        print(f"{route:<20}{r['requests']:>10}{r['errors']:>8}{r['rps']:>9}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+def print_report(results: dict):
+    if "phases" in results:
+        for phase, result in results["phases"].items():
+            print(phase)
+            print_routes(result["routes"])
+        return
+    print_routes(results["routes"])
+    print(f"total: {results['total_rps']} req/s over {results['duration_seconds']}s")
+
+
+def isolation_regressions(results: dict, tolerance: float):
+    """Probe routes whose p95 under load rose more than `tolerance` (plus slack) above their p95 alone."""
+    alone, loaded = results["phases"]["alone"]["routes"], results["phases"]["under_load"]["routes"]
+    regressions = []
+    for route in PROBE_MIX:
+        if loaded[route]["p95_ms"] > alone[route]["p95_ms"] * (1 + tolerance) + ISOLATION_SLACK_MS:
+            regressions.append(f"{route}: p95 {alone[route]['p95_ms']}ms alone -> "
+                               f"{loaded[route]['p95_ms']}ms with generations in flight")
+    return regressions
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Routes that got slower or lower-throughput than the baseline by more than `tolerance`."""
+    regressions = []
+    for route, base in baseline["routes"].items():
+        current = results["routes"].get(route)
+        if current is None or not base["requests"]:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {base['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{route}: {base['rps']} -> {current['rps']} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("mix", "isolation"), default="mix")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured load (per phase)")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent virtual users")
+    parser.add_argument("--probe-concurrency", type=int, default=4, help="isolation: users on the cheap routes")
+    parser.add_argument("--users", type=int, default=50, help="distinct user accounts")
+    parser.add_argument("--distinct-uploads", type=int, default=8)
+    parser.add_argument("--skip", action="append", default=[], choices=sorted(DEFAULT_MIX), help="leave a route out")
+    parser.add_argument("--auth-latency", type=float, default=0.005)
+    parser.add_argument("--auth-failure-rate", type=float, default=0.0)
+    parser.add_argument("--firestore-latency", type=float, default=0.015)
+    parser.add_argument("--firestore-failure-rate", type=float, default=0.0)
+    parser.add_argument("--model-latency", type=float, default=0.4)
+    parser.add_argument("--model-failure-rate", type=float, default=0.0)
+    parser.add_argument("--stripe-latency", type=float, default=0.15)
+    parser.add_argument("--stripe-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this file (a new baseline)")
+    parser.add_argument("--compare", help="baseline file to check the results against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    regressions = []
+    if args.scenario == "isolation":
+        regressions += isolation_regressions(results, args.tolerance)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if args.scenario == "isolation":
+            for phase, result in results["phases"].items():
+                regressions += [f"{phase} {line}" for line in compare(result, baseline["phases"][phase], args.tolerance)]
+        else:
+            regressions += compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print("REGRESSION", line)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark for Firebase ID token verification (services/token_verifier.py).
+
+Signs RS256 tokens shaped like Firebase's with a locally generated key and
+self-signed certificate, so nothing is fetched and no project is needed, and
+times per token:
+  - google_id_token: google.oauth2.id_token.verify_token with the certs
+    handed over in-process; what firebase_admin.auth.verify_id_token does,
+    minus its HTTP round trip for the certs
+  - verify_and_cache: TokenVerifier's local check of a token it hasn't seen
+  - cached: TokenVerifier.cached for a token that already verified (the
+    common path on a request)
+
+Run from backend/:
+    python bench/tokens.py --tokens 2000
+    python bench/tokens.py --json tokens.json
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+PROJECT_ID = "bench-project"
+KEY_ID = "bench-key"
+
+
+def make_signing_key():
+    """An RSA key and a self-signed PEM certificate for it."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "bench-securetoken")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("ascii")
+    return key_pem, cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+def make_tokens(key_pem: str, count: int):
+    from google.auth import crypt, jwt
+
+    signer = crypt.RSASigner.from_string(key_pem, key_id=KEY_ID)
+    now = int(time.time())
+    return [
+        jwt.encode(signer, {
+            "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+            "aud": PROJECT_ID,
+            "sub": f"bench-user-{i}",
+            "auth_time": now - 60,
+            "iat": now - 60,
+            "exp": now + 3600,
+        }).decode("ascii")
+        for i in range(count)
+    ]
+
+
+class LocalCertStore:
+    """A CertStore that already holds the benchmark certificate."""
+
+    def __init__(self, certs: dict):
+        self.certs = certs
+
+    def fresh(self) -> bool:
+        return True
+
+    def refresh(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class CertsResponse:
+    status = 200
+
+    def __init__(self, certs: dict):
+        self.data = json.dumps(certs).encode("utf-8")
+        self.headers = {}
+
+
+def time_each(fn, tokens) -> list:
+    samples = []
+    for token in tokens:
+        start = time.perf_counter()
+        fn(token)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples) -> dict:
+    median = statistics.median(samples)
+    return {
+        "median_us": round(median * 1e6, 1),
+        "p95_us": round(sorted(samples)[int(len(samples) * 0.95) - 1] * 1e6, 1),
+        "per_second": round(1 / median),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000, help="distinct tokens per measurement")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    from google.oauth2 import id_token
+
+    from services.token_verifier import TokenVerifier
+
+    key_pem, cert_pem = make_signing_key()
+    certs = {KEY_ID: cert_pem}
+    tokens = make_tokens(key_pem, args.tokens)
+    verifier = TokenVerifier(PROJECT_ID, cert_store=LocalCertStore(certs), cache_size=args.tokens)
+
+    def google_id_token(token):
+        return id_token.verify_token(token, lambda url, **kwargs: CertsResponse(certs), audience=PROJECT_ID)
+
+    results = {
+        "tokens": args.tokens,
+        "google_id_token": summarize(time_each(google_id_token, tokens)),
+        "verify_and_cache": summarize(time_each(verifier.verify_and_cache, tokens)),
+        "cached": summarize(time_each(verifier.cached, tokens)),
+    }
+    assert all(verifier.cached(token) is not None for token in tokens)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,217 @@
+import logging
 import os
-import firebase_admin
-from firebase_admin import credentials, firestore
-import google.generativeai as genai
+import sys
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configuration
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 FIREBASE_CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS_PATH")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Set by Cloud Run, where the disk is in-memory and requests spread over instances
+ON_CLOUD_RUN = bool(os.getenv("K_SERVICE"))
+
+# Model names, per-model concurrency limits and timeouts (see services/models.py)
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
+IMAGEN_MODEL = os.getenv("IMAGEN_MODEL", "imagen-3.0-generate-001")
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+IMAGEN_CONCURRENCY = int(os.getenv("IMAGEN_CONCURRENCY", "4"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+IMAGEN_TIMEOUT = float(os.getenv("IMAGEN_TIMEOUT", "90"))
+
+# Thread pool sizes for the blocking SDK clients (see services/executor.py)
+MODEL_POOL_SIZE = int(os.getenv("MODEL_POOL_SIZE", "16"))
+FIRESTORE_POOL_SIZE = int(os.getenv("FIRESTORE_POOL_SIZE", "32"))
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", "4"))
+AUTH_POOL_SIZE = int(os.getenv("AUTH_POOL_SIZE", "8"))
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "8"))
+# Image decoding holds full-size bitmaps in memory, so keep this pool small
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", "2"))
+
+# /analyze result cache: in-process LRU plus an optional shared tier
+# ("firestore" or "disk", see services/analysis_cache.py)
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "512"))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "")
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "/tmp/antigravity-analysis-cache")
+ANALYSIS_CACHE_DISK_ENTRIES = int(os.getenv("ANALYSIS_CACHE_DISK_ENTRIES", "10000"))
+
+# Upload ingestion limits for /analyze (see services/ingest.py)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_PIXELS", str(40_000_000)))
+ANALYSIS_MAX_SIDE = int(os.getenv("ANALYSIS_MAX_SIDE", "1024"))
+
+# Generation job queue (see services/jobs.py). Job status is kept in
+# Firestore ("firestore") so a poll can land on any instance; "memory" only
+# works with a single instance. Subscribers to a job another instance runs
+# re-read it every JOB_POLL_INTERVAL seconds.
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "200"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_BACKEND = os.getenv("JOB_BACKEND", "firestore" if ON_CLOUD_RUN else "memory")
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+
+# Generation fallback pipeline (see services/pipeline.py)
+HEDGE_DELAY_SECONDS = float(os.getenv("HEDGE_DELAY_SECONDS", "8"))
+IMAGEN_DEADLINE_SECONDS = float(os.getenv("IMAGEN_DEADLINE_SECONDS", "60"))
+SVG_DEADLINE_SECONDS = float(os.getenv("SVG_DEADLINE_SECONDS", "45"))
+
+# Generated asset storage (see services/blob_store.py). Defaults to Cloud
+# Storage when a bucket is configured, otherwise a local directory served under
+# BLOB_BASE_URL in development, and inline data URIs on Cloud Run (K_SERVICE is
+# set), whose disk is in-memory, per instance and not reachable by clients.
+STORAGE_BUCKET = os.getenv("FIREBASE_STORAGE_BUCKET")
+BLOB_STORE = os.getenv("BLOB_STORE", "gcs" if STORAGE_BUCKET else ("inline" if ON_CLOUD_RUN else "local"))
+BLOB_DIR = os.getenv("BLOB_DIR", "/tmp/antigravity-blobs")
+BLOB_BASE_URL = os.getenv("BLOB_BASE_URL", "http://localhost:8000/blobs")
+
+# Derivatives rendered for every saved generation (see services/derivatives.py)
+DERIVATIVES_ENABLED = os.getenv("DERIVATIVES_ENABLED", "true").lower() in ("1", "true", "yes")
+THUMBNAIL_SIZES = tuple(int(size) for size in os.getenv("THUMBNAIL_SIZES", "256,512").split(","))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+# Width SVG fallbacks are rasterized at (needs cairosvg)
+RASTER_SIZE = int(os.getenv("RASTER_SIZE", "1024"))
+
+# /auth/me profile cache (see services/profile_cache.py)
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "60"))
+
+# Write-behind project documents (see services/project_writer.py). Each
+# process keeps the records it has not written yet in its own file in
+# PROJECT_SPILL_DIR. To survive a crash this must be a persistent volume
+# shared by the processes that replace each other; on Cloud Run /tmp is
+# in-memory and lost with the instance.
+PROJECT_FLUSH_INTERVAL = float(os.getenv("PROJECT_FLUSH_INTERVAL", "0.5"))
+PROJECT_BATCH_SIZE = int(os.getenv("PROJECT_BATCH_SIZE", "100"))
+PROJECT_RETRY_BASE_DELAY = float(os.getenv("PROJECT_RETRY_BASE_DELAY", "1.0"))
+PROJECT_RETRY_MAX_DELAY = float(os.getenv("PROJECT_RETRY_MAX_DELAY", "60"))
+PROJECT_SPILL_DIR = os.getenv("PROJECT_SPILL_DIR", "/tmp/antigravity-project-spill")
+
+# Per-user cache of project prompts/styles for /generate/modify (see services/project_cache.py)
+PROJECT_CACHE_SIZE = int(os.getenv("PROJECT_CACHE_SIZE", "10000"))
+PROJECT_CACHE_TTL = int(os.getenv("PROJECT_CACHE_TTL", "3600"))
+
+# Seconds between batched credit ledger commit writes (see services/credit_ledger.py)
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "2"))
+
+# /generate/batch limits
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "24"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# Opt-in /generate/character result cache (see services/result_cache.py)
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "2048"))
+GENERATION_CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", str(24 * 3600)))
 
-# Initialize Gemini
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
+# Per-user token buckets for the expensive endpoints (see services/rate_limit.py).
+# The generate burst has to cover a full /generate/batch.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_GENERATE_PER_MINUTE = float(os.getenv("RATE_LIMIT_GENERATE_PER_MINUTE", "20"))
+RATE_LIMIT_GENERATE_BURST = int(os.getenv("RATE_LIMIT_GENERATE_BURST", "30"))
+RATE_LIMIT_ANALYZE_PER_MINUTE = float(os.getenv("RATE_LIMIT_ANALYZE_PER_MINUTE", "30"))
+RATE_LIMIT_ANALYZE_BURST = int(os.getenv("RATE_LIMIT_ANALYZE_BURST", "10"))
+# New work is shed with a 429 once a model's expected queue wait exceeds this
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "10"))
 
-# Initialize Firebase
+# Stripe webhook processing (see services/stripe_events.py)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+WEBHOOK_RETRY_BASE_DELAY = float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", "1.0"))
+
+# Bearer token /metrics requires (Authorization: Bearer <token>). Without
+# one, /metrics is only served off Cloud Run, i.e. in local development.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Logging (see services/logs.py)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json or text
+# Fraction of requests whose INFO logs are kept; warnings and errors are always kept
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_REDACT = os.getenv("LOG_REDACT", "true").lower() in ("1", "true", "yes")
+
+# Warm up Firebase, Gemini, Stripe and Pillow in the background at startup
+# (see main.py). With PREWARM off, each is initialized by the first request that needs it.
+PREWARM = os.getenv("PREWARM", "true").lower() in ("1", "true", "yes")
+
+# Firebase Admin is initialized on first use rather than at import: the SDK
+# import and the credentials lookup take seconds and would otherwise be paid
+# by every cold start before the container can answer a request.
+# Gemini is configured by the model registry (services/models.py).
 db = None
-if not firebase_admin._apps:
-    if FIREBASE_CREDENTIALS_PATH and os.path.exists(FIREBASE_CREDENTIALS_PATH):
-        cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
-        firebase_admin.initialize_app(cred)
-        db = firestore.client()
-        print("Firebase Admin initialized with credentials file.")
-    else:
-        # Fallback to Application Default Credentials (Cloud Run)
-        try:
-            firebase_admin.initialize_app()
+_firebase_ready = False
+_firebase_lock = threading.Lock()
+
+def init_firebase():
+    """Initialize Firebase Admin once; returns the Firestore client, or None if unavailable."""
+    global db, _firebase_ready
+    if _firebase_ready:
+        return db
+    with _firebase_lock:
+        if _firebase_ready:
+            return db
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        if not firebase_admin._apps:
+            if FIREBASE_CREDENTIALS_PATH and os.path.exists(FIREBASE_CREDENTIALS_PATH):
+                cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
+                firebase_admin.initialize_app(cred)
+                db = firestore.client()
+                logger.info("Firebase Admin initialized with credentials file")
+            else:
+                # Fallback to Application Default Credentials (Cloud Run)
+                try:
+                    firebase_admin.initialize_app()
+                    db = firestore.client()
+                    logger.info("Firebase Admin initialized with Default Credentials")
+                except Exception as e:
+                    logger.warning("Could not initialize Firebase Admin", extra={"error": str(e)})
+                    db = None
+        else:
             db = firestore.client()
-            print("Firebase Admin initialized with Default Credentials.")
-        except Exception as e:
-            print(f"Warning: Could not initialize Firebase Admin: {e}")
-            db = None
-else:
-    db = firestore.client()
+        _firebase_ready = True
+    return db
 
 def get_db():
+    return init_firebase()
+
+# Firestore caps a batched write at 500 operations
+FIRESTORE_MAX_BATCH_WRITES = 500
+
+def require_db():
+    """
+    get_db() for the Firestore-backed stores, raising if Firestore is unavailable.
+    Blocks on first use, so stores resolve it on the Firestore pool rather than at startup.
+    """
+    db = init_firebase()
+    if db is None:
+        raise RuntimeError("Database unavailable")
     return db
+
+async def get_db_async():
+    """get_db() for handlers: initializing Firebase on first use happens on the Firestore pool."""
+    if _firebase_ready:
+        return db
+    from services.executor import run_db
+
+    return await run_db(init_firebase)
+
+def get_stripe():
+    """The Stripe SDK, imported and configured on first use."""
+    import stripe
+
+    stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+async def get_stripe_async():
+    """get_stripe() for handlers: the first, slow import happens on the Stripe pool."""
+    if "stripe" in sys.modules:
+        return get_stripe()
+    from services.executor import run_stripe
+
+    return await run_stripe(get_stripe)
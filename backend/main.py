@@ -1,9 +1,90 @@
+import asyncio
+import hmac
+import logging
 import os
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from config import get_db
+from fastapi.staticfiles import StaticFiles
+from config import BLOB_STORE, METRICS_TOKEN, ON_CLOUD_RUN, PREWARM, get_stripe, init_firebase
+from services import (
+    analysis_cache,
+    blob_store,
+    credit_ledger,
+    derivatives,
+    executor,
+    ingest,
+    jobs,
+    logs,
+    metrics,
+    models,
+    profile_cache,
+    project_cache,
+    project_writer,
+    result_cache,
+    stripe_events,
+    token_verifier,
+)
+
+logs.setup_logging()
+
+logger = logging.getLogger(__name__)
+
+async def warm_models():
+    registry = await executor.run_model(models.get_registry)
+    await executor.run_model(registry.warm)
+
+async def prewarm():
+    """
+    Initialize the SDK clients in the background so the first requests don't
+    pay for it. Startup itself never waits on this.
+    """
+    steps = {
+        "firebase": executor.run_db(init_firebase),
+        "models": warm_models(),
+        "token_certs": executor.run_auth(token_verifier.prefetch),
+        "stripe": executor.run_stripe(get_stripe),
+        "pillow": executor.run_image(ingest.load_pillow),
+    }
 
-app = FastAPI(title="Antigravity API", version="1.0.0")
+    async def timed(name, step):
+        start = time.perf_counter()
+        try:
+            await step
+        except Exception as e:
+            logger.warning("Prewarm step failed", extra={"step": name, "error": str(e)})
+        else:
+            logger.info("Prewarm step done", extra={"step": name, "seconds": round(time.perf_counter() - start, 3)})
+
+    await asyncio.gather(*(timed(name, step) for name, step in steps.items()))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_up = asyncio.create_task(prewarm()) if PREWARM else None
+    await jobs.get_manager().start()
+    await credit_ledger.get_ledger().start()
+    await project_writer.get_writer().start()
+    await stripe_events.get_processor().start()
+    yield
+    if warm_up is not None:
+        warm_up.cancel()
+    await jobs.get_manager().stop()
+    await credit_ledger.get_ledger().stop()
+    # Renders submit their thumbnails to the project writer
+    await derivatives.drain()
+    # After the job workers and renders, so everything they submitted is flushed too
+    await project_writer.get_writer().stop()
+    await stripe_events.get_processor().stop()
+    token_verifier.stop()
+    executor.shutdown()
+
+app = FastAPI(title="Antigravity API", version="1.0.0", lifespan=lifespan)
+
+# Innermost, so 413s for oversized uploads still get CORS headers
+app.add_middleware(ingest.UploadLimitMiddleware)
 
 # CORS Configuration
 origins = [
@@ -19,8 +100,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Retry-After"],
 )
 
+app.add_middleware(metrics.MetricsMiddleware)
+# Added last so it wraps everything else and the request id is set for all of it
+app.add_middleware(logs.RequestIdMiddleware)
+
 @app.get("/")
 async def root():
     return {"message": "Antigravity API is running", "status": "ok"}
@@ -29,6 +115,82 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+def metrics_authorized(authorization: Optional[str]) -> bool:
+    if not METRICS_TOKEN:
+        # Nothing to check against: only expose them in local development
+        return not ON_CLOUD_RUN
+    scheme, _, token = (authorization or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus scrape endpoint; needs `Authorization: Bearer $METRICS_TOKEN` (see config.py)."""
+    if not metrics_authorized(authorization):
+        # Same answer as an unknown route, so the endpoint isn't advertised
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@metrics.register_collector
+def service_stats():
+    """Export the stats() the services already keep as gauges and counters."""
+    samples = []
+
+    job_stats = jobs.get_manager().stats()
+    samples += [
+        ("job_queue_depth", "gauge", "Generation jobs waiting for a worker.", {}, job_stats["queue_depth"]),
+        ("jobs_running", "gauge", "Generation jobs currently running.", {}, job_stats["running"]),
+        ("jobs_finished_total", "counter", "Finished generation jobs.", {"outcome": "completed"}, job_stats["completed"]),
+        ("jobs_finished_total", "counter", "Finished generation jobs.", {"outcome": "failed"}, job_stats["failed"]),
+        ("jobs_finished_total", "counter", "Finished generation jobs.", {"outcome": "dropped"}, job_stats["dropped"]),
+        ("job_wait_seconds_max", "gauge", "Longest queue wait seen.", {}, job_stats["max_wait_seconds"]),
+    ]
+
+    registry = models.peek_registry()
+    for role, client in (registry.stats() if registry else {}).items():
+        samples.append(("model_in_flight", "gauge", "Model calls in flight.", {"role": role}, client["in_flight"]))
+        samples.append(("model_concurrency_limit", "gauge", "Model concurrency limit.", {"role": role}, client["limit"]))
+
+    # The analysis cache's own totals: its in-memory tier counts a miss even when the shared tier answers
+    analysis = analysis_cache.get_cache().stats()
+    caches = {
+        "profile": profile_cache.get_cache().stats(),
+        "generation": result_cache.get_cache().stats(),
+        "analysis": {"hits": analysis["hits"] + analysis["shared_hits"], "misses": analysis["misses"],
+                     "size": analysis["memory"]["size"]},
+        "project_context": project_cache.get_cache().stats(),
+    }
+    verifier = token_verifier.peek_verifier()
+    if verifier is not None:
+        caches["token"] = verifier.cache.stats()
+    for name, stats in caches.items():
+        labels = {"cache": name}
+        samples.append(("cache_hits_total", "counter", "Cache hits.", labels, stats["hits"]))
+        samples.append(("cache_misses_total", "counter", "Cache misses.", labels, stats["misses"]))
+        samples.append(("cache_entries", "gauge", "Entries held in memory.", labels, stats["size"]))
+    samples.append(("generation_cache_coalesced_total", "counter", "Requests that joined an identical in-flight generation.",
+                    {}, caches["generation"]["coalesced"]))
+    samples.append(("analysis_cache_shared_hits_total", "counter", "Analysis cache hits answered by the shared tier.",
+                    {}, analysis["shared_hits"]))
+
+    webhook_stats = stripe_events.get_processor().stats()
+    samples.append(("stripe_webhook_queue_depth", "gauge", "Stripe events waiting to be applied.",
+                    {}, webhook_stats["queue_depth"]))
+    for outcome in ("received", "duplicates", "applied", "failed"):
+        samples.append(("stripe_webhook_events_total", "counter", "Stripe webhook events by outcome.",
+                        {"outcome": outcome}, webhook_stats[outcome]))
+
+    samples.append(("credit_ledger_pending_commits", "gauge", "Ledger commits waiting to be flushed.",
+                    {}, credit_ledger.get_ledger().stats()["pending_commits"]))
+    writer_stats = project_writer.get_writer().stats()
+    samples += [
+        ("project_writes_pending", "gauge", "Project documents waiting to be written.", {}, writer_stats["pending"]),
+        ("project_writes_total", "counter", "Project documents written.", {}, writer_stats["written"]),
+        ("project_write_failures_total", "counter", "Failed project batch writes.", {}, writer_stats["failed_flushes"]),
+        ("project_dead_letters_total", "counter", "Project documents Firestore rejected for good.",
+         {}, writer_stats["dead_lettered"]),
+    ]
+    return samples
+
 # Include Routers
 from routers import auth, analyze, generate, payments, projects
 
@@ -37,3 +199,7 @@ app.include_router(analyze.router)
 app.include_router(generate.router)
 app.include_router(payments.router)
 app.include_router(projects.router)
+
+# Serve generated assets ourselves when not using Cloud Storage (local dev/tests)
+if BLOB_STORE == "local":
+    app.mount("/blobs", StaticFiles(directory=blob_store.get_store().directory), name="blobs")
@@ -1,52 +1,185 @@
+import json
+import logging
+
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
-from routers.auth import verify_token
-import google.generativeai as genai
-from PIL import Image
-import io
+from fastapi.responses import StreamingResponse
+from routers.auth import rate_limited
+from services import analysis_cache, metrics, models
+from services.executor import run_image
+from services.ingest import open_upload, prepare_image
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/analyze", tags=["analyze"])
 
+# Bump the version whenever the prompt changes so cached analyses are not reused
+ANALYSIS_PROMPT_VERSION = "1"
+ANALYSIS_PROMPT = """
+        Describe this character in detail for the purpose of regenerating it. 
+        Focus on physical appearance, clothing, accessories, and distinct features.
+        Also identify the art style (e.g., 3D render, anime, sketch).
+        
+        Format the output as a single descriptive paragraph followed by a new line and "Style: [Style Name]".
+        """
+
+STYLE_MARKER = "Style:"
+DEFAULT_STYLE = "3D Render"
+
+
+def parse_analysis(text: str) -> dict:
+    description = text
+    style = DEFAULT_STYLE
+
+    if STYLE_MARKER in text:
+        parts = text.split(STYLE_MARKER)
+        description = parts[0].strip()
+        style = parts[1].strip()
+
+    return {
+        "description": description,
+        "style": style
+    }
+
+
+class StyleSplitter:
+    """
+    Incremental version of parse_analysis for streamed output.
+
+    `feed` returns the part of each chunk that is known to be description.
+    Text that could be the start of a "Style:" marker split across chunks is
+    held back until the next chunk settles it. `result()` gives the same dict
+    parse_analysis would for the whole text.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.emitted = 0
+        self.marker_at = -1
+
+    def feed(self, chunk: str) -> str:
+        self.text += chunk
+        if self.marker_at >= 0:
+            return ""
+        self.marker_at = self.text.find(STYLE_MARKER, self.emitted)
+        if self.marker_at >= 0:
+            end = self.marker_at
+        else:
+            end = len(self.text)
+            # Hold back a trailing prefix of the marker ("St", "Styl", ...)
+            for size in range(min(len(STYLE_MARKER) - 1, len(self.text)), 0, -1):
+                if STYLE_MARKER.startswith(self.text[-size:]):
+                    end -= size
+                    break
+        end = max(end, self.emitted)
+        out, self.emitted = self.text[self.emitted:end], end
+        return out
+
+    def flush(self) -> str:
+        """Description text still held back once the stream has ended."""
+        if self.marker_at >= 0:
+            return ""
+        out, self.emitted = self.text[self.emitted:], len(self.text)
+        return out
+
+    def result(self) -> dict:
+        return parse_analysis(self.text)
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def prepare_analysis(file: UploadFile):
+    """Decode an upload for the model. Returns (image, cache_key, cached result or None)."""
+    # Decode the (size-capped) upload at the resolution the model needs
+    with metrics.stage_timer("analyze", "ingest"):
+        image = await run_image(prepare_image, open_upload(file))
+
+    # Identical images (after decoding) reuse the previous analysis
+    cache = analysis_cache.get_cache()
+    with metrics.stage_timer("analyze", "cache_lookup"):
+        cache_key = await run_image(analysis_cache.image_key, image, ANALYSIS_PROMPT_VERSION)
+        cached = await cache.get(cache_key)
+    return image, cache_key, cached
+
 @router.post("/")
 async def analyze_image(
     file: UploadFile = File(...),
-    user_data: dict = Depends(verify_token)
+    user_data: dict = Depends(rate_limited("analyze", model="gemini"))
 ):
     """
     Upload an image and analyze it using Gemini Vision Pro.
     Returns a structured description of the character.
     """
     try:
-        # Read image file
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        image, cache_key, cached = await prepare_analysis(file)
+        if cached is not None:
+            return cached
 
-        # Prepare Gemini Model
-        model = genai.GenerativeModel('gemini-1.5-pro')
-        
-        prompt = """
-        Describe this character in detail for the purpose of regenerating it. 
-        Focus on physical appearance, clothing, accessories, and distinct features.
-        Also identify the art style (e.g., 3D render, anime, sketch).
-        
-        Format the output as a single descriptive paragraph followed by a new line and "Style: [Style Name]".
-        """
+        model = (await models.get_registry_async()).get("gemini")
+        with metrics.stage_timer("analyze", "gemini"):
+            response = await model.generate_content([ANALYSIS_PROMPT, image])
+        result = parse_analysis(response.text)
+        await analysis_cache.get_cache().set(cache_key, result)
+        return result
 
-        response = model.generate_content([prompt, image])
-        text = response.text
-        
-        # Simple parsing
-        description = text
-        style = "3D Render" # Default
-        
-        if "Style:" in text:
-            parts = text.split("Style:")
-            description = parts[0].strip()
-            style = parts[1].strip()
-        
-        return {
-            "description": description,
-            "style": style
-        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+
+
+@router.post("/stream")
+async def analyze_image_stream(
+    file: UploadFile = File(...),
+    user_data: dict = Depends(rate_limited("analyze", model="gemini"))
+):
+    """
+    Streaming variant of /analyze as Server-Sent Events:
+
+        event: description   data: {"text": "..."}   (repeated, as Gemini emits it)
+        event: result        data: {"description": "...", "style": "..."}
+        event: error         data: {"detail": "..."}
 
+    The final `result` is the same as /analyze returns, so clients can replace
+    the streamed text with it.
+    """
+    try:
+        image, cache_key, cached = await prepare_analysis(file)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+
+    async def events():
+        if cached is not None:
+            yield sse("description", {"text": cached["description"]})
+            yield sse("result", cached)
+            return
+
+        splitter = StyleSplitter()
+        try:
+            model = (await models.get_registry_async()).get("gemini")
+            with metrics.stage_timer("analyze", "gemini"):
+                async for chunk in model.stream_content([ANALYSIS_PROMPT, image]):
+                    text = splitter.feed(chunk)
+                    if text:
+                        yield sse("description", {"text": text})
+            text = splitter.flush()
+            if text:
+                yield sse("description", {"text": text})
+        except Exception as e:
+            logger.exception("Streaming analysis failed")
+            yield sse("error", {"detail": f"Analysis failed: {str(e)}"})
+            return
+
+        result = splitter.result()
+        await analysis_cache.get_cache().set(cache_key, result)
+        yield sse("result", result)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Stop proxies (and Cloud Run's frontend) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,15 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from firebase_admin import auth
 from typing import Optional
+from services.executor import run_auth, run_db
+from services import metrics, profile_cache, rate_limit, token_verifier
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 security = HTTPBearer()
 
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+    with metrics.stage_timer("auth", "verify_token"):
+        return await _verify(credentials.credentials)
+
+async def _verify(token: str):
     try:
-        decoded_token = auth.verify_id_token(token)
+        verifier = await token_verifier.get_verifier_async()
+        if verifier is None:
+            # Project id unknown, so we can't check the audience ourselves
+            return await run_auth(verify_with_firebase, token)
+        decoded_token = verifier.cached(token)
+        if decoded_token is None:
+            decoded_token = await run_auth(verifier.verify_and_cache, token)
         return decoded_token
     except Exception as e:
         raise HTTPException(
@@ -18,12 +31,32 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-from config import get_db
+def rate_limited(bucket: str, model: Optional[str] = None):
+    """
+    Dependency for expensive endpoints: authenticates like `verify_token`,
+    then sheds the request if `model` is overloaded and takes a token from
+    the user's `bucket` (429 with Retry-After otherwise).
+    """
+    async def dependency(user_data: dict = Depends(verify_token)):
+        await rate_limit.enforce(user_data, bucket, model)
+        return user_data
+
+    return dependency
+
+from config import get_db_async, init_firebase
+
+def verify_with_firebase(token: str):
+    """Blocking: verify through the Firebase Admin SDK, initializing it if needed."""
+    from firebase_admin import auth
+
+    init_firebase()
+    return auth.verify_id_token(token)
 
 @router.get("/me")
-async def get_current_user(user_data: dict = Depends(verify_token)):
+async def get_current_user(request: Request, user_data: dict = Depends(verify_token)):
     """
     Verify the current user's token and return their Firebase profile data + Firestore data.
+    Served from the profile cache unless the request sends `Cache-Control: no-cache`.
     """
     uid = user_data["uid"]
     profile = {
@@ -34,14 +67,23 @@ async def get_current_user(user_data: dict = Depends(verify_token)):
         "isPremium": False
     }
     
+    cache = profile_cache.get_cache()
+    if "no-cache" not in request.headers.get("cache-control", ""):
+        cached = await cache.get(uid)
+        if cached is not None:
+            profile.update(cached)
+            return profile
+
     try:
-        db = get_db()
+        db = await get_db_async()
         if db:
+            version = cache.version(uid)
             doc_ref = db.collection('users').document(uid)
-            doc = doc_ref.get()
+            doc = await run_db(doc_ref.get)
             if doc.exists:
                 data = doc.to_dict()
                 profile.update(data)
+                await cache.set(uid, data, version=version)
             else:
                 # Create initial user doc if not exists
                 initial_data = {
@@ -51,9 +93,10 @@ async def get_current_user(user_data: dict = Depends(verify_token)):
                     "generation_count": 0,
                     "modification_count": 0
                 }
-                doc_ref.set(initial_data)
+                await run_db(doc_ref.set, initial_data)
                 profile.update(initial_data)
-    except Exception as e:
-        print(f"Error fetching user profile: {e}")
+                await cache.set(uid, initial_data, version=version)
+    except Exception:
+        logger.exception("Error fetching user profile", extra={"uid": uid})
         
     return profile
@@ -1,8 +1,18 @@
 from fastapi import APIRouter, HTTPException, Body, Depends
-from routers.auth import verify_token
-from config import get_db
-from firebase_admin import firestore
-import google.generativeai as genai
+from fastapi.responses import JSONResponse, StreamingResponse
+from routers.auth import rate_limited, verify_token
+from config import BATCH_CONCURRENCY, BATCH_MAX_PROMPTS, GENERATION_CACHE_ENABLED, get_db_async
+from services import (
+    blob_store, credit_ledger, derivatives, jobs, metrics, models, pipeline, project_cache,
+    project_writer, rate_limit, result_cache,
+)
+import asyncio
+import functools
+import json
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/generate", tags=["generate"])
 
@@ -11,11 +21,33 @@ class GenerationRequest:
     style: str
     type: str  # basic, storyboard, mockup, emoticon
 
-@router.post("/character")
-async def generate_character(
-    request: dict = Body(...),
-    user_data: dict = Depends(verify_token)
-):
+async def reserve_credits(uid: str, kind: str, insufficient_detail: str, count: int = 1):
+    try:
+        with metrics.stage_timer("generate", "credit_reserve"):
+            reservation = await credit_ledger.get_ledger().reserve(uid, kind, count)
+    except credit_ledger.InsufficientCreditsError:
+        raise HTTPException(status_code=402, detail=insufficient_detail)
+    except Exception:
+        logger.exception("Credit reservation failed", extra={"uid": uid, "kind": kind})
+        raise HTTPException(status_code=500, detail="Transaction failed")
+    logger.info("Credits reserved", extra={"uid": uid, "kind": kind, "count": count, "tier": reservation.tier})
+    return reservation
+
+async def produce_image(subject: str, keywords_from: str, tag: str) -> dict:
+    """Run the pipeline and store the asset; returns the image fields plus tier and billable flag."""
+    try:
+        generated = await pipeline.generate_image(subject, keywords_from, tag)
+    except pipeline.PipelineError as e:
+        logger.error("Image generation failed", extra={"errors": e.errors})
+        metrics.GENERATION_TIER.inc(flow="character", tier="failed")
+        return {"image_fields": None, "image": None, "tier": None, "billable": False}
+    logger.info("Image generated", extra={"tier": generated.tier})
+    metrics.GENERATION_TIER.inc(flow="character", tier=generated.tier)
+    with metrics.stage_timer("generate", "blob_save"):
+        image_fields = await blob_store.save_generated(generated.image)
+    return {"image_fields": image_fields, "image": generated.image, "tier": generated.tier, "billable": generated.billable}
+
+async def run_character_generation(request: dict, user_data: dict):
     """
     Generate a refined character image based on the analysis.
     """
@@ -32,251 +64,344 @@ async def generate_character(
         prompt = request.get("prompt")
         style = request.get("style")
         gen_type = request.get("type", "basic")
-        print(f"Received generation request: Prompt='{prompt}', Style='{style}', Type='{gen_type}', User='{user_data['uid']}'")
+        logger.info("Received generation request", extra={
+            "prompt": prompt, "style": style, "type": gen_type, "uid": user_data['uid'],
+        })
         
-        import os
-        if not os.getenv("GOOGLE_API_KEY"):
-            print("CRITICAL: GOOGLE_API_KEY is not set!")
+        if not (await models.get_registry_async()).configured:
+            logger.critical("GOOGLE_API_KEY is not set")
             raise HTTPException(status_code=500, detail="Server Configuration Error: API Key missing.")
         
         # Check Credits
-        db = get_db()
+        db = await get_db_async()
         if not db:
             raise HTTPException(status_code=500, detail="Database unavailable")
             
-        user_ref = db.collection('users').document(user_data['uid'])
-        
-        # Transaction to safely check limits and deduct credit
-        @firestore.transactional
-        def check_and_deduct(transaction, doc_ref):
-            snapshot = doc_ref.get(transaction=transaction)
-            if not snapshot.exists:
-                # Initialize if missing
-                initial_data = {
-                    "credits": 0, 
-                    "isPremium": False,
-                    "generation_count": 0,
-                    "modification_count": 0
-                }
-                transaction.set(doc_ref, initial_data)
-                return "free" # First one is free
-            
-            data = snapshot.to_dict()
-            gen_count = data.get("generation_count", 0)
-            credits = data.get("credits", 0)
-            
-            # Logic: 1 Free Generation
-            if gen_count < 1:
-                transaction.update(doc_ref, {"generation_count": firestore.Increment(1)})
-                return "free"
-            
-            # Otherwise, check credits
-            if credits < 1:
-                raise ValueError("Insufficient credits")
-            
-            transaction.update(doc_ref, {
-                "credits": firestore.Increment(-1),
-                "generation_count": firestore.Increment(1)
-            })
-            return "paid"
-
-        try:
-            transaction = db.transaction()
-            status = check_and_deduct(transaction, user_ref)
-            print(f"Generation status: {status}")
-        except ValueError as e:
-            raise HTTPException(status_code=402, detail="Insufficient credits. You have used your free generation. Please upgrade.")
-        except Exception as e:
-            print(f"Transaction failed: {e}")
-            raise HTTPException(status_code=500, detail="Transaction failed")
+        # Reserve the credit; it is committed once an image is produced and refunded otherwise
+        reservation = await reserve_credits(
+            user_data['uid'], credit_ledger.GENERATION,
+            "Insufficient credits. You have used your free generation. Please upgrade.",
+        )
 
         # Refine Prompt (Simple concatenation for now to save latency, or use Gemini Text model)
         refined_prompt = f"{prompt}, {style} style"
         
-        # Generate Image
-        image_url = "https://via.placeholder.com/1024x1024.png?text=Generation+Failed"
-        
+        # Generate Image (Imagen -> SVG -> Unsplash, hedged; see services/pipeline.py)
+        # With caching opted in, identical prompt/style/type requests reuse (or join) one generation
+        produce = functools.partial(produce_image, refined_prompt, prompt, gen_type)
+        outcome = {"billable": False}
         try:
-            # Construct the full prompt
-            full_prompt = f"{refined_prompt}. High quality, detailed, 8k."
-            
-            # Try to use Imagen model
-            # Note: This requires the 'imagen-3.0-generate-001' or similar model to be available to the API key
-            model = genai.GenerativeModel('imagen-3.0-generate-001')
-            result = model.generate_images(
-                prompt=full_prompt,
-                number_of_images=1,
-            )
-            image_url = result.images[0].url
-                
-        except Exception as e:
-            print(f"Image generation failed: {e}")
-            
-            # Fallback: Generate SVG using Gemini
-            try:
-                print("Attempting SVG generation fallback...")
-                svg_model = genai.GenerativeModel('gemini-1.5-pro')
-                svg_prompt = f"Generate a simple, cute SVG code for a {refined_prompt}. Return ONLY the SVG code, no markdown."
-                svg_response = svg_model.generate_content(svg_prompt)
-                svg_content = svg_response.text.replace("```svg", "").replace("```", "").strip()
-                
-                # Encode SVG to Data URI
-                import base64
-                encoded_svg = base64.b64encode(svg_content.encode('utf-8')).decode('utf-8')
-                image_url = f"data:image/svg+xml;base64,{encoded_svg}"
-                print("SVG generation successful")
-                
-            except Exception as svg_e:
-                print(f"SVG generation failed: {svg_e}")
-                
-                # Final Fallback: Unsplash (High Quality Real Images)
-                # Use keywords from the prompt to find a relevant image
-                keywords = prompt.split(" ")[0:3] # First 3 words
-                search_term = ",".join(keywords)
-                image_url = f"https://source.unsplash.com/1024x1024/?{search_term},{gen_type}"
-                print(f"Using Unsplash fallback: {image_url}")
+            if GENERATION_CACHE_ENABLED or request.get("cache"):
+                key = result_cache.generation_key(refined_prompt, style, gen_type)
+                outcome = await result_cache.get_cache().get_or_generate(key, produce)
+            else:
+                outcome = await produce()
+        finally:
+            await credit_ledger.get_ledger().settle(reservation, outcome["billable"])
+        image_fields = outcome["image_fields"] or {"image_url": "https://via.placeholder.com/1024x1024.png?text=Generation+Failed"}
+        image_url = image_fields["image_url"]
         
-        # Save to Firestore
+        # Save to Firestore (written behind the response, see services/project_writer.py)
+        from firebase_admin import firestore
+        doc_ref = db.collection('projects').document()
         try:
-            doc_ref = db.collection('projects').document()
-            doc_ref.set({
+            project = {
                 'userId': user_data['uid'],
                 'prompt': prompt,
                 'refined_prompt': refined_prompt,
                 'style': style,
                 'type': gen_type,
-                'image_url': image_url,
+                **image_fields,
                 'createdAt': firestore.SERVER_TIMESTAMP
-            })
-        except Exception as e:
-            print(f"Failed to save project: {e}")
+            }
+            # Now only the spill-file append; the Firestore write itself is in project_flush_duration_seconds
+            with metrics.stage_timer("generate", "firestore_save"):
+                await project_writer.get_writer().submit(doc_ref.id, project)
+            # Modifications of it will find its prompt here without a Firestore read
+            project_cache.get_cache().put(user_data['uid'], doc_ref.id, project)
+            # Thumbnails are rendered in the background and merged into the document
+            derivatives.schedule(doc_ref, outcome.get("image"))
+        except Exception:
+            logger.exception("Failed to save project")
 
         return {
             "status": "success",
+            "projectId": doc_ref.id,
             "image_url": image_url,
             "refined_prompt": refined_prompt,
             "type": gen_type
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"CRITICAL ERROR in generate_character: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Character generation failed")
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
-@router.post("/modify")
-async def modify_character(
-    request: dict = Body(...),
-    user_data: dict = Depends(verify_token)
-):
+async def run_modification(request: dict, user_data: dict):
     """
     Modify an existing character image.
     """
     try:
         project_id = request.get("projectId")
         modification_prompt = request.get("modificationPrompt")
-        print(f"Received modification request: Project='{project_id}', Prompt='{modification_prompt}', User='{user_data['uid']}'")
+        logger.info("Received modification request", extra={
+            "project_id": project_id, "modification_prompt": modification_prompt, "uid": user_data['uid'],
+        })
         
-        db = get_db()
+        db = await get_db_async()
         if not db:
             raise HTTPException(status_code=500, detail="Database unavailable")
             
-        # 1. Get Original Project
-        # In a real app, we would fetch the project to get the original prompt.
-        # For simplicity, we'll assume the frontend passes the context or we just use the modification prompt as the new prompt.
-        # Let's try to fetch if projectId is valid, otherwise rely on prompt.
-        
-        # 2. Check Credits (Modification Logic)
-        user_ref = db.collection('users').document(user_data['uid'])
-        
-        @firestore.transactional
-        def check_and_deduct_mod(transaction, doc_ref):
-            snapshot = doc_ref.get(transaction=transaction)
-            if not snapshot.exists:
-                raise ValueError("User not found")
-            
-            data = snapshot.to_dict()
-            mod_count = data.get("modification_count", 0)
-            credits = data.get("credits", 0)
-            
-            # Logic: 1 Free Modification
-            if mod_count < 1:
-                transaction.update(doc_ref, {"modification_count": firestore.Increment(1)})
-                return "free"
-            
-            # Otherwise, check credits
-            if credits < 1:
-                raise ValueError("Insufficient credits")
-            
-            transaction.update(doc_ref, {
-                "credits": firestore.Increment(-1),
-                "modification_count": firestore.Increment(1)
-            })
-            return "paid"
+        # 1. Get Original Project (usually from the project cache, see services/project_cache.py)
+        context = None
+        if project_id:
+            with metrics.stage_timer("generate", "project_context"):
+                context = await project_cache.get_cache().get(user_data['uid'], project_id)
+            if context is None:
+                raise HTTPException(status_code=404, detail="Project not found")
+        # Modifications of modifications keep composing onto the chain's prompt
+        refined_prompt = project_cache.compose_prompt(context, modification_prompt)
+        style = context['style'] if context else None
 
-        try:
-            transaction = db.transaction()
-            status = check_and_deduct_mod(transaction, user_ref)
-            print(f"Modification status: {status}")
-        except ValueError as e:
-            raise HTTPException(status_code=402, detail="Insufficient credits. You have used your free modification. Please upgrade.")
-        except Exception as e:
-            print(f"Transaction failed: {e}")
-            raise HTTPException(status_code=500, detail="Transaction failed")
+        # 2. Reserve Credits (Modification Logic)
+        reservation = await reserve_credits(
+            user_data['uid'], credit_ledger.MODIFICATION,
+            "Insufficient credits. You have used your free modification. Please upgrade.",
+        )
 
         # 3. Generate Modified Image
-        # We reuse the generation logic. 
-        # Ideally, we would use an image-to-image model, but for now we will do text-to-image with the modified prompt.
-        full_prompt = f"{modification_prompt}. High quality, detailed, 8k."
-        
-        image_url = "https://via.placeholder.com/1024x1024.png?text=Modification+Failed"
-        
+        # Ideally, we would use an image-to-image model, but for now we will do text-to-image with the composed prompt.
+        image_fields = {"image_url": "https://via.placeholder.com/1024x1024.png?text=Modification+Failed"}
+        image = None
+        billable = False
         try:
-            # Try Imagen
-            model = genai.GenerativeModel('imagen-3.0-generate-001')
-            result = model.generate_images(
-                prompt=full_prompt,
-                number_of_images=1,
-            )
-            image_url = result.images[0].url
-        except Exception as e:
-            print(f"Imagen modification failed: {e}")
-            # Fallback: SVG
-            try:
-                svg_model = genai.GenerativeModel('gemini-1.5-pro')
-                svg_prompt = f"Generate a simple, cute SVG code for: {modification_prompt}. Return ONLY the SVG code, no markdown."
-                svg_response = svg_model.generate_content(svg_prompt)
-                svg_content = svg_response.text.replace("```svg", "").replace("```", "").strip()
-                import base64
-                encoded_svg = base64.b64encode(svg_content.encode('utf-8')).decode('utf-8')
-                image_url = f"data:image/svg+xml;base64,{encoded_svg}"
-            except Exception as svg_e:
-                print(f"SVG modification failed: {svg_e}")
-                # Fallback: Unsplash
-                keywords = modification_prompt.split(" ")[0:3]
-                search_term = ",".join(keywords)
-                image_url = f"https://source.unsplash.com/1024x1024/?{search_term},modification"
+            generated = await pipeline.generate_image(refined_prompt, refined_prompt, "modification")
+            logger.info("Modification generated", extra={"tier": generated.tier})
+            metrics.GENERATION_TIER.inc(flow="modify", tier=generated.tier)
+            with metrics.stage_timer("generate", "blob_save"):
+                image_fields = await blob_store.save_generated(generated.image)
+            image = generated.image
+            billable = generated.billable
+        except pipeline.PipelineError as e:
+            logger.error("Modification generation failed", extra={"errors": e.errors})
+            metrics.GENERATION_TIER.inc(flow="modify", tier="failed")
+        finally:
+            await credit_ledger.get_ledger().settle(reservation, billable)
+        image_url = image_fields["image_url"]
 
         # 4. Save Project (New Version)
+        from firebase_admin import firestore
+        doc_ref = db.collection('projects').document()
         try:
-            doc_ref = db.collection('projects').document()
-            doc_ref.set({
+            project = {
                 'userId': user_data['uid'],
                 'prompt': modification_prompt,
+                'refined_prompt': refined_prompt,
+                'style': style,
                 'originalProjectId': project_id,
                 'type': 'modification',
-                'image_url': image_url,
+                **image_fields,
                 'createdAt': firestore.SERVER_TIMESTAMP
-            })
-        except Exception as e:
-            print(f"Failed to save modified project: {e}")
+            }
+            with metrics.stage_timer("generate", "firestore_save"):
+                await project_writer.get_writer().submit(doc_ref.id, project)
+            project_cache.get_cache().put(user_data['uid'], doc_ref.id, project)
+            derivatives.schedule(doc_ref, image)
+        except Exception:
+            logger.exception("Failed to save modified project")
 
         return {
             "status": "success",
+            "projectId": doc_ref.id,
             "image_url": image_url,
-            "prompt": modification_prompt
+            "prompt": modification_prompt,
+            "refined_prompt": refined_prompt
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"CRITICAL ERROR in modify_character: {str(e)}")
+        logger.exception("Modification failed")
         raise HTTPException(status_code=500, detail=f"Modification failed: {str(e)}")
+
+def job_handler(run):
+    """Adapt a generation function for the job queue: its HTTP errors become job errors."""
+    async def handler(payload: dict, user_data: dict):
+        try:
+            return await run(payload, user_data)
+        except HTTPException as e:
+            raise jobs.JobError(str(e.detail), e.status_code)
+    return handler
+
+jobs.register("character", job_handler(run_character_generation))
+jobs.register("modify", job_handler(run_modification))
+
+async def enqueue(kind: str, request: dict, user_data: dict):
+    try:
+        job = await jobs.get_manager().submit(kind, request, user_data)
+    except jobs.QueueFullError:
+        raise HTTPException(status_code=503, detail="Generation queue is full, try again shortly",
+                            headers={"Retry-After": "5"})
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+@router.post("/character")
+async def generate_character(
+    request: dict = Body(...),
+    user_data: dict = Depends(rate_limited("generate", model="imagen"))
+):
+    """
+    Generate a character image. With `"async": true` in the body the work is
+    queued and a job is returned immediately; poll or subscribe for the result.
+    """
+    if request.get("async"):
+        return await enqueue("character", request, user_data)
+    return await run_character_generation(request, user_data)
+
+@router.post("/modify")
+async def modify_character(
+    request: dict = Body(...),
+    user_data: dict = Depends(rate_limited("generate", model="imagen"))
+):
+    """
+    Modify an existing character image. Accepts `"async": true` like /character.
+    """
+    if request.get("async"):
+        return await enqueue("modify", request, user_data)
+    return await run_modification(request, user_data)
+
+@router.post("/batch")
+async def generate_batch(
+    request: dict = Body(...),
+    user_data: dict = Depends(verify_token)
+):
+    """
+    Generate a set of images (storyboard panels, emoticons...) sharing a style.
+    Body: {"prompts": [...], "style": "...", "type": "storyboard"}.
+
+    Credits for the whole set are reserved in one ledger operation, generations
+    run with bounded concurrency, and results are streamed back as NDJSON lines
+    as they finish, followed by a summary line. Items that fall back to a stock
+    photo are refunded. Project documents are written behind the stream in batched writes.
+    """
+    prompts = request.get("prompts")
+    style = request.get("style")
+    gen_type = request.get("type", "storyboard")
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+        raise HTTPException(status_code=400, detail="prompts must be a non-empty list of strings")
+    if len(prompts) > BATCH_MAX_PROMPTS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_PROMPTS} prompts per batch")
+    # Each prompt counts against the user's generate rate limit
+    await rate_limit.enforce(user_data, "generate", model="imagen", cost=len(prompts))
+
+    db = await get_db_async()
+    if not db:
+        raise HTTPException(status_code=500, detail="Database unavailable")
+
+    uid = user_data['uid']
+    reservation = await reserve_credits(
+        uid, credit_ledger.GENERATION,
+        f"Insufficient credits for {len(prompts)} generations. Please upgrade.",
+        count=len(prompts),
+    )
+    logger.info("Received batch generation request", extra={
+        "count": len(prompts), "style": style, "type": gen_type, "uid": uid,
+    })
+
+    async def stream():
+        from firebase_admin import firestore
+
+        batch_id = uuid.uuid4().hex
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        generated_count = 0
+        used = 0
+
+        async def generate_one(index: int, prompt: str):
+            refined_prompt = f"{prompt}, {style} style"
+            async with semaphore:
+                try:
+                    generated = await pipeline.generate_image(refined_prompt, prompt, gen_type)
+                except pipeline.PipelineError as e:
+                    metrics.GENERATION_TIER.inc(flow="batch", tier="failed")
+                    return index, refined_prompt, None, str(e)
+                metrics.GENERATION_TIER.inc(flow="batch", tier=generated.tier)
+                image_fields = await blob_store.save_generated(generated.image)
+                return index, refined_prompt, generated, image_fields
+
+        tasks = [asyncio.create_task(generate_one(i, p)) for i, p in enumerate(prompts)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, refined_prompt, generated, outcome = await next_done
+                if generated is None:
+                    yield json.dumps({"index": index, "status": "failed", "error": outcome}) + "\n"
+                    continue
+                if generated.billable:
+                    used += 1
+                doc_ref = db.collection('projects').document()
+                try:
+                    project = {
+                        'userId': uid,
+                        'prompt': prompts[index],
+                        'refined_prompt': refined_prompt,
+                        'style': style,
+                        'type': gen_type,
+                        'batchId': batch_id,
+                        'batchIndex': index,
+                        **outcome,
+                        'createdAt': firestore.SERVER_TIMESTAMP
+                    }
+                    with metrics.stage_timer("generate", "firestore_save"):
+                        await project_writer.get_writer().submit(doc_ref.id, project)
+                    project_cache.get_cache().put(uid, doc_ref.id, project)
+                    derivatives.schedule(doc_ref, generated.image)
+                except Exception:
+                    logger.exception("Failed to save batch project", extra={"batch_id": batch_id, "index": index})
+                generated_count += 1
+                yield json.dumps({
+                    "index": index,
+                    "status": "success",
+                    "projectId": doc_ref.id,
+                    "image_url": outcome["image_url"],
+                    "refined_prompt": refined_prompt,
+                    "type": gen_type,
+                }) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            await credit_ledger.get_ledger().settle_units(reservation, used)
+
+        yield json.dumps({"status": "done", "batchId": batch_id, "generated": generated_count, "charged": used}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@router.get("/jobs/stats")
+async def get_job_stats(user_data: dict = Depends(verify_token)):
+    """
+    Queue depth, running jobs and queue wait times for this instance.
+    """
+    return jobs.get_manager().stats()
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, user_data: dict = Depends(verify_token)):
+    """
+    Poll the status of a queued generation job.
+    """
+    job = await jobs.get_manager().get(job_id)
+    if job is None or job.uid != user_data['uid']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@router.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, user_data: dict = Depends(verify_token)):
+    """
+    Server-Sent Events stream of a job's status until it finishes.
+    """
+    manager = jobs.get_manager()
+    job = await manager.get(job_id)
+    if job is None or job.uid != user_data['uid']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        manager.sse_events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
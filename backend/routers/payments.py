@@ -1,13 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Header
 from routers.auth import verify_token
-from config import STRIPE_SECRET_KEY, STRIPE_WEBHOOK_SECRET, get_db
-from firebase_admin import firestore
-import stripe
+from config import STRIPE_WEBHOOK_SECRET, get_stripe_async
+from services import stripe_events
+from services.executor import run_stripe
+import json
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/payments", tags=["payments"])
 
-stripe.api_key = STRIPE_SECRET_KEY
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 
 @router.post("/create-checkout-session")
@@ -16,7 +19,9 @@ async def create_checkout_session(user_data: dict = Depends(verify_token)):
     Create a Stripe Checkout Session for the 'Coffee' product.
     """
     try:
-        checkout_session = stripe.checkout.Session.create(
+        stripe = await get_stripe_async()
+        checkout_session = await run_stripe(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=[
                 {
@@ -49,11 +54,17 @@ async def create_checkout_session(user_data: dict = Depends(verify_token)):
 async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
     """
     Handle Stripe Webhooks to unlock features.
+
+    The event is only verified and recorded here, then acknowledged; the
+    credit grant is applied by a background worker (see
+    services/stripe_events.py). Redeliveries of an event that was already
+    recorded are acknowledged without granting again.
     """
     payload = await request.body()
+    stripe = await get_stripe_async()
     
     try:
-        event = stripe.Webhook.construct_event(
+        stripe.Webhook.construct_event(
             payload, stripe_signature, STRIPE_WEBHOOK_SECRET
         )
     except ValueError as e:
@@ -61,22 +72,14 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
     except stripe.error.SignatureVerificationError as e:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    # Handle the event
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        uid = session.get('client_reference_id')
-        
-        if uid:
-            print(f"Payment successful for user: {uid}")
-            # Update user in Firestore
-            db = get_db()
-            if db:
-                user_ref = db.collection('users').document(uid)
-                user_ref.set({
-                    'isPremium': True,
-                    'credits': firestore.Increment(10) # Bonus credits
-                }, merge=True)
-            else:
-                print("Firestore not initialized, skipping DB update.")
+    # The signature covers the raw payload, so work with it as plain JSON
+    event = json.loads(payload)
+    try:
+        outcome = await stripe_events.get_processor().submit(event)
+    except Exception:
+        # Not recorded, so let Stripe retry the delivery
+        logger.exception("Could not record Stripe event", extra={"event_id": event.get('id')})
+        raise HTTPException(status_code=500, detail="Could not record event")
+    logger.info("Stripe event received", extra={"event_id": event.get('id'), "type": event.get('type'), "outcome": outcome})
 
-    return {"status": "success"}
+    return {"status": "success", "outcome": outcome}
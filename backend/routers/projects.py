@@ -1,33 +1,143 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
 from routers.auth import verify_token
-from config import get_db
-from firebase_admin import firestore
+from config import get_db_async
+from services import project_cache, project_writer
+from services.executor import run_db
+from typing import Optional
+import base64
+import datetime
+import hashlib
+import json
+from types import SimpleNamespace
 
 router = APIRouter(prefix="/projects", tags=["projects"])
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+# Fields a client may ask for with ?fields=; createdAt is always included for the cursor
+PROJECT_FIELDS = {
+    'prompt', 'refined_prompt', 'style', 'type', 'originalProjectId',
+    'image_url', 'image_key', 'image_size', 'image_mime', 'createdAt',
+    'thumbnails', 'raster_url',
+}
+
+def encode_cursor(created_at, doc_id: str) -> str:
+    raw = json.dumps({"t": created_at.isoformat(), "id": doc_id})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(raw["t"]), str(raw["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_fields(fields: Optional[str]):
+    if not fields:
+        return None
+    requested = {f.strip() for f in fields.split(',') if f.strip()}
+    unknown = requested - PROJECT_FIELDS
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return sorted(requested | {'createdAt'})
+
+def page_etag(uid: str, docs, *params) -> str:
+    """Derived from doc ids and update times, so it's computed without serializing the page."""
+    digest = hashlib.sha256(json.dumps([uid, *params]).encode('utf-8'))
+    for doc in docs:
+        digest.update(doc.id.encode('utf-8'))
+        if doc.update_time is not None:
+            digest.update(doc.update_time.isoformat().encode('utf-8'))
+    return f'W/"{digest.hexdigest()[:32]}"'
+
+def with_pending(results, uid: str, after=None):
+    """
+    Merge `uid`'s not-yet-written projects (see services/project_writer.py)
+    into a page, newest first, so a project is listed as soon as /generate/*
+    has responded. `after` is the page's decoded cursor.
+    """
+    pending = project_writer.get_writer().pending_for(uid)
+    if not pending:
+        return results
+    merged = {doc.id: doc for doc in results}
+    for project_id, data in pending:
+        if after is not None and (data.get('createdAt'), project_id) >= after:
+            continue
+        # Its createdAt stands in for the update time in the ETag
+        merged[project_id] = SimpleNamespace(id=project_id, update_time=data.get('createdAt'),
+                                             to_dict=lambda data=data: dict(data))
+    return sorted(merged.values(), key=lambda doc: (doc.to_dict().get('createdAt'), doc.id), reverse=True)
+
 @router.get("/")
-async def get_user_projects(user_data: dict = Depends(verify_token)):
+async def get_user_projects(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    user_data: dict = Depends(verify_token)
+):
     """
-    Fetch all projects for the authenticated user.
+    Fetch the authenticated user's projects, newest first, one page at a time.
+    Pass `nextCursor` from the previous page as `cursor` to continue, and
+    `fields` (comma-separated) to only return some fields.
     """
     try:
-        db = get_db()
+        db = await get_db_async()
         if not db:
             raise HTTPException(status_code=500, detail="Database not initialized")
-            
+
+        field_paths = parse_fields(fields)
         projects_ref = db.collection('projects')
-        query = projects_ref.where('userId', '==', user_data['uid']).order_by('createdAt', direction=firestore.Query.DESCENDING)
-        results = query.stream()
-        
+        query = (
+            projects_ref.where('userId', '==', user_data['uid'])
+            .order_by('createdAt', direction='DESCENDING')
+            .order_by('__name__', direction='DESCENDING')
+        )
+        if field_paths:
+            # The context fields too, for the project cache; trimmed from the response below
+            query = query.select(sorted(set(field_paths) | set(project_cache.CONTEXT_FIELDS)))
+        after = None
+        if cursor:
+            after = decode_cursor(cursor)
+            query = query.start_after({'createdAt': after[0], '__name__': after[1]})
+        # One extra document tells us whether there is another page
+        query = query.limit(limit + 1)
+        results = with_pending(await run_db(lambda: list(query.stream())), user_data['uid'], after)
+
+        has_more = len(results) > limit
+        results = results[:limit]
+
+        etag = page_etag(user_data['uid'], results, cursor, field_paths, limit)
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status_code=304, headers={"ETag": etag})
+
         projects = []
+        contexts = []
+        next_cursor = None
         for doc in results:
             data = doc.to_dict()
+            # Listed projects are what users go on to modify
+            contexts.append({**data, 'id': doc.id})
+            if field_paths:
+                data = {f: data[f] for f in field_paths if f in data}
+            created_at = data.get('createdAt')
             # Convert timestamp to string
-            if 'createdAt' in data and data['createdAt']:
-                data['createdAt'] = data['createdAt'].isoformat()
+            if created_at:
+                data['createdAt'] = created_at.isoformat()
             data['id'] = doc.id
             projects.append(data)
-            
-        return {"projects": projects}
+            if has_more and created_at:
+                next_cursor = encode_cursor(created_at, doc.id)
+        project_cache.get_cache().put_many(user_data['uid'], contexts)
+
+        return JSONResponse(
+            content={"projects": projects, "nextCursor": next_cursor},
+            headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,178 @@
+"""
+Content-addressed cache for /analyze results.
+
+Users re-upload the same reference image constantly, so results are keyed on a
+hash of the decoded pixels (not the file bytes, which change with re-encoding
+and metadata) plus the analysis prompt version. Lookups go to an in-process LRU
+first and then to an optional shared tier that survives restarts and is seen
+by every instance.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+
+from config import (
+    ANALYSIS_CACHE_BACKEND,
+    ANALYSIS_CACHE_DIR,
+    ANALYSIS_CACHE_DISK_ENTRIES,
+    ANALYSIS_CACHE_SIZE,
+    ANALYSIS_CACHE_TTL,
+    require_db,
+)
+from services.cache import TTLCache
+from services.executor import run_db, run_io
+
+logger = logging.getLogger(__name__)
+
+
+def image_key(image, prompt_version: str) -> str:
+    """Hash the normalized pixels of a PIL image. CPU bound - run off the loop."""
+    normalized = image.convert("RGB")
+    digest = hashlib.sha256()
+    digest.update(prompt_version.encode("utf-8"))
+    digest.update(f"{normalized.width}x{normalized.height}".encode("utf-8"))
+    digest.update(normalized.tobytes())
+    return digest.hexdigest()
+
+
+class FirestoreTier:
+    """Shared tier in the `analysis_cache` collection.
+
+    `expiresAt` is a timestamp so a Firestore TTL policy on that field can do
+    the size housekeeping; reads also ignore anything past its expiry.
+    """
+
+    collection = "analysis_cache"
+
+    @property
+    def db(self):
+        return require_db()
+
+    def get(self, key: str):
+        doc = self.db.collection(self.collection).document(key).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expiresAt")
+        if expires_at and expires_at.timestamp() <= time.time():
+            return None
+        return data.get("result")
+
+    def set(self, key: str, result: dict, ttl: float):
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+        self.db.collection(self.collection).document(key).set({
+            "result": result,
+            "expiresAt": expires_at,
+        })
+
+
+class DiskTier:
+    """Shared tier as one JSON file per key, for a single host or a mounted volume."""
+
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expiresAt"] <= time.time():
+            return None
+        return entry["result"]
+
+    def set(self, key: str, result: dict, ttl: float):
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"result": result, "expiresAt": time.time() + ttl}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+        if len(entries) <= self.max_entries:
+            return
+        # Oldest first; expired entries are skipped on read and age out here
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[: len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class AnalysisCache:
+    def __init__(self, shared=None, max_entries: int = ANALYSIS_CACHE_SIZE, ttl: float = ANALYSIS_CACHE_TTL):
+        self.memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.shared = shared
+        self.ttl = ttl
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    async def _run_shared(self, fn, *args):
+        if isinstance(self.shared, FirestoreTier):
+            return await run_db(fn, *args)
+        return await run_io(fn, *args)
+
+    async def get(self, key: str):
+        result = self.memory.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        if self.shared is not None:
+            try:
+                result = await self._run_shared(self.shared.get, key)
+            except Exception as e:
+                logger.warning("Analysis cache shared tier read failed", extra={"error": str(e)})
+                result = None
+            if result is not None:
+                self.shared_hits += 1
+                self.memory.set(key, result)
+                return result
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, result: dict):
+        self.memory.set(key, result)
+        if self.shared is not None:
+            try:
+                await self._run_shared(self.shared.set, key, result, self.ttl)
+            except Exception as e:
+                logger.warning("Analysis cache shared tier write failed", extra={"error": str(e)})
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "memory": self.memory.stats(),
+        }
+
+
+_cache = None
+
+
+def _build_shared_tier():
+    if ANALYSIS_CACHE_BACKEND == "firestore":
+        return FirestoreTier()
+    if ANALYSIS_CACHE_BACKEND == "disk":
+        return DiskTier(ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_DISK_ENTRIES)
+    return None
+
+
+def get_cache() -> AnalysisCache:
+    global _cache
+    if _cache is None:
+        _cache = AnalysisCache(shared=_build_shared_tier())
+    return _cache
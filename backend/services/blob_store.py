@@ -0,0 +1,137 @@
+"""
+Blob storage for generated assets.
+
+Generated bytes (the Gemini SVG fallback today) are written under a
+content-hash key, so identical outputs are stored once, and project documents
+only keep the URL, key, size and mime type instead of an inline data URI.
+
+Production uses Cloud Storage through the Firebase Admin default bucket; local
+development and tests use a directory that main.py serves under /blobs. With
+BLOB_STORE=inline (the default on Cloud Run without a bucket) assets are kept
+in the project document as data URIs, as they were before blob storage.
+"""
+import base64
+import hashlib
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from urllib.parse import quote
+
+from config import BLOB_BASE_URL, BLOB_DIR, BLOB_STORE, ON_CLOUD_RUN, STORAGE_BUCKET
+from services.executor import run_io
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    "image/svg+xml": "svg",
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+}
+
+
+@dataclass
+class BlobRef:
+    key: str
+    url: str
+    size: int
+    mime_type: str
+
+
+def blob_key(data: bytes, mime_type: str, prefix: str = "generated") -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{prefix}/{digest}.{EXTENSIONS.get(mime_type, 'bin')}"
+
+
+class LocalBlobStore:
+    def __init__(self, directory: str = BLOB_DIR, base_url: str = BLOB_BASE_URL):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data: bytes, mime_type: str, prefix: str = "generated") -> BlobRef:
+        key = blob_key(data, mime_type, prefix)
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return BlobRef(key=key, url=f"{self.base_url}/{key}", size=len(data), mime_type=mime_type)
+
+
+class GCSBlobStore:
+    def __init__(self, bucket_name: str = STORAGE_BUCKET):
+        from firebase_admin import storage
+        from config import init_firebase
+
+        init_firebase()
+        self.bucket = storage.bucket(bucket_name or None)
+
+    def _download_url(self, key: str, token: str) -> str:
+        return (
+            f"https://firebasestorage.googleapis.com/v0/b/{self.bucket.name}/o/"
+            f"{quote(key, safe='')}?alt=media&token={token}"
+        )
+
+    def put(self, data: bytes, mime_type: str, prefix: str = "generated") -> BlobRef:
+        from google.api_core.exceptions import PreconditionFailed
+
+        key = blob_key(data, mime_type, prefix)
+        blob = self.bucket.blob(key)
+        token = uuid.uuid4().hex
+        blob.metadata = {"firebaseStorageDownloadTokens": token}
+        blob.cache_control = "public, max-age=31536000, immutable"
+        try:
+            # Generation 0 means "only if it doesn't exist yet" - one round trip either way
+            blob.upload_from_string(data, content_type=mime_type, if_generation_match=0)
+        except PreconditionFailed:
+            blob.reload()
+            token = (blob.metadata or {}).get("firebaseStorageDownloadTokens", "").split(",")[0]
+        return BlobRef(key=key, url=self._download_url(key, token), size=len(data), mime_type=mime_type)
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        if BLOB_STORE == "inline":
+            return None
+        if BLOB_STORE == "local" and ON_CLOUD_RUN:
+            # Clients would get BLOB_BASE_URL links to one instance's in-memory /tmp
+            raise RuntimeError("BLOB_STORE=local does not work on Cloud Run; set FIREBASE_STORAGE_BUCKET")
+        _store = GCSBlobStore() if BLOB_STORE == "gcs" else LocalBlobStore()
+    return _store
+
+
+def inline_fields(image) -> dict:
+    encoded = base64.b64encode(image.data).decode('utf-8')
+    return {"image_url": f"data:{image.mime_type};base64,{encoded}"}
+
+
+async def save_generated(image) -> dict:
+    """
+    Persist a pipeline image and return the project document fields for it.
+    Images that are already hosted elsewhere are referenced by URL only.
+    """
+    if image.data is None:
+        return {"image_url": image.url}
+    if BLOB_STORE == "inline":
+        return inline_fields(image)
+    try:
+        # get_store() builds the GCS client on first use, so it runs on the pool too
+        ref = await run_io(lambda: get_store().put(image.data, image.mime_type))
+    except Exception as e:
+        # Don't lose a paid-for generation over a storage hiccup; inline it instead
+        logger.warning("Blob store write failed, inlining asset", extra={"error": str(e)})
+        return inline_fields(image)
+    return {
+        "image_url": ref.url,
+        "image_key": ref.key,
+        "image_size": ref.size,
+        "image_mime": ref.mime_type,
+    }
@@ -0,0 +1,346 @@
+"""
+Reserve-then-commit credit ledger.
+
+Generations reserve their credits up front, commit them once an image was
+actually produced, and refund them if it wasn't. Reservations for the same user
+are group-committed: while one Firestore transaction on `users/{uid}` is in
+flight, further requests for that user queue up and are all applied by the
+next single transaction. A storyboard batch therefore costs one or two
+transactions instead of N contending ones that retry each other.
+
+Each reservation is recorded in `users/{uid}/credit_ledger/{id}` inside the
+reserving transaction. Commits are buffered and written in batches by a
+background flusher; refunds are written straight away.
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from config import FIRESTORE_MAX_BATCH_WRITES, LEDGER_FLUSH_INTERVAL, require_db
+from services import profile_cache
+from services.executor import run_db
+
+logger = logging.getLogger(__name__)
+
+GENERATION = "generation"
+MODIFICATION = "modification"
+
+COUNTERS = {GENERATION: "generation_count", MODIFICATION: "modification_count"}
+# Each user gets one free generation and one free modification
+FREE_UNITS = {GENERATION: 1, MODIFICATION: 1}
+
+INITIAL_USER = {
+    "credits": 0,
+    "isPremium": False,
+    "generation_count": 0,
+    "modification_count": 0,
+}
+
+RESERVED = "reserved"
+COMMITTED = "committed"
+REFUNDED = "refunded"
+# In memory only, while a refund is being written
+REFUNDING = "refunding"
+
+
+
+class InsufficientCreditsError(ValueError):
+    pass
+
+
+@dataclass
+class Reservation:
+    uid: str
+    kind: str
+    free: int
+    paid: int
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = RESERVED
+
+    @property
+    def count(self) -> int:
+        return self.free + self.paid
+
+    @property
+    def tier(self) -> str:
+        return "paid" if self.paid else "free"
+
+
+def allocate(data, requests):
+    """
+    Apply reservation requests, in order, to a user document.
+
+    `data` is the current document (None if missing) and `requests` a list of
+    `(kind, count)`. Returns `(outcomes, state, created)` where each outcome is
+    either `(free, paid)` or an InsufficientCreditsError, `state` is the
+    document after all granted requests, and `created` says the document has
+    to be created.
+    """
+    exists = data is not None
+    state = dict(INITIAL_USER)
+    state.update(data or {})
+    granted = False
+    outcomes = []
+    for kind, count in requests:
+        if not exists and kind == MODIFICATION:
+            outcomes.append(InsufficientCreditsError("User not found"))
+            continue
+        counter = COUNTERS[kind]
+        free = max(0, min(count, FREE_UNITS[kind] - state.get(counter, 0)))
+        paid = count - free
+        if paid > state.get("credits", 0):
+            outcomes.append(InsufficientCreditsError("Insufficient credits"))
+            continue
+        state["credits"] = state.get("credits", 0) - paid
+        state[counter] = state.get(counter, 0) + count
+        outcomes.append((free, paid))
+        granted = True
+        exists = True
+    return outcomes, state, granted and data is None
+
+
+class FirestoreCreditStore:
+    @property
+    def db(self):
+        return require_db()
+
+    def _user_ref(self, uid: str):
+        return self.db.collection('users').document(uid)
+
+    def reserve_batch(self, uid: str, requests):
+        """Grant a list of `(kind, count)` requests in one transaction; returns Reservations/errors."""
+        from firebase_admin import firestore
+
+        user_ref = self._user_ref(uid)
+
+        @firestore.transactional
+        def apply(transaction):
+            snapshot = user_ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else None
+            outcomes, state, created = allocate(data, requests)
+
+            results = []
+            for (kind, _), outcome in zip(requests, outcomes):
+                if isinstance(outcome, Exception):
+                    results.append(outcome)
+                    continue
+                reservation = Reservation(uid=uid, kind=kind, free=outcome[0], paid=outcome[1])
+                transaction.set(user_ref.collection('credit_ledger').document(reservation.id), {
+                    'kind': kind,
+                    'free': reservation.free,
+                    'paid': reservation.paid,
+                    'status': RESERVED,
+                    'createdAt': firestore.SERVER_TIMESTAMP,
+                })
+                results.append(reservation)
+
+            if created:
+                transaction.set(user_ref, state)
+            elif any(isinstance(r, Reservation) for r in results):
+                transaction.update(user_ref, {
+                    key: state[key] for key in ("credits", *COUNTERS.values())
+                })
+            return results
+
+        return apply(self.db.transaction())
+
+    def refund(self, reservation: Reservation, free: int, paid: int, status: str):
+        from firebase_admin import firestore
+
+        batch = self.db.batch()
+        batch.update(self._user_ref(reservation.uid), {
+            'credits': firestore.Increment(paid),
+            COUNTERS[reservation.kind]: firestore.Increment(-(free + paid)),
+        })
+        batch.set(self._ledger_ref(reservation), {
+            'status': status,
+            'refunded': free + paid,
+        }, merge=True)
+        batch.commit()
+
+    def _ledger_ref(self, reservation: Reservation):
+        return self._user_ref(reservation.uid).collection('credit_ledger').document(reservation.id)
+
+    def record_commits(self, reservations):
+        for start in range(0, len(reservations), FIRESTORE_MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for reservation in reservations[start:start + FIRESTORE_MAX_BATCH_WRITES]:
+                batch.set(self._ledger_ref(reservation), {'status': COMMITTED}, merge=True)
+            batch.commit()
+
+
+class InMemoryCreditStore:
+    """Same interface as FirestoreCreditStore, for tests and offline benchmarks."""
+
+    def __init__(self, users: dict = None, latency: float = 0.0):
+        self.users = users if users is not None else {}
+        self.ledger = {}
+        self.latency = latency
+        self.transactions = 0
+        self._lock = threading.Lock()
+
+    def reserve_batch(self, uid: str, requests):
+        # Round trip outside the lock: other users' transactions don't wait on it
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.transactions += 1
+            outcomes, state, created = allocate(self.users.get(uid), requests)
+            results = []
+            for (kind, _), outcome in zip(requests, outcomes):
+                if isinstance(outcome, Exception):
+                    results.append(outcome)
+                    continue
+                reservation = Reservation(uid=uid, kind=kind, free=outcome[0], paid=outcome[1])
+                self.ledger[reservation.id] = RESERVED
+                results.append(reservation)
+            if uid in self.users or created:
+                self.users[uid] = state
+            return results
+
+    def refund(self, reservation: Reservation, free: int, paid: int, status: str):
+        with self._lock:
+            user = self.users[reservation.uid]
+            user["credits"] += paid
+            user[COUNTERS[reservation.kind]] -= free + paid
+            self.ledger[reservation.id] = status
+
+    def record_commits(self, reservations):
+        with self._lock:
+            for reservation in reservations:
+                self.ledger[reservation.id] = COMMITTED
+
+
+class CreditLedger:
+    def __init__(self, store, flush_interval: float = LEDGER_FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._active = set()
+        self._commits = []
+        self._flusher = None
+
+    async def reserve(self, uid: str, kind: str, count: int = 1) -> Reservation:
+        """Reserve `count` units; raises InsufficientCreditsError if the user can't pay."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(uid, []).append((kind, count, future))
+        if uid not in self._active:
+            self._active.add(uid)
+            asyncio.create_task(self._drain(uid))
+        return await future
+
+    async def _drain(self, uid: str):
+        try:
+            while self._pending.get(uid):
+                batch = self._pending.pop(uid)
+                try:
+                    results = await run_db(self.store.reserve_batch, uid, [(kind, count) for kind, count, _ in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+                abandoned = []
+                for (_, _, future), result in zip(batch, results):
+                    if future.done():
+                        # The caller was cancelled while the transaction ran: nobody
+                        # will settle what it was granted
+                        if isinstance(result, Reservation):
+                            abandoned.append(result)
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                await profile_cache.get_cache().invalidate(uid)
+                for reservation in abandoned:
+                    await self._refund_abandoned(reservation)
+        finally:
+            self._active.discard(uid)
+
+    async def _refund_abandoned(self, reservation: Reservation):
+        try:
+            await self.refund(reservation)
+        except Exception as e:
+            logger.error("Could not refund a reservation whose caller was cancelled",
+                         extra={"uid": reservation.uid, "reservation_id": reservation.id, "error": str(e)})
+        else:
+            logger.info("Refunded a reservation whose caller was cancelled",
+                        extra={"uid": reservation.uid, "reservation_id": reservation.id})
+
+    async def commit(self, reservation: Reservation):
+        if reservation.status != RESERVED:
+            return
+        reservation.status = COMMITTED
+        self._commits.append(reservation)
+        if len(self._commits) >= FIRESTORE_MAX_BATCH_WRITES:
+            await self.flush()
+
+    async def refund(self, reservation: Reservation, units: int = None):
+        """Give back `units` of the reservation (all of it by default), paid units first."""
+        if reservation.status != RESERVED:
+            return
+        units = reservation.count if units is None else units
+        paid = min(units, reservation.paid)
+        free = units - paid
+        # A partial refund still commits the units that were used
+        status = REFUNDED if units == reservation.count else COMMITTED
+        reservation.status = REFUNDING
+        try:
+            await run_db(self.store.refund, reservation, free, paid, status)
+        except Exception:
+            # Nothing was given back; the reservation can still be settled. (If
+            # we're cancelled instead, the write may still land: stay REFUNDING.)
+            reservation.status = RESERVED
+            raise
+        reservation.status = status
+        await profile_cache.get_cache().invalidate(reservation.uid)
+
+    async def settle(self, reservation: Reservation, success: bool):
+        await self.settle_units(reservation, reservation.count if success else 0)
+
+    async def settle_units(self, reservation: Reservation, used: int):
+        """Commit the `used` units of a multi-unit reservation and refund the rest."""
+        if used >= reservation.count:
+            await self.commit(reservation)
+        else:
+            await self.refund(reservation, reservation.count - used)
+
+    async def flush(self):
+        commits, self._commits = self._commits, []
+        if not commits:
+            return
+        try:
+            await run_db(self.store.record_commits, commits)
+        except Exception as e:
+            logger.warning("Failed to record ledger commits, will retry", extra={"count": len(commits), "error": str(e)})
+            self._commits[:0] = commits
+
+    def stats(self) -> dict:
+        return {"pending_commits": len(self._commits), "reserving_users": len(self._active)}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+
+_ledger = None
+
+
+def get_ledger() -> CreditLedger:
+    global _ledger
+    if _ledger is None:
+        _ledger = CreditLedger(FirestoreCreditStore())
+    return _ledger
@@ -0,0 +1,155 @@
+"""
+Derivative rendering for generated assets.
+
+Listing pages used to load every project's full 1024x1024 image (or its
+inline SVG). After a generation is saved, a background task now renders WebP
+thumbnails at THUMBNAIL_SIZES, stores them in the blob store next to the
+original and merges them into the project document:
+
+    thumbnails: [{"width": 256, "url": ..., "key": ..., "size": ...}, ...]
+
+SVG fallbacks are rasterized to a RASTER_SIZE PNG first (also stored, as
+`raster_url`, for downloads) with cairosvg, which needs the system cairo
+library (installed in the Dockerfile); where either is missing, SVGs get no
+derivatives. Images that are only hosted
+elsewhere are fetched once. Results are memoized by source, so cached
+generations and repeated outputs are not re-encoded.
+
+None of this is on the request path: failures are logged and the project
+simply keeps using `image_url`.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+
+from config import (
+    BLOB_STORE,
+    DERIVATIVES_ENABLED,
+    MAX_UPLOAD_BYTES,
+    MAX_UPLOAD_PIXELS,
+    RASTER_SIZE,
+    THUMBNAIL_QUALITY,
+    THUMBNAIL_SIZES,
+)
+from services import blob_store, project_writer
+from services.cache import TTLCache
+from services.executor import run_image, run_io
+from services.ingest import load_pillow
+
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = 15
+
+_rendered = TTLCache(max_entries=1024, ttl=24 * 3600)
+_tasks = set()
+
+
+def source_key(image) -> str:
+    if image.data is not None:
+        return hashlib.sha256(image.data).hexdigest()
+    return hashlib.sha256(image.url.encode("utf-8")).hexdigest()
+
+
+def fetch_image(url: str, max_bytes: int = MAX_UPLOAD_BYTES):
+    """Blocking: download a hosted image, up to `max_bytes`. Returns (data, mime_type)."""
+    import requests
+
+    with requests.get(url, timeout=FETCH_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        chunks, total = [], 0
+        for chunk in response.iter_content(64 * 1024):
+            total += len(chunk)
+            if total > max_bytes:
+                raise ValueError(f"Image at {url} is larger than {max_bytes} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks), response.headers.get("Content-Type", "").split(";")[0]
+
+
+def rasterize_svg(data: bytes, width: int = RASTER_SIZE):
+    """PNG bytes for an SVG, or None if cairosvg or libcairo isn't installed."""
+    try:
+        import cairosvg
+    except (ImportError, OSError) as e:
+        # cairocffi raises OSError when it can't load libcairo
+        logger.warning("Cannot rasterize SVG", extra={"error": str(e)})
+        return None
+    # unsafe=False (the default) keeps external references and entities disabled
+    return cairosvg.svg2png(bytestring=data, output_width=width)
+
+
+def make_thumbnails(data: bytes, sizes=THUMBNAIL_SIZES, quality: int = THUMBNAIL_QUALITY):
+    """Blocking: WebP thumbnails of a raster image, as a list of (width, bytes)."""
+    Image, _, _ = load_pillow()
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > MAX_UPLOAD_PIXELS:
+        raise ValueError("Image too large to thumbnail")
+    image.draft("RGB", (max(sizes), max(sizes)))
+    image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+    thumbnails = []
+    # Largest first, each one shrunk from the previous, which is cheaper than from the original
+    for width in sorted(sizes, reverse=True):
+        if width < image.width:
+            image.thumbnail((width, width), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, "WEBP", quality=quality, method=4)
+        thumbnails.append((width, out.getvalue()))
+    return sorted(thumbnails)
+
+
+async def render(image) -> dict:
+    """Project document fields for a pipeline image's derivatives ({} if there are none)."""
+    key = source_key(image)
+    fields = _rendered.get(key)
+    if fields is not None:
+        return fields
+
+    data, mime_type = image.data, image.mime_type
+    if data is None:
+        data, mime_type = await run_io(fetch_image, image.url)
+
+    store = await run_io(blob_store.get_store)
+    fields = {}
+    if mime_type == "image/svg+xml":
+        data = await run_image(rasterize_svg, data)
+        if data is None:
+            _rendered.set(key, fields)
+            return fields
+        raster = await run_io(store.put, data, "image/png", "raster")
+        fields["raster_url"] = raster.url
+
+    thumbnails = []
+    for width, thumbnail in await run_image(make_thumbnails, data):
+        ref = await run_io(store.put, thumbnail, "image/webp", f"thumbnails/{width}")
+        thumbnails.append({"width": width, "url": ref.url, "key": ref.key, "size": ref.size})
+    fields["thumbnails"] = thumbnails
+    _rendered.set(key, fields)
+    return fields
+
+
+async def attach(doc_ref, image):
+    try:
+        fields = await render(image)
+        if fields:
+            # Through the writer, which writes in submit order, so this never
+            # lands before (or without) the project document itself
+            await project_writer.get_writer().submit(doc_ref.id, fields)
+    except Exception as e:
+        logger.warning("Could not render derivatives", extra={"project_id": doc_ref.id, "error": str(e)})
+
+
+def schedule(doc_ref, image):
+    """Render and attach derivatives for a saved project in the background."""
+    # Without a blob store there is nowhere to put them
+    if not DERIVATIVES_ENABLED or BLOB_STORE == "inline" or image is None:
+        return
+    task = asyncio.create_task(attach(doc_ref, image))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def drain(timeout: float = 10):
+    """Give in-flight renders a chance to finish (on shutdown)."""
+    if _tasks:
+        await asyncio.wait(set(_tasks), timeout=timeout)
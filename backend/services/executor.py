@@ -0,0 +1,98 @@
+"""
+Shared execution layer for the blocking SDK clients.
+
+google-generativeai, firebase-admin and stripe are all synchronous, so calling
+them directly from an ``async def`` handler stalls the whole event loop. Every
+router goes through the helpers below instead, which run the call on a bounded
+thread pool dedicated to that backend. Keeping the pools separate means a burst
+of slow Imagen calls can never starve Firestore reads or Stripe checkouts.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from config import (
+    AUTH_POOL_SIZE,
+    FIRESTORE_POOL_SIZE,
+    IMAGE_POOL_SIZE,
+    IO_POOL_SIZE,
+    MODEL_POOL_SIZE,
+    STRIPE_POOL_SIZE,
+)
+
+POOL_SIZES = {
+    "model": MODEL_POOL_SIZE,
+    "firestore": FIRESTORE_POOL_SIZE,
+    "stripe": STRIPE_POOL_SIZE,
+    "auth": AUTH_POOL_SIZE,
+    "io": IO_POOL_SIZE,
+    "image": IMAGE_POOL_SIZE,
+}
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_pool(name: str) -> ThreadPoolExecutor:
+    pool = _pools.get(name)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = ThreadPoolExecutor(
+                    max_workers=POOL_SIZES[name],
+                    thread_name_prefix=f"{name}-pool",
+                )
+                _pools[name] = pool
+    return pool
+
+
+async def run_in_pool(name: str, fn, *args, **kwargs):
+    """Run a blocking callable on the named pool and await its result."""
+    loop = asyncio.get_running_loop()
+    # Carry context variables (the request id for logging) over to the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_pool(name), functools.partial(context.run, fn, *args, **kwargs))
+
+
+def submit_to_pool(name: str, fn, *args, **kwargs) -> Future:
+    """
+    Like run_in_pool, but returns the pool's own Future, whose callbacks fire
+    when the thread is actually done (awaiting callers may give up earlier).
+    """
+    context = contextvars.copy_context()
+    return get_pool(name).submit(context.run, fn, *args, **kwargs)
+
+
+async def run_model(fn, *args, **kwargs):
+    return await run_in_pool("model", fn, *args, **kwargs)
+
+
+async def run_db(fn, *args, **kwargs):
+    return await run_in_pool("firestore", fn, *args, **kwargs)
+
+
+async def run_stripe(fn, *args, **kwargs):
+    return await run_in_pool("stripe", fn, *args, **kwargs)
+
+
+async def run_auth(fn, *args, **kwargs):
+    return await run_in_pool("auth", fn, *args, **kwargs)
+
+
+async def run_io(fn, *args, **kwargs):
+    return await run_in_pool("io", fn, *args, **kwargs)
+
+
+async def run_image(fn, *args, **kwargs):
+    return await run_in_pool("image", fn, *args, **kwargs)
+
+
+def shutdown(wait: bool = False):
+    with _lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=wait, cancel_futures=True)
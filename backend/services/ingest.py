@@ -0,0 +1,128 @@
+"""
+Bounded ingestion of uploaded reference images.
+
+Request bodies on the upload routes are capped by UploadLimitMiddleware
+before Starlette's multipart parser spools them: a Content-Length over the
+limit is refused with a 413 before anything is read, and a body sent without
+one is cut off as soon as it passes the limit. On Cloud Run the spool's disk
+is memory too, so nothing larger than the limit is ever held. The spooled
+file is then decoded in place. Decoding only reads the header before checking
+the pixel count, then lets Pillow's draft mode decode JPEGs at a reduced
+scale, so a 20 MB phone photo never becomes a full-size bitmap. Other formats
+(PNG) have no reduced decode: the full bitmap is the floor, and shrinking it
+adds only a small intermediate on top (see bench/ingest.py). The result is an
+RGB image no larger than the model needs, with EXIF and other metadata dropped.
+"""
+import os
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from config import ANALYSIS_MAX_SIDE, MAX_UPLOAD_BYTES, MAX_UPLOAD_PIXELS
+
+# Routes whose bodies are capped, and the room left for the multipart
+# boundaries and part headers around the file itself
+UPLOAD_PATHS = ("/analyze",)
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def _too_large(max_bytes: int) -> str:
+    return f"Image too large (max {max_bytes // (1024 * 1024)} MB)"
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that caps request bodies on UPLOAD_PATHS at
+    MAX_UPLOAD_BYTES (plus multipart overhead), answering 413 otherwise.
+    """
+
+    def __init__(self, app, paths=UPLOAD_PATHS, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.paths = tuple(paths)
+        self.max_bytes = max_bytes
+        self.max_body = max_bytes + MULTIPART_OVERHEAD_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                if value.isdigit() and int(value) > self.max_body:
+                    response = JSONResponse({"detail": _too_large(self.max_bytes)}, status_code=413)
+                    await response(scope, receive, send)
+                    return
+                break
+
+        received = 0
+
+        async def receive_wrapper():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    # FastAPI passes an HTTPException raised while reading the body through as is
+                    raise HTTPException(status_code=413, detail=_too_large(self.max_bytes))
+            return message
+
+        await self.app(scope, receive_wrapper, send)
+
+
+def open_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES):
+    """The upload's spooled file, rewound for decoding, once it is known to be within the size limit."""
+    size = file.size
+    if size is None:
+        size = file.file.seek(0, os.SEEK_END)
+    if size > max_bytes:
+        raise HTTPException(status_code=413, detail=_too_large(max_bytes))
+    file.file.seek(0)
+    return file.file
+
+
+def load_pillow():
+    """Import Pillow. Deferred so instances that never analyze an image don't pay for it."""
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    return Image, ImageOps, UnidentifiedImageError
+
+
+def prepare_image(fp, max_side: int = ANALYSIS_MAX_SIDE, max_pixels: int = MAX_UPLOAD_PIXELS):
+    """Decode an image at bounded resolution. Blocking - run on the image pool."""
+    Image, ImageOps, UnidentifiedImageError = load_pillow()
+    try:
+        image = Image.open(fp)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=400, detail=f"Unsupported image: {e}")
+
+    # Only the header has been read at this point
+    width, height = image.size
+    if width * height > max_pixels:
+        raise HTTPException(status_code=413, detail="Image dimensions too large")
+
+    # JPEG decodes at 1/2, 1/4 or 1/8 scale directly; a no-op for other formats.
+    # Ask for the final thumbnail box so the largest usable reduction is picked.
+    ratio = min(1.0, max_side / max(width, height))
+    image.draft("RGB", (max(1, int(width * ratio)), max(1, int(height * ratio))))
+    try:
+        # reducing_gap=1.0: box-reduce by the largest whole factor first, so a
+        # full-size PNG bitmap isn't joined by a half-size copy (the default)
+        # or a full-height LANCZOS pass
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=1.0)
+        # Rotate after shrinking; exif_transpose otherwise copies the full bitmap
+        ImageOps.exif_transpose(image, in_place=True)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode image: {e}")
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    # Drop EXIF, ICC profiles, text chunks etc. before anything leaves the server
+    image.info = {}
+    return image
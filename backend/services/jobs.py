@@ -0,0 +1,393 @@
+"""
+Asynchronous job queue for long-running generation work.
+
+Endpoints submit a job and return its id straight away; a fixed pool of worker
+tasks pulls jobs off the queue and runs the registered handler for the job's
+kind. Clients poll the job or subscribe to its Server-Sent Events stream.
+
+A job runs on the instance that accepted it. The queue backend is pluggable:
+InMemoryJobBackend keeps job status in this process too, which only works
+with a single instance (and in the tests). SharedJobBackend also writes every
+status change to a JobStore (Firestore's `jobs` collection in production),
+so a poll or SSE subscription that lands on another instance still finds the
+job; there, subscribers re-read it every JOB_POLL_INTERVAL seconds. Set a
+Firestore TTL policy on `jobs.expiresAt` to have finished jobs cleaned up.
+
+Jobs that are queued or running when an instance shuts down are not handed
+over: `stop` marks them failed (503), in the store as well, so clients and
+subscribers hear about it and can resubmit, and logs them. On Cloud Run the
+workers run after the 202 has gone out, so the service needs CPU allocated
+outside requests (`--no-cpu-throttling`).
+"""
+import asyncio
+import datetime
+import json
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from config import (
+    GENERATION_WORKERS,
+    JOB_BACKEND,
+    JOB_POLL_INTERVAL,
+    JOB_QUEUE_MAX,
+    JOB_RESULT_TTL,
+    require_db,
+)
+from services.cache import TTLCache
+from services.executor import run_db
+from services.logs import request_id_var
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED_STATES = (SUCCEEDED, FAILED)
+
+
+@dataclass
+class Job:
+    kind: str
+    payload: dict
+    user_data: dict
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    result: dict = None
+    error: str = None
+    status_code: int = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    # Id of the request that submitted the job, so its logs can be correlated
+    request_id: str = field(default_factory=request_id_var.get)
+
+    @property
+    def uid(self) -> str:
+        return self.user_data["uid"]
+
+    def to_dict(self) -> dict:
+        return {
+            "jobId": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "statusCode": self.status_code,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+    def to_record(self, ttl: float) -> dict:
+        """The job as stored in a JobStore; it expires `ttl` seconds from now."""
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=ttl)
+        return {**self.to_dict(), "uid": self.uid, "requestId": self.request_id, "expiresAt": expires_at}
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Job":
+        """A job read back from a JobStore. Only its status is kept, not its payload."""
+        return cls(
+            kind=record["kind"],
+            payload={},
+            user_data={"uid": record["uid"]},
+            id=record["jobId"],
+            status=record["status"],
+            result=record.get("result"),
+            error=record.get("error"),
+            status_code=record.get("statusCode"),
+            created_at=record["createdAt"],
+            started_at=record.get("startedAt"),
+            finished_at=record.get("finishedAt"),
+            request_id=record.get("requestId"),
+        )
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobError(Exception):
+    """Raised by a handler for an expected failure; `status_code` is reported with the job."""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class InMemoryJobBackend:
+    def __init__(self, max_queued: int = JOB_QUEUE_MAX, result_ttl: float = JOB_RESULT_TTL):
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.result_ttl = result_ttl
+        self.jobs = TTLCache(max_entries=max(10000, max_queued * 2), ttl=result_ttl)
+
+    async def put(self, job: Job):
+        try:
+            self.queue.put_nowait(job.id)
+        except asyncio.QueueFull:
+            raise QueueFullError()
+        self.jobs.set(job.id, job)
+
+    async def take(self) -> Job:
+        while True:
+            job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return job
+
+    async def load(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    async def save(self, job: Job):
+        self.jobs.set(job.id, job)
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def drain(self):
+        """Take every job that is still queued."""
+        jobs = []
+        while not self.queue.empty():
+            job = self.jobs.get(self.queue.get_nowait())
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+
+class FirestoreJobStore:
+    """Job records in the `jobs` collection. Blocking; called on the Firestore pool."""
+
+    collection = "jobs"
+
+    @property
+    def db(self):
+        return require_db()
+
+    def write(self, record: dict):
+        self.db.collection(self.collection).document(record["jobId"]).set(record)
+
+    def read(self, job_id: str):
+        doc = self.db.collection(self.collection).document(job_id).get()
+        return doc.to_dict() if doc.exists else None
+
+
+class InMemoryJobStore:
+    """A JobStore for tests: share one between backends to stand in for several instances."""
+
+    def __init__(self):
+        self.records = {}
+
+    def write(self, record: dict):
+        self.records[record["jobId"]] = dict(record)
+
+    def read(self, job_id: str):
+        record = self.records.get(job_id)
+        return dict(record) if record is not None else None
+
+
+class SharedJobBackend(InMemoryJobBackend):
+    """
+    Runs this instance's jobs from its own queue, like InMemoryJobBackend, and
+    writes every status change to `store` so other instances can read it.
+    """
+
+    def __init__(self, store, max_queued: int = JOB_QUEUE_MAX, result_ttl: float = JOB_RESULT_TTL):
+        super().__init__(max_queued, result_ttl)
+        self.store = store
+
+    async def put(self, job: Job):
+        if self.queue.full():
+            raise QueueFullError()
+        # Recorded before it is queued, so a poll right after the 202 finds it
+        await run_db(self.store.write, job.to_record(self.result_ttl))
+        try:
+            await super().put(job)
+        except QueueFullError:
+            job.status, job.error, job.status_code = FAILED, "Generation queue is full", 503
+            await self.save(job)
+            raise
+
+    async def load(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        record = await run_db(self.store.read, job_id)
+        if record is None or record["expiresAt"] <= datetime.datetime.now(datetime.timezone.utc):
+            return None
+        return Job.from_record(record)
+
+    async def save(self, job: Job):
+        await super().save(job)
+        try:
+            await run_db(self.store.write, job.to_record(self.result_ttl))
+        except Exception as e:
+            # Pollers on this instance still see it; elsewhere it looks stuck until the next save
+            logger.warning("Could not save job status", extra={"job_id": job.id, "status": job.status, "error": str(e)})
+
+
+class JobManager:
+    def __init__(self, backend=None, concurrency: int = GENERATION_WORKERS, handlers: dict = None,
+                 poll_interval: float = JOB_POLL_INTERVAL):
+        self.backend = backend or InMemoryJobBackend()
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.handlers = dict(handlers or {})
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._workers = []
+        self._subscribers = {}
+
+    def register(self, kind: str, handler):
+        """`handler(payload, user_data)` is a coroutine returning the job result."""
+        self.handlers[kind] = handler
+
+    async def submit(self, kind: str, payload: dict, user_data: dict) -> Job:
+        """Queue a job; raises QueueFullError if the backend is at capacity."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = Job(kind=kind, payload=payload, user_data=user_data)
+        await self.backend.put(job)
+        return job
+
+    async def get(self, job_id: str):
+        return await self.backend.load(job_id)
+
+    async def start(self):
+        if self._workers:
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        # Running jobs are marked dropped by _run as they are cancelled
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        queued = self.backend.drain()
+        for job in queued:
+            self._mark_dropped(job)
+            job.finished_at = time.time()
+            await self.backend.save(job)
+            self._publish(job)
+        if self.dropped:
+            logger.warning("Jobs dropped at shutdown", extra={"count": self.dropped, "queued": len(queued)})
+
+    def _mark_dropped(self, job: Job):
+        job.status, job.error, job.status_code = FAILED, "Server shut down before the job finished", 503
+        self.dropped += 1
+        logger.warning("Job dropped at shutdown", extra={"job_id": job.id, "kind": job.kind, "uid": job.uid})
+
+    async def _worker(self):
+        while True:
+            job = await self.backend.take()
+            await self._run(job)
+
+    async def _run(self, job: Job):
+        job.started_at = time.time()
+        wait = job.started_at - job.created_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        job.status = RUNNING
+        await self.backend.save(job)
+        self._publish(job)
+
+        self.running += 1
+        token = request_id_var.set(job.request_id)
+        try:
+            job.result = await self.handlers[job.kind](job.payload, job.user_data)
+            job.status = SUCCEEDED
+            self.completed += 1
+        except JobError as e:
+            job.status, job.error, job.status_code = FAILED, str(e), e.status_code
+            self.failed += 1
+        except asyncio.CancelledError:
+            # stop() at shutdown: the job dies with this instance
+            self._mark_dropped(job)
+            raise
+        except Exception as e:
+            logger.exception("Job failed", extra={"job_id": job.id, "kind": job.kind})
+            job.status, job.error, job.status_code = FAILED, str(e), 500
+            self.failed += 1
+        finally:
+            request_id_var.reset(token)
+            self.running -= 1
+            job.finished_at = time.time()
+            await self.backend.save(job)
+            self._publish(job)
+
+    def _publish(self, job: Job):
+        for queue in self._subscribers.get(job.id, ()):
+            queue.put_nowait(job.to_dict())
+
+    async def events(self, job_id: str):
+        """
+        Yield the job's state now and after every change until it finishes.
+        Changes made here are published straight away; for a job another
+        instance runs, the backend is re-read every `poll_interval`.
+        """
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, []).append(queue)
+        try:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            state = job.to_dict()
+            while True:
+                yield state
+                if state["status"] in FINISHED_STATES:
+                    return
+                previous = state
+                while state == previous:
+                    try:
+                        state = await asyncio.wait_for(queue.get(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        job = await self.get(job_id)
+                        if job is None:
+                            return
+                        state = job.to_dict()
+        finally:
+            subscribers = self._subscribers.get(job_id, [])
+            subscribers.remove(queue)
+            if not subscribers:
+                self._subscribers.pop(job_id, None)
+
+    async def sse_events(self, job_id: str):
+        async for state in self.events(job_id):
+            yield f"event: {state['status']}\ndata: {json.dumps(state)}\n\n"
+
+    def stats(self) -> dict:
+        started = self.completed + self.failed + self.running
+        return {
+            "queue_depth": self.backend.depth(),
+            "running": self.running,
+            "workers": self.concurrency,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "avg_wait_seconds": self.total_wait / started if started else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
+
+
+_manager = None
+_handlers = {}
+
+
+def register(kind: str, handler):
+    _handlers[kind] = handler
+    if _manager is not None:
+        _manager.register(kind, handler)
+
+
+def get_manager() -> JobManager:
+    global _manager
+    if _manager is None:
+        backend = SharedJobBackend(FirestoreJobStore()) if JOB_BACKEND == "firestore" else InMemoryJobBackend()
+        _manager = JobManager(backend=backend, handlers=_handlers)
+    return _manager
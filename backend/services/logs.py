@@ -0,0 +1,216 @@
+"""
+Structured, non-blocking logging.
+
+`setup_logging()` installs a QueueHandler on the root logger, so a log call on
+the request path only builds the record and puts it on an in-process queue; a
+QueueListener thread does the JSON formatting, redaction and the actual write
+to stdout. Lines use Cloud Logging's field names (`severity`, `message`), so
+Cloud Run picks up levels and extra fields without any agent.
+
+Every record carries the current request id (see RequestIdMiddleware), which
+is also propagated to job workers and executor threads, so one generate or
+analyze request can be followed across the pipeline.
+
+INFO and DEBUG records are sampled per request at LOG_SAMPLE_RATE: either all
+of a request's info logs are kept or none are. Warnings and errors are always
+kept. Fields such as prompts and tokens are redacted before they are written.
+
+Usage:
+    logger = logging.getLogger(__name__)
+    logger.info("Image generated", extra={"tier": "svg", "prompt": prompt})
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+import zlib
+
+from config import LOG_FORMAT, LOG_LEVEL, LOG_REDACT, LOG_SAMPLE_RATE
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Extra fields whose values never reach the log output
+REDACTED_FIELDS = {
+    "prompt", "refined_prompt", "modification_prompt", "prompts", "description",
+    "token", "id_token", "authorization", "signature", "stripe_signature",
+}
+# Bearer tokens and JWTs that end up inside a message string (e.g. an exception text)
+TOKEN_PATTERN = re.compile(r"(Bearer\s+)?eyJ[\w-]+\.[\w-]+\.[\w-]+")
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+
+
+def redact_value(value):
+    if value is None:
+        return None
+    return f"<redacted {len(value) if hasattr(value, '__len__') else 1}>"
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a `rate` fraction of INFO/DEBUG records, decided per request id."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        request_id = getattr(record, "request_id", None)
+        if request_id is None:
+            return random.random() < self.rate
+        return zlib.crc32(request_id.encode()) % 10000 < self.rate * 10000
+
+
+class RedactionFilter(logging.Filter):
+    _formatter = logging.Formatter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self._formatter.formatException(record.exc_info)
+        for key, value in _extra_fields(record).items():
+            if key in REDACTED_FIELDS:
+                setattr(record, key, redact_value(value))
+            elif isinstance(value, str) and "eyJ" in value:
+                setattr(record, key, TOKEN_PATTERN.sub("<redacted token>", value))
+        if "eyJ" in record.msg:
+            record.msg = TOKEN_PATTERN.sub("<redacted token>", record.msg)
+        if record.exc_text and "eyJ" in record.exc_text:
+            record.exc_text = TOKEN_PATTERN.sub("<redacted token>", record.exc_text)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "logger": record.name,
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        entry.update(_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable output for local development (LOG_FORMAT=text)."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = _extra_fields(record)
+        return f"{line} {json.dumps(extra, default=str, ensure_ascii=False)}" if extra else line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message now (its args may change later) but leave
+        # formatting, including tracebacks, to the listener thread. The queue
+        # is in-process, so exc_info can travel as is.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT,
+                  sample_rate: float = LOG_SAMPLE_RATE, redact: bool = LOG_REDACT):
+    """Route all logging through the background queue. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+    if redact:
+        output.addFilter(RedactionFilter())
+    # Unbounded, so logging never blocks a request
+    log_queue = queue.SimpleQueue()
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+    # Let uvicorn's loggers go through the same pipeline
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestIdMiddleware:
+    """
+    ASGI middleware that gives every request an id (the incoming X-Request-ID
+    header, or a new one), exposes it to logging through `request_id_var` and
+    echoes it back in the X-Request-ID response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,207 @@
+"""
+Minimal Prometheus-style metrics.
+
+Counters and histograms are kept in-process and rendered in the Prometheus
+text exposition format by GET /metrics. Request latency per route is recorded
+by middleware in main.py; `stage_timer` times individual stages of the
+generate and analyze flows so we can see where p99 actually goes. Collectors
+registered with `register_collector` are called at scrape time to export
+gauges such as queue depth and cache hit counts.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra.items())
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, {"le": _format_value(bound)})
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+_metrics = []
+_collectors = []
+
+
+def counter(name: str, help: str, labels=()) -> Counter:
+    metric = Counter(name, help, labels)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    metric = Histogram(name, help, labels, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(fn):
+    """
+    `fn()` returns a list of `(name, type, help, labels, value)` samples and
+    is called on every scrape.
+    """
+    _collectors.append(fn)
+    return fn
+
+
+REQUEST_LATENCY = histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status"))
+STAGE_LATENCY = histogram(
+    "stage_duration_seconds", "Latency of individual stages of a request flow.", ("flow", "stage", "outcome"))
+GENERATION_TIER = counter(
+    "generation_tier_total", "Which fallback tier served each generation.", ("flow", "tier"))
+
+
+@contextmanager
+def stage_timer(flow: str, stage: str):
+    """Time a block as `stage` of `flow`; works around awaits too."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        # e.g. the losing side of a hedged pipeline call
+        outcome = "cancelled"
+        raise
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, flow=flow, stage=stage, outcome=outcome)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording REQUEST_LATENCY per route template (not raw
+    path, to keep label cardinality bounded). Streaming responses are timed
+    until their body is finished.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=status,
+            )
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+
+    # Samples of one metric have to be contiguous in the exposition format
+    families = {}
+    for collector in _collectors:
+        try:
+            samples = collector()
+        except Exception:
+            logger.exception("Metrics collector failed")
+            continue
+        for name, metric_type, help, labels, value in samples:
+            family = families.setdefault(name, (metric_type, help, []))
+            family[2].append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+    for name, (metric_type, help, sample_lines) in families.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(sample_lines)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,293 @@
+"""
+Process-wide registry of model clients.
+
+Routers used to build `genai.GenerativeModel(...)` and re-read GOOGLE_API_KEY
+on every request. The registry is created once in the FastAPI lifespan, holds
+one client per model role with its own concurrency limit and timeout, and
+warms the underlying connections in the background so the first real request
+doesn't pay for the TLS handshake.
+
+Roles:
+    "gemini" - text and vision (analysis, SVG fallback), GEMINI_MODEL
+    "imagen" - image generation, IMAGEN_MODEL
+
+`ModelRegistry.fake(...)` builds a registry of FakeModels for tests and
+offline benchmarks.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from config import (
+    GEMINI_CONCURRENCY,
+    GEMINI_MODEL,
+    GEMINI_TIMEOUT,
+    GOOGLE_API_KEY,
+    IMAGEN_CONCURRENCY,
+    IMAGEN_MODEL,
+    IMAGEN_TIMEOUT,
+)
+from services.executor import run_model, submit_to_pool
+
+logger = logging.getLogger(__name__)
+
+
+class _Slot:
+    """
+    One of a ModelClient's concurrency slots. A caller that times out or is
+    cancelled stops waiting, but the pool thread keeps running the blocking
+    call, so the slot is only given back once the caller is done with it and
+    none of its pool threads are still running.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.get_running_loop()
+        self.start = time.perf_counter()
+        self.running = 0
+        self.closed = False
+        self.released = False
+
+    def run(self, fn, *args, **kwargs):
+        """Start `fn` on the model pool; returns an awaitable for its result."""
+        future = submit_to_pool("model", fn, *args, **kwargs)
+        self.running += 1
+        future.add_done_callback(self._thread_done)
+        return asyncio.wrap_future(future, loop=self.loop)
+
+    def _thread_done(self, future):
+        try:
+            self.loop.call_soon_threadsafe(self._finished)
+        except RuntimeError:
+            # The loop is closed (shutdown); nobody is waiting for the slot
+            pass
+
+    def _finished(self):
+        self.running -= 1
+        self._maybe_release()
+
+    def close(self):
+        self.closed = True
+        self._maybe_release()
+
+    def _maybe_release(self):
+        if self.closed and not self.running and not self.released:
+            self.released = True
+            self.client._release(time.perf_counter() - self.start)
+
+
+class ModelClient:
+    def __init__(self, name: str, model, concurrency: int, timeout: float):
+        self.name = name
+        self.model = model
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        # Moving average of call durations, for estimating queue wait
+        self.avg_latency = 0.0
+
+    def expected_wait(self) -> float:
+        """Rough seconds a new call would wait for a slot right now."""
+        if self.in_flight < self.concurrency:
+            return 0.0
+        return (self.waiting + 1) / self.concurrency * self.avg_latency
+
+    async def _acquire(self) -> _Slot:
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return _Slot(self)
+
+    def _release(self, elapsed: float):
+        self.avg_latency = elapsed if not self.avg_latency else 0.8 * self.avg_latency + 0.2 * elapsed
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    async def call(self, method: str, *args, **kwargs):
+        """Call a blocking model method on the model pool, within this model's limits."""
+        slot = await self._acquire()
+        try:
+            return await asyncio.wait_for(slot.run(getattr(self.model, method), *args, **kwargs), timeout=self.timeout)
+        finally:
+            slot.close()
+
+    async def generate_content(self, *args, **kwargs):
+        return await self.call("generate_content", *args, **kwargs)
+
+    async def stream_content(self, *args, **kwargs):
+        """
+        Stream `generate_content(..., stream=True)`, yielding the text of each
+        chunk as the model emits it. The concurrency slot is held until the
+        stream is exhausted or closed, and `timeout` bounds the whole stream.
+        """
+        slot = await self._acquire()
+        deadline = slot.start + self.timeout
+        try:
+            response = await asyncio.wait_for(
+                slot.run(self.model.generate_content, *args, stream=True, **kwargs),
+                timeout=self.timeout,
+            )
+            chunks = iter(response)
+            while True:
+                chunk = await asyncio.wait_for(
+                    slot.run(next, chunks, None),
+                    timeout=max(0.0, deadline - time.perf_counter()),
+                )
+                if chunk is None:
+                    break
+                text = _chunk_text(chunk)
+                if text:
+                    yield text
+        finally:
+            slot.close()
+
+    async def generate_images(self, *args, **kwargs):
+        return await self.call("generate_images", *args, **kwargs)
+
+
+def _chunk_text(chunk) -> str:
+    # .text raises for chunks without text parts (e.g. a final safety or usage chunk)
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+class ModelRegistry:
+    def __init__(self, clients: dict, configured: bool = True):
+        self.clients = clients
+        self.configured = configured
+
+    def get(self, role: str) -> ModelClient:
+        return self.clients[role]
+
+    def warm(self):
+        """Open the API connection up front. Blocking; failures are only logged."""
+        client = self.clients.get("gemini")
+        if not self.configured or client is None or not hasattr(client.model, "count_tokens"):
+            return
+        try:
+            client.model.count_tokens("warm up")
+        except Exception as e:
+            logger.warning("Model warm-up failed", extra={"error": str(e)})
+
+    def stats(self) -> dict:
+        return {
+            role: {
+                "model": c.name,
+                "in_flight": c.in_flight,
+                "waiting": c.waiting,
+                "limit": c.concurrency,
+                "expected_wait": c.expected_wait(),
+            }
+            for role, c in self.clients.items()
+        }
+
+    @classmethod
+    def from_config(cls):
+        import google.generativeai as genai
+
+        if GOOGLE_API_KEY:
+            genai.configure(api_key=GOOGLE_API_KEY)
+        return cls({
+            "gemini": ModelClient(GEMINI_MODEL, genai.GenerativeModel(GEMINI_MODEL), GEMINI_CONCURRENCY, GEMINI_TIMEOUT),
+            "imagen": ModelClient(IMAGEN_MODEL, genai.GenerativeModel(IMAGEN_MODEL), IMAGEN_CONCURRENCY, IMAGEN_TIMEOUT),
+        }, configured=bool(GOOGLE_API_KEY))
+
+    @classmethod
+    def fake(cls, text: str = "A small robot with round eyes.\nStyle: 3D Render",
+             latency: float = 0.0, failure_rate: float = 0.0, image_url: str = None,
+             concurrency: int = 8, timeout: float = 30):
+        model = FakeModel(text=text, latency=latency, failure_rate=failure_rate, image_url=image_url)
+        return cls({
+            "gemini": ModelClient("fake-gemini", model, concurrency, timeout),
+            "imagen": ModelClient("fake-imagen", model, concurrency, timeout),
+        })
+
+
+class FakeModel:
+    """
+    Stand-in for a GenerativeModel with configurable latency and failure rate.
+    `generate_images` fails unless an `image_url` is given, like the real
+    Imagen call does for keys without Imagen access.
+    """
+
+    def __init__(self, text: str, latency: float = 0.0, failure_rate: float = 0.0, image_url: str = None):
+        self.text = text
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.image_url = image_url
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("Injected model failure")
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        if stream:
+            return self._stream()
+        self._call()
+        return SimpleNamespace(text=self.text)
+
+    def _stream(self, chunk_size: int = 8):
+        # Same total latency as a plain call, spread over the chunks
+        self.calls += 1
+        pieces = [self.text[i:i + chunk_size] for i in range(0, len(self.text), chunk_size)]
+        for i, piece in enumerate(pieces):
+            if self.latency:
+                time.sleep(self.latency / len(pieces))
+            if self.failure_rate and i == 0 and random.random() < self.failure_rate:
+                raise RuntimeError("Injected model failure")
+            yield SimpleNamespace(text=piece)
+
+    def generate_images(self, prompt: str, number_of_images: int = 1, **kwargs):
+        self._call()
+        if not self.image_url:
+            raise RuntimeError("Image generation is not available for this model")
+        return SimpleNamespace(images=[SimpleNamespace(url=self.image_url)] * number_of_images)
+
+    def count_tokens(self, contents):
+        return SimpleNamespace(total_tokens=1)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def init_registry(registry: ModelRegistry = None) -> ModelRegistry:
+    global _registry
+    _registry = registry or ModelRegistry.from_config()
+    return _registry
+
+
+def peek_registry():
+    """The registry if it has been created, without creating it."""
+    return _registry
+
+
+def get_registry() -> ModelRegistry:
+    if _registry is None:
+        # Importing the SDK is slow; make sure a request racing the startup
+        # prewarm doesn't build a second registry
+        with _registry_lock:
+            if _registry is None:
+                return init_registry()
+    return _registry
+
+
+async def get_registry_async() -> ModelRegistry:
+    """get_registry() for handlers: building the registry (importing the SDK) happens on the model pool."""
+    if _registry is not None:
+        return _registry
+    return await run_model(get_registry)
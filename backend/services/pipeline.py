@@ -0,0 +1,152 @@
+"""
+Image generation pipeline shared by /generate/character and /generate/modify.
+
+Providers are tried in order (Imagen -> Gemini SVG -> Unsplash), but instead of
+waiting for one to fail before starting the next, each strategy has its own
+deadline and the next hedgeable strategy is started speculatively once
+HEDGE_DELAY_SECONDS pass without a result. The first success wins and the rest
+are cancelled. Strategies marked ``hedge=False`` (the Unsplash last resort,
+which always "succeeds") only start once everything before them has failed,
+and a stock photo from it is not billed to the user.
+
+Cancelling a task doesn't stop a call already running on a worker thread; its
+result is simply discarded.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from config import HEDGE_DELAY_SECONDS, IMAGEN_DEADLINE_SECONDS, SVG_DEADLINE_SECONDS
+from services import metrics, models
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GeneratedImage:
+    """Either a hosted `url` or raw `data` that still needs to go to the blob store."""
+    url: str = None
+    data: bytes = None
+    mime_type: str = None
+
+
+@dataclass
+class Strategy:
+    name: str
+    run: Callable[[], Awaitable[GeneratedImage]]
+    deadline: float = None
+    hedge: bool = True
+    # Whether a result from this strategy counts as a real generation the user pays for
+    billable: bool = True
+
+
+@dataclass
+class PipelineResult:
+    image: GeneratedImage
+    tier: str
+    billable: bool
+    errors: dict
+
+
+class PipelineError(Exception):
+    def __init__(self, errors: dict):
+        super().__init__("All generation strategies failed: " + "; ".join(f"{k}: {v}" for k, v in errors.items()))
+        self.errors = errors
+
+
+async def _attempt(strategy: Strategy):
+    with metrics.stage_timer("generate", strategy.name):
+        if strategy.deadline is None:
+            return await strategy.run()
+        return await asyncio.wait_for(strategy.run(), timeout=strategy.deadline)
+
+
+async def run_strategies(strategies, hedge_delay: float = HEDGE_DELAY_SECONDS) -> PipelineResult:
+    """Run strategies with hedging and return the first successful result."""
+    strategies = list(strategies)
+    pending = {}
+    errors = {}
+    next_index = 0
+
+    def start_next():
+        nonlocal next_index
+        strategy = strategies[next_index]
+        next_index += 1
+        pending[asyncio.create_task(_attempt(strategy))] = strategy
+
+    start_next()
+    try:
+        while pending or next_index < len(strategies):
+            if not pending:
+                start_next()
+                continue
+
+            can_hedge = next_index < len(strategies) and strategies[next_index].hedge
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_delay if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                # Nothing finished within the hedge delay: start the next strategy alongside
+                logger.info("Hedging: starting next strategy", extra={"strategy": strategies[next_index].name, "hedge_delay": hedge_delay})
+                start_next()
+                continue
+
+            for task in done:
+                strategy = pending.pop(task)
+                try:
+                    image = task.result()
+                except asyncio.TimeoutError:
+                    errors[strategy.name] = f"deadline of {strategy.deadline}s exceeded"
+                except Exception as e:
+                    errors[strategy.name] = str(e) or type(e).__name__
+                else:
+                    return PipelineResult(image=image, tier=strategy.name, billable=strategy.billable, errors=errors)
+                logger.warning("Generation strategy failed", extra={"strategy": strategy.name, "error": errors[strategy.name]})
+        raise PipelineError(errors)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def imagen_strategy(image_prompt: str) -> GeneratedImage:
+    model = (await models.get_registry_async()).get("imagen")
+    result = await model.generate_images(
+        prompt=image_prompt,
+        number_of_images=1,
+    )
+    return GeneratedImage(url=result.images[0].url)
+
+
+async def svg_strategy(subject: str) -> GeneratedImage:
+    svg_model = (await models.get_registry_async()).get("gemini")
+    svg_prompt = f"Generate a simple, cute SVG code for: {subject}. Return ONLY the SVG code, no markdown."
+    svg_response = await svg_model.generate_content(svg_prompt)
+    svg_content = svg_response.text.replace("```svg", "").replace("```", "").strip()
+    return GeneratedImage(data=svg_content.encode('utf-8'), mime_type="image/svg+xml")
+
+
+async def unsplash_strategy(keywords_from: str, tag: str) -> GeneratedImage:
+    # Use keywords from the prompt to find a relevant image
+    keywords = keywords_from.split(" ")[0:3] # First 3 words
+    search_term = ",".join(keywords)
+    return GeneratedImage(url=f"https://source.unsplash.com/1024x1024/?{search_term},{tag}")
+
+
+def default_strategies(subject: str, keywords_from: str, tag: str):
+    image_prompt = f"{subject}. High quality, detailed, 8k."
+    return [
+        Strategy("imagen", lambda: imagen_strategy(image_prompt), deadline=IMAGEN_DEADLINE_SECONDS),
+        Strategy("svg", lambda: svg_strategy(subject), deadline=SVG_DEADLINE_SECONDS),
+        Strategy("unsplash", lambda: unsplash_strategy(keywords_from, tag), hedge=False, billable=False),
+    ]
+
+
+async def generate_image(subject: str, keywords_from: str, tag: str) -> PipelineResult:
+    """
+    Produce an image for `subject`, falling back from Imagen to a Gemini SVG
+    to an Unsplash search built from the first words of `keywords_from`.
+    """
+    return await run_strategies(default_strategies(subject, keywords_from, tag))
@@ -0,0 +1,84 @@
+"""
+Read cache for `users/{uid}` profile documents.
+
+/auth/me is called on every page load, so the Firestore document is kept in an
+in-process TTL cache (optionally backed by a shared tier for multi-instance
+deployments). Every code path that mutates a user - the credit transactions in
+routers/generate.py and the Stripe webhook - invalidates the entry, and
+clients can bypass the cache with `Cache-Control: no-cache` right after a
+purchase or generation so they never see a stale credit count from another
+instance's cache.
+"""
+import itertools
+import logging
+
+from config import PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL
+from services.cache import TTLCache
+from services.executor import run_io
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    """
+    `shared`, if given, is any object with blocking `get(uid)`,
+    `set(uid, data, ttl)` and `delete(uid)` methods (e.g. a Redis or
+    Memcached wrapper) that all instances can see.
+    """
+
+    def __init__(self, shared=None, max_entries: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL):
+        self.memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.shared = shared
+        self.ttl = ttl
+        # Bumped on every invalidation so a read that raced a write can't
+        # repopulate the cache with the pre-write document
+        self._versions = TTLCache(max_entries=max_entries, ttl=max(ttl, 60) * 10)
+        self._counter = itertools.count(1)
+
+    def version(self, uid: str) -> int:
+        return self._versions.get(uid, 0)
+
+    async def get(self, uid: str):
+        data = self.memory.get(uid)
+        if data is None and self.shared is not None:
+            try:
+                data = await run_io(self.shared.get, uid)
+            except Exception as e:
+                logger.warning("Profile cache shared tier read failed", extra={"error": str(e)})
+            if data is not None:
+                self.memory.set(uid, data)
+        return dict(data) if data is not None else None
+
+    async def set(self, uid: str, data: dict, version: int = None):
+        """Store a freshly loaded document; skipped if `uid` was invalidated since `version`."""
+        if version is not None and version != self.version(uid):
+            return
+        data = dict(data)
+        self.memory.set(uid, data)
+        if self.shared is not None:
+            try:
+                await run_io(self.shared.set, uid, data, self.ttl)
+            except Exception as e:
+                logger.warning("Profile cache shared tier write failed", extra={"error": str(e)})
+
+    async def invalidate(self, uid: str):
+        self._versions.set(uid, next(self._counter))
+        self.memory.pop(uid)
+        if self.shared is not None:
+            try:
+                await run_io(self.shared.delete, uid)
+            except Exception as e:
+                logger.warning("Profile cache shared tier delete failed", extra={"error": str(e)})
+
+    def stats(self) -> dict:
+        return self.memory.stats()
+
+
+_cache = None
+
+
+def get_cache() -> ProfileCache:
+    global _cache
+    if _cache is None:
+        _cache = ProfileCache()
+    return _cache
@@ -0,0 +1,93 @@
+"""
+Per-user cache of the generation context of projects, for /generate/modify.
+
+A modification builds on the project it modifies: its prompt is the
+original's `refined_prompt` plus the modification, and it keeps the original's
+style. So that this costs no Firestore read on the common path (modifying
+something just generated, or picked from the project list), contexts are
+cached under `(uid, project_id)` when /generate/* saves a project and when
+/projects/ lists them. On a miss the project is looked up in the write-behind
+queue (it may not be written yet) and then read from Firestore once.
+
+Project documents never change their prompt or style after creation, so
+entries don't need invalidating; they simply expire.
+"""
+import logging
+
+from config import PROJECT_CACHE_SIZE, PROJECT_CACHE_TTL, get_db_async
+from services import project_writer
+from services.cache import TTLCache
+from services.executor import run_db
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_FIELDS = ('prompt', 'refined_prompt', 'style', 'image_url')
+
+
+def context_from(data: dict):
+    """The part of a project document modifications build on, or None if it lacks a refined prompt."""
+    if not data.get('refined_prompt'):
+        return None
+    return {field: data.get(field) for field in CONTEXT_FIELDS}
+
+
+def compose_prompt(context, modification_prompt: str) -> str:
+    """Prompt for a modification: the project's refined prompt with the change appended."""
+    if context is None:
+        return modification_prompt
+    return f"{context['refined_prompt']}, {modification_prompt}"
+
+
+class ProjectContextCache:
+    def __init__(self, max_entries: int = PROJECT_CACHE_SIZE, ttl: float = PROJECT_CACHE_TTL):
+        self.memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.reads = 0
+
+    def put(self, uid: str, project_id: str, data: dict):
+        context = context_from(data)
+        if context is not None:
+            self.memory.set((uid, project_id), context)
+
+    def put_many(self, uid: str, projects):
+        """Cache contexts from listed projects (dicts with an `id`)."""
+        for project in projects:
+            self.put(uid, project['id'], project)
+
+    async def get(self, uid: str, project_id: str):
+        """The context of `uid`'s project, or None if there is no such project of theirs."""
+        context = self.memory.get((uid, project_id))
+        if context is not None:
+            return context
+
+        data = project_writer.get_writer().get(project_id)
+        # Without a userId it is only derivatives (thumbnails) for a project that is already written
+        if data is None or 'userId' not in data:
+            db = await get_db_async()
+            if db is None:
+                raise RuntimeError("Database unavailable")
+            self.reads += 1
+            doc = await run_db(db.collection('projects').document(project_id).get)
+            data = doc.to_dict() if doc.exists else None
+        if data is None or data.get('userId') != uid:
+            return None
+
+        context = context_from(data)
+        if context is None:
+            # Written before refined prompts were stored (older modifications)
+            context = {field: data.get(field) for field in CONTEXT_FIELDS}
+            context['refined_prompt'] = data.get('prompt') or ''
+        self.memory.set((uid, project_id), context)
+        return context
+
+    def stats(self) -> dict:
+        return {**self.memory.stats(), "firestore_reads": self.reads}
+
+
+_cache = None
+
+
+def get_cache() -> ProjectContextCache:
+    global _cache
+    if _cache is None:
+        _cache = ProjectContextCache()
+    return _cache
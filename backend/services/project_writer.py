@@ -0,0 +1,383 @@
+"""
+Write-behind persistence for project documents.
+
+/generate/character and /generate/modify used to write `projects/{id}` before
+responding, and a failed write was only logged, losing the project. Now the
+document id is allocated locally, the record is handed to this writer and the
+response goes out straight away. A background flusher coalesces pending
+records into Firestore batched writes, retrying with exponential backoff
+(capped at PROJECT_RETRY_MAX_DELAY) for as long as it takes; records are only
+dropped once Firestore has accepted them.
+
+Every record is also appended (and fsynced, on the io pool) to this process's
+spill file in PROJECT_SPILL_DIR before `submit` returns. The file is
+rewritten with just the still-pending records after each successful flush.
+Each process holds a lock on its own file; at startup a process takes over
+the files of processes that are gone and writes their records. That only
+helps if the directory outlives the process: on Cloud Run /tmp is in-memory
+and per instance, so PROJECT_SPILL_DIR has to be a mounted persistent
+volume for records to survive a crash. Replaying is safe: records are written
+with a fixed id and `merge=True`.
+
+A batch Firestore rejects outright (InvalidArgument, say a document over the
+size limit) is split until the offending records are found; those are
+appended to `dead-letter.jsonl` in PROJECT_SPILL_DIR and dropped rather than
+retried, so one bad record can't hold up everyone else's. Any other error
+keeps the whole batch pending for the next retry.
+
+Later additions to a project (the thumbnails from services/derivatives.py)
+are submitted here too: merged into the record if it is still pending, and
+otherwise written after it, since batches go out in submit order.
+
+`SERVER_TIMESTAMP` values are resolved to the submit time, so `createdAt`
+reflects when the project was made rather than when the write landed.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+import uuid
+
+from config import (
+    FIRESTORE_MAX_BATCH_WRITES,
+    PROJECT_BATCH_SIZE,
+    PROJECT_FLUSH_INTERVAL,
+    PROJECT_RETRY_BASE_DELAY,
+    PROJECT_RETRY_MAX_DELAY,
+    PROJECT_SPILL_DIR,
+    require_db,
+)
+from services import metrics
+from services.executor import run_db, run_io
+
+logger = logging.getLogger(__name__)
+
+FLUSH_LATENCY = metrics.histogram(
+    "project_flush_duration_seconds", "Latency of one batched write of pending projects.", ("outcome",))
+FLUSH_SIZE = metrics.histogram(
+    "project_flush_size", "Projects per batched write.", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+DEAD_LETTER_FILE = "dead-letter.jsonl"
+
+
+def is_permanent(error: Exception) -> bool:
+    """Whether Firestore (or the client, serializing the data) will never accept the write as is."""
+    from google.api_core import exceptions
+
+    return isinstance(error, (exceptions.InvalidArgument, TypeError, ValueError))
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot spill {type(value).__name__}")
+
+
+def _decode(obj: dict):
+    if set(obj) == {"__datetime__"}:
+        return datetime.datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+class FirestoreProjectStore:
+    def __init__(self, collection: str = 'projects'):
+        self.collection = collection
+
+    @property
+    def db(self):
+        return require_db()
+
+    def write(self, records):
+        """Blocking: write `(project_id, data)` records in batched writes."""
+        for start in range(0, len(records), FIRESTORE_MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for project_id, data in records[start:start + FIRESTORE_MAX_BATCH_WRITES]:
+                batch.set(self.db.collection(self.collection).document(project_id), data, merge=True)
+            batch.commit()
+
+
+def _line(project_id: str, data: dict) -> str:
+    return json.dumps({"id": project_id, "data": data}, default=_encode) + "\n"
+
+
+def _load(path: str) -> dict:
+    records = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook=_decode)
+                except ValueError:
+                    # A torn last line from a crash mid-append
+                    logger.warning("Skipping unreadable spill record", extra={"path": path})
+                    continue
+                records[record["id"]] = record["data"]
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class SpillFile:
+    """
+    This process's append-only JSONL of submitted records, compacted after
+    each flush. All methods block (fsync); call them on the io pool.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        name = f"projects-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.path = os.path.join(directory, name + ".jsonl")
+        self.lock_path = os.path.join(directory, name + ".lock")
+        self._lock_file = None
+
+    def open(self) -> dict:
+        """Lock this process's file and take over the records of processes that are gone."""
+        import fcntl
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(self.lock_path, "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+        recovered, orphans = {}, []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not (name.startswith("projects-") and name.endswith(".jsonl")) or path == self.path:
+                continue
+            lock = open(path[:-len(".jsonl")] + ".lock", "a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Its process is still running
+                lock.close()
+                continue
+            recovered.update(_load(path))
+            orphans.append((path, lock))
+
+        # Ours now: make them durable in our file before dropping the orphans
+        if recovered:
+            self.rewrite(recovered)
+        for path, lock in orphans:
+            os.remove(path)
+            os.remove(lock.name)
+            lock.close()
+        return recovered
+
+    def append(self, project_id: str, data: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(_line(project_id, data))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def bury(self, project_id: str, data: dict, error: str):
+        """Append a record Firestore rejected for good to the dead-letter file."""
+        line = json.dumps({"id": project_id, "data": data, "error": error}, default=_encode) + "\n"
+        with open(os.path.join(self.directory, DEAD_LETTER_FILE), "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rewrite(self, records: dict):
+        if not records and not os.path.exists(self.path):
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for project_id, data in records.items():
+                f.write(_line(project_id, data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def close(self, remove: bool):
+        """Release the file; with `remove`, delete it (nothing is left to write)."""
+        if remove:
+            for path in (self.path, self.lock_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class ProjectWriter:
+    def __init__(self, store, spill_dir: str = PROJECT_SPILL_DIR,
+                 flush_interval: float = PROJECT_FLUSH_INTERVAL, batch_size: int = PROJECT_BATCH_SIZE,
+                 retry_base_delay: float = PROJECT_RETRY_BASE_DELAY,
+                 retry_max_delay: float = PROJECT_RETRY_MAX_DELAY):
+        self.store = store
+        self.spill = SpillFile(spill_dir) if spill_dir else None
+        self.flush_interval = flush_interval
+        self.batch_size = min(batch_size, FIRESTORE_MAX_BATCH_WRITES)
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        # project id -> data, in submit order; a record stays here until it is written
+        self._pending = {}
+        self._failures = 0
+        self._wake = None
+        self._flush_lock = asyncio.Lock()
+        # Serializes appends and compactions of the spill file
+        self._spill_lock = asyncio.Lock()
+        self._flusher = None
+        self.written = 0
+        self.failed_flushes = 0
+        self.dead_lettered = 0
+
+    async def submit(self, project_id: str, data: dict):
+        """Queue `projects/{project_id}` to be written. Returns once it is in the spill file."""
+        from firebase_admin import firestore
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        data = {k: now if v is firestore.SERVER_TIMESTAMP else v for k, v in data.items()}
+        if project_id in self._pending:
+            data = {**self._pending.pop(project_id), **data}
+        self._pending[project_id] = data
+        # A full batch is flushed early, unless we are backing off after a failure
+        if len(self._pending) >= self.batch_size and not self._failures and self._wake is not None:
+            self._wake.set()
+        if self.spill is not None:
+            try:
+                async with self._spill_lock:
+                    await run_io(self.spill.append, project_id, data)
+            except Exception as e:
+                logger.warning("Could not spill project record", extra={"project_id": project_id, "error": str(e)})
+
+    def get(self, project_id: str):
+        """A project that is still waiting to be written, or None."""
+        data = self._pending.get(project_id)
+        return dict(data) if data is not None else None
+
+    def pending_for(self, uid: str):
+        """`(project_id, data)` of `uid`'s projects that are still waiting to be written."""
+        return [(project_id, dict(data)) for project_id, data in self._pending.items() if data.get('userId') == uid]
+
+    async def flush(self) -> bool:
+        """Write everything pending, a batch at a time. Returns False if a write failed."""
+        async with self._flush_lock:
+            while self._pending:
+                records = list(self._pending.items())[:self.batch_size]
+                FLUSH_SIZE.observe(len(records))
+                start = time.perf_counter()
+                try:
+                    await self._write(records)
+                except Exception as e:
+                    FLUSH_LATENCY.observe(time.perf_counter() - start, outcome="error")
+                    self._failures += 1
+                    self.failed_flushes += 1
+                    logger.warning("Failed to write projects, will retry",
+                                   extra={"count": len(records), "attempt": self._failures, "error": str(e)})
+                    # Whatever was settled before the failure is already out of _pending
+                    await self._compact()
+                    return False
+                FLUSH_LATENCY.observe(time.perf_counter() - start, outcome="ok")
+                self._failures = 0
+                await self._compact()
+            return True
+
+    async def _write(self, records):
+        """
+        Write `records`, splitting the batch to isolate any that Firestore
+        rejects for good and dead-lettering those. Raises on a retryable error.
+        """
+        try:
+            await run_db(self.store.write, records)
+        except Exception as e:
+            if not is_permanent(e):
+                raise
+            if len(records) == 1:
+                await self._dead_letter(*records[0], e)
+                return
+            middle = len(records) // 2
+            await self._write(records[:middle])
+            await self._write(records[middle:])
+            return
+        self._settle(records)
+        self.written += len(records)
+
+    def _settle(self, records):
+        for project_id, data in records:
+            # Only drop it if it wasn't resubmitted while the write was in flight
+            if self._pending.get(project_id) is data:
+                del self._pending[project_id]
+
+    async def _dead_letter(self, project_id: str, data: dict, error: Exception):
+        logger.error("Firestore rejected a project, moving it to the dead-letter file",
+                     extra={"project_id": project_id, "error": str(error)})
+        if self.spill is not None:
+            try:
+                await run_io(self.spill.bury, project_id, data, str(error))
+            except Exception as e:
+                logger.error("Could not dead-letter project record", extra={"project_id": project_id, "error": str(e)})
+        self._settle([(project_id, data)])
+        self.dead_lettered += 1
+
+    async def _compact(self):
+        if self.spill is None:
+            return
+        try:
+            async with self._spill_lock:
+                # Records submitted after this snapshot are appended after the rewrite
+                await run_io(self.spill.rewrite, dict(self._pending))
+        except Exception as e:
+            logger.warning("Could not compact project spill file", extra={"error": str(e)})
+
+    def _retry_delay(self) -> float:
+        return min(self.retry_max_delay, self.retry_base_delay * 2 ** (self._failures - 1))
+
+    async def _flush_loop(self):
+        while True:
+            delay = self._retry_delay() if self._failures else self.flush_interval
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "written": self.written, "failed_flushes": self.failed_flushes,
+                "dead_lettered": self.dead_lettered}
+
+    async def start(self):
+        if self._flusher is not None:
+            return
+        self._wake = asyncio.Event()
+        if self.spill is not None:
+            try:
+                recovered = await run_io(self.spill.open)
+            except Exception as e:
+                logger.error("Could not open project spill file", extra={"error": str(e)})
+                recovered = {}
+            if recovered:
+                logger.info("Recovered unwritten projects from spill files", extra={"count": len(recovered)})
+                self._pending = {**recovered, **self._pending}
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        if not await self.flush():
+            # Still in the spill file; taken over by the next process to start
+            logger.error("Projects left unwritten at shutdown", extra={"count": len(self._pending)})
+        if self.spill is not None:
+            async with self._spill_lock:
+                await run_io(self.spill.close, not self._pending)
+
+
+_writer = None
+
+
+def get_writer() -> ProjectWriter:
+    global _writer
+    if _writer is None:
+        _writer = ProjectWriter(FirestoreProjectStore())
+    return _writer
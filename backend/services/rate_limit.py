@@ -0,0 +1,132 @@
+"""
+Per-user rate limiting and per-model admission control.
+
+Two checks guard the expensive endpoints (/analyze, /generate/*):
+
+- Admission: if the model the request needs already has an expected queue
+  wait above ADMISSION_MAX_WAIT_SECONDS (see ModelClient.expected_wait), the
+  request is shed straight away instead of piling onto the queue.
+- Rate limit: a token bucket per `uid` and bucket name ("generate",
+  "analyze") refilled at a steady rate up to a burst size.
+
+Both fail fast with 429 and a Retry-After header. Admission runs first so a
+shed request doesn't cost the user any tokens.
+
+Buckets live in this process by default. For several instances, pass a
+shared store: any object with a blocking
+`take(key, rate, burst, cost) -> (allowed, retry_after)` (e.g. a Redis Lua
+script), called on the io pool. If the shared store fails, the in-process
+buckets are used instead.
+"""
+import logging
+import math
+import threading
+import time
+
+from fastapi import HTTPException
+
+from config import (
+    ADMISSION_MAX_WAIT_SECONDS,
+    RATE_LIMIT_ANALYZE_BURST,
+    RATE_LIMIT_ANALYZE_PER_MINUTE,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_GENERATE_BURST,
+    RATE_LIMIT_GENERATE_PER_MINUTE,
+)
+from services import metrics, models
+from services.cache import TTLCache
+from services.executor import run_io
+
+logger = logging.getLogger(__name__)
+
+# bucket name -> (tokens per second, burst)
+LIMITS = {
+    "generate": (RATE_LIMIT_GENERATE_PER_MINUTE / 60, RATE_LIMIT_GENERATE_BURST),
+    "analyze": (RATE_LIMIT_ANALYZE_PER_MINUTE / 60, RATE_LIMIT_ANALYZE_BURST),
+}
+
+REJECTED = metrics.counter("rate_limit_rejected_total", "Requests rejected with 429.", ("bucket", "reason"))
+
+
+class InMemoryBucketStore:
+    def __init__(self, max_keys: int = 100000):
+        # Idle buckets are full again after burst/rate seconds, so expiring them loses nothing
+        self.buckets = TTLCache(max_entries=max_keys, ttl=3600)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int, cost: int = 1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self.buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets.set(key, (tokens, now), ttl=burst / rate if rate else None)
+        if allowed:
+            return True, 0.0
+        return False, (cost - tokens) / rate if rate else math.inf
+
+
+def too_many_requests(detail: str, retry_after: float):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class RateLimiter:
+    def __init__(self, shared=None, limits: dict = None, max_wait: float = ADMISSION_MAX_WAIT_SECONDS):
+        self.local = InMemoryBucketStore()
+        self.shared = shared
+        self.limits = dict(limits or LIMITS)
+        self.max_wait = max_wait
+
+    async def _take(self, key: str, rate: float, burst: int, cost: int):
+        if self.shared is not None:
+            try:
+                return await run_io(self.shared.take, key, rate, burst, cost)
+            except Exception as e:
+                logger.warning("Shared rate limit store failed, using local buckets", extra={"error": str(e)})
+        return self.local.take(key, rate, burst, cost)
+
+    def admit(self, role: str, bucket: str = None):
+        """Shed the request if `role`'s model queue is already too long."""
+        registry = models.peek_registry()
+        if registry is None or role not in registry.clients:
+            return
+        wait = registry.get(role).expected_wait()
+        if wait > self.max_wait:
+            REJECTED.inc(bucket=bucket or role, reason="overloaded")
+            raise too_many_requests("Server is busy, please retry shortly", wait)
+
+    async def check(self, uid: str, bucket: str, cost: int = 1):
+        rate, burst = self.limits[bucket]
+        if cost > burst:
+            raise HTTPException(status_code=400, detail=f"Request exceeds the rate limit burst of {burst}")
+        allowed, retry_after = await self._take(f"{bucket}:{uid}", rate, burst, cost)
+        if not allowed:
+            REJECTED.inc(bucket=bucket, reason="rate_limited")
+            raise too_many_requests("Rate limit exceeded", retry_after)
+
+
+_limiter = None
+
+
+def get_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
+
+
+async def enforce(user_data: dict, bucket: str, model: str = None, cost: int = 1):
+    """Admission check for `model`, then take `cost` tokens from the user's bucket."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    limiter = get_limiter()
+    if model is not None:
+        limiter.admit(model, bucket)
+    await limiter.check(user_data["uid"], bucket, cost)
+
@@ -0,0 +1,87 @@
+"""
+Opt-in result cache and request coalescing for /generate/character.
+
+Style presets and the analysis output mean many users send the same
+prompt/style/type combination. When caching is enabled (GENERATION_CACHE_ENABLED
+or `"cache": true` in the request) results are keyed on the normalized refined
+prompt, style and type, and concurrent identical requests share one in-flight
+provider call (single-flight). Only billable results are cached, so a stock
+photo fallback is never served from cache. Credits are still reserved and
+settled per request by the caller.
+"""
+import asyncio
+import hashlib
+import re
+
+from config import GENERATION_CACHE_SIZE, GENERATION_CACHE_TTL
+from services.cache import TTLCache
+
+
+def normalize(text) -> str:
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower()
+
+
+def generation_key(refined_prompt: str, style: str, gen_type: str) -> str:
+    raw = "\x1f".join(normalize(part) for part in (refined_prompt, style, gen_type))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self, max_entries: int = GENERATION_CACHE_SIZE, ttl: float = GENERATION_CACHE_TTL):
+        self.memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def get_or_generate(self, key: str, produce):
+        """
+        Return the cached result for `key`, join an identical in-flight call,
+        or run `produce()` (a coroutine function returning a dict with a
+        `billable` flag) and cache its result.
+        """
+        cached = self.memory.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        # A task of its own, so that a caller giving up (the first one
+        # included) doesn't cancel the generation the others are waiting for
+        task = asyncio.create_task(self._produce(key, produce))
+        self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _produce(self, key: str, produce):
+        try:
+            result = await produce()
+            if result.get("billable"):
+                self.memory.set(key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "size": len(self.memory),
+        }
+
+
+_cache = None
+
+
+def get_cache() -> GenerationCache:
+    global _cache
+    if _cache is None:
+        _cache = GenerationCache()
+    return _cache
@@ -0,0 +1,319 @@
+"""
+Idempotent, queued processing of Stripe webhook events.
+
+Stripe delivers events at least once and retries whenever we are slow to
+answer, so the webhook used to be able to grant the same purchase twice. Now
+the endpoint only verifies the signature and records the event id in
+`stripe_events/{event_id}` with a create-if-absent write; a duplicate
+delivery finds the record and is acknowledged without doing anything.
+Recorded events are applied by background workers with retries and
+exponential backoff. The grant itself runs in a transaction that also marks
+the event as applied, so it happens exactly once even if a retry races a slow
+first attempt.
+
+Events left pending or failed (e.g. the instance stopped mid-retry) are
+replayed on startup, and `replay_from_stripe(since)` re-submits a backlog
+fetched from the Stripe API in bulk, e.g. after an outage:
+
+    python -m services.stripe_events --since 2024-05-01
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from config import (
+    WEBHOOK_MAX_ATTEMPTS,
+    WEBHOOK_RETRY_BASE_DELAY,
+    WEBHOOK_WORKERS,
+    get_stripe,
+    require_db,
+)
+from services import profile_cache
+from services.cache import TTLCache
+from services.executor import run_db
+
+logger = logging.getLogger(__name__)
+
+# Credits granted for one completed checkout
+PURCHASE_CREDITS = 10
+
+PENDING = "pending"
+APPLIED = "applied"
+FAILED = "failed"
+
+
+def checkout_grant(event: dict):
+    """
+    Return `(uid, credits)` for an event that grants credits, else None.
+    `event` is the plain JSON dict, not a StripeObject.
+    """
+    if event.get("type") != "checkout.session.completed":
+        return None
+    session = event["data"]["object"]
+    uid = session.get("client_reference_id") or (session.get("metadata") or {}).get("uid")
+    if not uid:
+        return None
+    return uid, PURCHASE_CREDITS
+
+
+class FirestoreEventStore:
+    @property
+    def db(self):
+        return require_db()
+
+    def _event_ref(self, event_id: str):
+        return self.db.collection('stripe_events').document(event_id)
+
+    def record(self, event_id: str, event_type: str, uid: str, credits: int) -> bool:
+        """Record a new event; returns False if it was already recorded."""
+        from firebase_admin import firestore
+        from google.api_core import exceptions as google_exceptions
+
+        try:
+            self._event_ref(event_id).create({
+                'type': event_type,
+                'uid': uid,
+                'credits': credits,
+                'status': PENDING,
+                'attempts': 0,
+                'createdAt': firestore.SERVER_TIMESTAMP,
+            })
+        except google_exceptions.AlreadyExists:
+            return False
+        return True
+
+    def apply_grant(self, event_id: str, uid: str, credits: int) -> bool:
+        """Grant the credits unless the event was already applied; returns whether it granted."""
+        from firebase_admin import firestore
+
+        event_ref = self._event_ref(event_id)
+        user_ref = self.db.collection('users').document(uid)
+
+        @firestore.transactional
+        def apply(transaction):
+            snapshot = event_ref.get(transaction=transaction)
+            if snapshot.exists and snapshot.get('status') == APPLIED:
+                return False
+            transaction.set(user_ref, {
+                'isPremium': True,
+                'credits': firestore.Increment(credits),
+            }, merge=True)
+            transaction.set(event_ref, {
+                'status': APPLIED,
+                'appliedAt': firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+            return True
+
+        return apply(self.db.transaction())
+
+    def mark_failed(self, event_id: str, attempts: int, error: str):
+        self._event_ref(event_id).set({
+            'status': FAILED,
+            'attempts': attempts,
+            'error': error,
+        }, merge=True)
+
+    def unapplied(self, limit: int = 500):
+        """`(event_id, uid, credits)` of recorded events that were never applied."""
+        query = self.db.collection('stripe_events').where('status', 'in', [PENDING, FAILED]).limit(limit)
+        return [(doc.id, doc.get('uid'), doc.get('credits')) for doc in query.stream()]
+
+
+class InMemoryEventStore:
+    """Same interface as FirestoreEventStore, for tests and local runs."""
+
+    def __init__(self, users: dict = None):
+        self.users = users if users is not None else {}
+        self.events = {}
+        self._lock = threading.Lock()
+
+    def record(self, event_id: str, event_type: str, uid: str, credits: int) -> bool:
+        with self._lock:
+            if event_id in self.events:
+                return False
+            self.events[event_id] = {"type": event_type, "uid": uid, "credits": credits,
+                                     "status": PENDING, "attempts": 0}
+            return True
+
+    def apply_grant(self, event_id: str, uid: str, credits: int) -> bool:
+        with self._lock:
+            event = self.events.setdefault(event_id, {"uid": uid, "credits": credits, "attempts": 0})
+            if event.get("status") == APPLIED:
+                return False
+            user = self.users.setdefault(uid, {"credits": 0})
+            user["isPremium"] = True
+            user["credits"] = user.get("credits", 0) + credits
+            event["status"] = APPLIED
+            return True
+
+    def mark_failed(self, event_id: str, attempts: int, error: str):
+        with self._lock:
+            self.events[event_id].update(status=FAILED, attempts=attempts, error=error)
+
+    def unapplied(self, limit: int = 500):
+        with self._lock:
+            return [(event_id, e["uid"], e["credits"]) for event_id, e in self.events.items()
+                    if e.get("status") in (PENDING, FAILED)][:limit]
+
+
+class WebhookProcessor:
+    def __init__(self, store, workers: int = WEBHOOK_WORKERS, max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+                 retry_base_delay: float = WEBHOOK_RETRY_BASE_DELAY):
+        self.store = store
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.queue = asyncio.Queue()
+        # Recently seen ids, so rapid redeliveries don't even reach Firestore
+        self.seen = TTLCache(max_entries=10000, ttl=24 * 3600)
+        self.received = 0
+        self.duplicates = 0
+        self.applied = 0
+        self.failed = 0
+        self._tasks = []
+
+    async def submit(self, event: dict) -> str:
+        """
+        Record an event for processing and return "accepted", "duplicate" or
+        "ignored". Raises if the event could not be recorded, so the webhook
+        fails and Stripe redelivers it.
+        """
+        grant = checkout_grant(event)
+        if grant is None:
+            return "ignored"
+        event_id = event["id"]
+        self.received += 1
+        if self.seen.get(event_id) or not await run_db(self.store.record, event_id, event["type"], *grant):
+            self.duplicates += 1
+            self.seen.set(event_id, True)
+            return "duplicate"
+        self.seen.set(event_id, True)
+        self.queue.put_nowait((event_id, *grant))
+        return "accepted"
+
+    async def replay(self, events) -> dict:
+        """Submit a backlog of Stripe events in bulk; already-processed ones are skipped."""
+        counts = {"accepted": 0, "duplicate": 0, "ignored": 0}
+        for event in events:
+            counts[await self.submit(event)] += 1
+        return counts
+
+    async def replay_unapplied(self) -> int:
+        """Re-queue recorded events that never got applied."""
+        pending = await run_db(self.store.unapplied)
+        for item in pending:
+            self.queue.put_nowait(item)
+        if pending:
+            logger.info("Replaying unapplied Stripe events", extra={"count": len(pending)})
+        return len(pending)
+
+    async def _process(self, event_id: str, uid: str, credits: int):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                granted = await run_db(self.store.apply_grant, event_id, uid, credits)
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logger.exception("Stripe event failed, giving up",
+                                     extra={"event_id": event_id, "uid": uid, "attempts": attempt})
+                    self.failed += 1
+                    try:
+                        await run_db(self.store.mark_failed, event_id, attempt, str(e))
+                    except Exception:
+                        logger.exception("Could not mark Stripe event as failed", extra={"event_id": event_id})
+                    return
+                delay = self.retry_base_delay * 2 ** (attempt - 1)
+                logger.warning("Stripe event failed, retrying",
+                               extra={"event_id": event_id, "attempt": attempt, "delay": delay, "error": str(e)})
+                await asyncio.sleep(delay)
+                continue
+            if granted:
+                self.applied += 1
+                logger.info("Credits granted", extra={"event_id": event_id, "uid": uid, "credits": credits})
+                await profile_cache.get_cache().invalidate(uid)
+            return
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._process(*item)
+            finally:
+                self.queue.task_done()
+
+    async def drain(self):
+        """Wait until everything queued so far has been processed."""
+        await self.queue.join()
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # Runs in the background so startup doesn't wait on Firestore
+        self._tasks.append(asyncio.create_task(self._replay_on_start()))
+
+    async def _replay_on_start(self):
+        try:
+            await self.replay_unapplied()
+        except Exception as e:
+            logger.warning("Could not load unapplied Stripe events", extra={"error": str(e)})
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "applied": self.applied,
+            "failed": self.failed,
+        }
+
+
+_processor = None
+
+
+def get_processor() -> WebhookProcessor:
+    global _processor
+    if _processor is None:
+        # Without Firestore, recording fails and the webhook returns 500 so Stripe retries later
+        _processor = WebhookProcessor(FirestoreEventStore())
+    return _processor
+
+
+def fetch_stripe_events(since: float):
+    """Blocking: all completed checkout events created at or after `since` (epoch seconds), as dicts."""
+    stripe = get_stripe()
+    events = stripe.Event.list(type="checkout.session.completed", created={"gte": int(since)}, limit=100)
+    return [json.loads(str(event)) for event in events.auto_paging_iter()]
+
+
+async def replay_from_stripe(since: float) -> dict:
+    from services.executor import run_stripe
+
+    processor = get_processor()
+    await processor.start()
+    events = await run_stripe(fetch_stripe_events, since)
+    counts = await processor.replay(events)
+    await processor.drain()
+    await processor.stop()
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    import datetime
+
+    from services import logs
+
+    parser = argparse.ArgumentParser(description="Replay completed Stripe checkouts since a date.")
+    parser.add_argument("--since", required=True, help="ISO date, e.g. 2024-05-01")
+    args = parser.parse_args()
+    since = datetime.datetime.fromisoformat(args.since).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    logs.setup_logging()
+    print(asyncio.run(replay_from_stripe(since)))
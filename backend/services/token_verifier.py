@@ -0,0 +1,234 @@
+"""
+Local verification of Firebase ID tokens.
+
+``firebase_admin.auth.verify_id_token`` is synchronous and runs on every
+request. Here the Google signing certificates are kept in memory (refreshed in
+the background ahead of the expiry advertised in their Cache-Control header),
+signatures are checked locally, and tokens that already verified are cached by
+hash until their own ``exp`` - so the common path is a dictionary lookup.
+A token signed with a key id we don't know refreshes the certs early (Google
+may have rotated keys), but no more than once per
+FORCED_REFRESH_COOLDOWN_SECONDS; in between it is rejected outright.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+from services.cache import TTLCache
+from services.executor import run_auth
+
+logger = logging.getLogger(__name__)
+
+CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+CLOCK_SKEW_SECONDS = 5
+# Refresh certs this long before they expire so requests never wait on a fetch
+REFRESH_MARGIN_SECONDS = 300
+DEFAULT_CERT_MAX_AGE = 3600
+# A token with an unknown key id forces a cert fetch at most this often;
+# otherwise forged tokens with random key ids would each cost a fetch
+FORCED_REFRESH_COOLDOWN_SECONDS = 60
+
+
+class InvalidTokenError(ValueError):
+    pass
+
+
+class CertStore:
+    """Google public signing certs, keyed by key id."""
+
+    def __init__(self, url: str = CERTS_URL):
+        self.url = url
+        self.certs = {}
+        self.expires_at = 0.0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def fresh(self) -> bool:
+        return bool(self.certs) and time.time() < self.expires_at
+
+    def refresh(self):
+        import requests
+
+        with self._lock:
+            response = requests.get(self.url, timeout=10)
+            response.raise_for_status()
+            max_age = DEFAULT_CERT_MAX_AGE
+            match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+            if match:
+                max_age = int(match.group(1))
+            self.certs = response.json()
+            self.expires_at = time.time() + max_age
+        self._schedule(max_age)
+
+    def _schedule(self, max_age: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max(60, max_age - REFRESH_MARGIN_SECONDS)
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning("Could not refresh token signing certs", extra={"error": str(e)})
+            self._schedule(REFRESH_MARGIN_SECONDS)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class TokenVerifier:
+    def __init__(self, project_id: str, cert_store: CertStore = None, cache_size: int = TOKEN_CACHE_SIZE,
+                 refresh_cooldown: float = FORCED_REFRESH_COOLDOWN_SECONDS):
+        self.project_id = project_id
+        self.issuer = f"https://securetoken.google.com/{project_id}"
+        self.cert_store = cert_store or CertStore()
+        self.cache = TTLCache(max_entries=cache_size)
+        self.refresh_cooldown = refresh_cooldown
+        self._next_forced_refresh = 0.0
+        self._forced_refresh_lock = threading.Lock()
+        self.forced_refreshes = 0
+
+    def cached(self, token: str):
+        """Return the claims for a token that already verified, or None."""
+        return self.cache.get(_token_key(token))
+
+    def verify(self, token: str) -> dict:
+        """Verify a token, hitting the cache first. May block on a cert fetch."""
+        claims = self.cached(token)
+        if claims is None:
+            claims = self.verify_and_cache(token)
+        return claims
+
+    def verify_and_cache(self, token: str) -> dict:
+        """Check the signature and claims locally and remember the result."""
+        from google.auth import exceptions as google_auth_exceptions
+
+        if not self.cert_store.fresh():
+            self.cert_store.refresh()
+        try:
+            payload = self._decode(token)
+        except google_auth_exceptions.MalformedError as e:
+            # Unknown key id usually means Google rotated keys before our refresh
+            if "Certificate for key id" not in str(e) or not self._claim_forced_refresh():
+                raise InvalidTokenError(str(e))
+            self.cert_store.refresh()
+            try:
+                payload = self._decode(token)
+            except google_auth_exceptions.MalformedError as e:
+                raise InvalidTokenError(str(e))
+
+        claims = self._check_claims(payload)
+        self.cache.set(_token_key(token), claims, expires_at=claims["exp"])
+        return claims
+
+    def _claim_forced_refresh(self) -> bool:
+        """Whether this caller may refresh the certs out of schedule (once per cooldown)."""
+        with self._forced_refresh_lock:
+            now = time.monotonic()
+            if now < self._next_forced_refresh:
+                return False
+            self._next_forced_refresh = now + self.refresh_cooldown
+            self.forced_refreshes += 1
+            return True
+
+    def _decode(self, token: str) -> dict:
+        # google.auth and requests are imported on first use (on the auth
+        # pool) to keep them off the cold-start path
+        from google.auth import exceptions as google_auth_exceptions
+        from google.auth import jwt
+
+        try:
+            return jwt.decode(
+                token,
+                certs=self.cert_store.certs,
+                audience=self.project_id,
+                clock_skew_in_seconds=CLOCK_SKEW_SECONDS,
+            )
+        except google_auth_exceptions.MalformedError:
+            raise
+        except (google_auth_exceptions.GoogleAuthError, ValueError) as e:
+            raise InvalidTokenError(str(e))
+
+    def _check_claims(self, payload: dict) -> dict:
+        if payload.get("iss") != self.issuer:
+            raise InvalidTokenError(f"Token has incorrect issuer {payload.get('iss')!r}")
+        sub = payload.get("sub")
+        if not isinstance(sub, str) or not sub or len(sub) > 128:
+            raise InvalidTokenError("Token has an invalid subject")
+        if payload.get("auth_time", 0) > time.time() + CLOCK_SKEW_SECONDS:
+            raise InvalidTokenError("Token auth_time is in the future")
+        claims = dict(payload)
+        claims["uid"] = sub
+        return claims
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def _resolve_project_id():
+    project_id = os.getenv("FIREBASE_PROJECT_ID") or os.getenv("GOOGLE_CLOUD_PROJECT")
+    if project_id:
+        return project_id
+    logger.warning("FIREBASE_PROJECT_ID is not set; reading the project id from the Firebase SDK")
+    try:
+        import firebase_admin
+        from config import init_firebase
+
+        init_firebase()
+        return firebase_admin.get_app().project_id
+    except Exception:
+        return None
+
+
+def get_verifier():
+    """The process-wide verifier, or None if the project id is unknown."""
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                project_id = _resolve_project_id()
+                if project_id:
+                    _verifier = TokenVerifier(project_id)
+    return _verifier
+
+
+def peek_verifier():
+    """The verifier if it has been created, without creating it."""
+    return _verifier
+
+
+async def get_verifier_async():
+    """get_verifier() for handlers: resolving the project id on first use happens on the auth pool."""
+    if _verifier is not None:
+        return _verifier
+    return await run_auth(get_verifier)
+
+
+def prefetch():
+    """Load the signing certs up front so the first request doesn't pay for it."""
+    verifier = get_verifier()
+    if verifier is None:
+        return
+    try:
+        verifier.cert_store.refresh()
+    except Exception as e:
+        logger.warning("Could not prefetch token signing certs", extra={"error": str(e)})
+
+
+def stop():
+    if _verifier is not None:
+        _verifier.cert_store.stop()
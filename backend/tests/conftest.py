@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Read by config at import time: no background SDK warm-up, quiet logs, and a
+# throwaway directory for the project writer's spill files
+os.environ.setdefault("PREWARM", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("PROJECT_SPILL_DIR", "/tmp/antigravity-test-project-spill")
+
+# The app's modules import each other as top-level packages (config, services, routers)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from services import credit_ledger
+from services.credit_ledger import (
+    COMMITTED,
+    GENERATION,
+    REFUNDED,
+    RESERVED,
+    CreditLedger,
+    InMemoryCreditStore,
+    InsufficientCreditsError,
+)
+
+
+def paying_user(credits: int) -> dict:
+    # Free generation already used, so every unit is paid for
+    return dict(credit_ledger.INITIAL_USER, credits=credits, generation_count=1)
+
+
+async def reserve_concurrently(ledger, uid: str, n: int):
+    return await asyncio.gather(*(ledger.reserve(uid, GENERATION) for _ in range(n)), return_exceptions=True)
+
+
+@pytest.mark.parametrize("latency", [0.0, 0.01])
+def test_concurrent_reservations_grant_exactly_the_balance(latency):
+    store = InMemoryCreditStore(users={"u1": paying_user(5)}, latency=latency)
+    ledger = CreditLedger(store)
+
+    results = asyncio.run(reserve_concurrently(ledger, "u1", 40))
+
+    granted = [r for r in results if isinstance(r, credit_ledger.Reservation)]
+    refused = [r for r in results if isinstance(r, InsufficientCreditsError)]
+    assert len(granted) == 5
+    assert len(refused) == 35
+    assert store.users["u1"]["credits"] == 0
+    assert store.users["u1"]["generation_count"] == 6
+    # Group commit: far fewer transactions than requests
+    assert store.transactions < 40
+
+
+def test_concurrent_reservations_across_users_are_independent():
+    store = InMemoryCreditStore(users={"u1": paying_user(3), "u2": paying_user(7)}, latency=0.005)
+    ledger = CreditLedger(store)
+
+    async def run():
+        return await asyncio.gather(reserve_concurrently(ledger, "u1", 20), reserve_concurrently(ledger, "u2", 20))
+
+    u1, u2 = asyncio.run(run())
+
+    assert sum(isinstance(r, credit_ledger.Reservation) for r in u1) == 3
+    assert sum(isinstance(r, credit_ledger.Reservation) for r in u2) == 7
+    assert store.users["u1"]["credits"] == store.users["u2"]["credits"] == 0
+
+
+def test_refund_gives_credits_back():
+    store = InMemoryCreditStore(users={"u1": paying_user(2)})
+    ledger = CreditLedger(store)
+
+    async def run():
+        reservation = await ledger.reserve("u1", GENERATION)
+        await ledger.settle(reservation, success=False)
+        return reservation
+
+    reservation = asyncio.run(run())
+
+    assert reservation.status == REFUNDED
+    assert store.ledger[reservation.id] == REFUNDED
+    assert store.users["u1"]["credits"] == 2
+
+
+def test_failed_refund_leaves_the_reservation_reserved():
+    class FailingStore(InMemoryCreditStore):
+        fail = True
+
+        def refund(self, *args):
+            if self.fail:
+                raise RuntimeError("Firestore unavailable")
+            super().refund(*args)
+
+    store = FailingStore(users={"u1": paying_user(2)})
+    ledger = CreditLedger(store)
+
+    async def run():
+        reservation = await ledger.reserve("u1", GENERATION)
+        with pytest.raises(RuntimeError):
+            await ledger.refund(reservation)
+        assert reservation.status == RESERVED
+        # Still settleable once the store is back
+        store.fail = False
+        await ledger.refund(reservation)
+        return reservation
+
+    reservation = asyncio.run(run())
+
+    assert reservation.status == REFUNDED
+    assert store.users["u1"]["credits"] == 2
+
+
+def test_partial_refund_commits_the_used_units():
+    store = InMemoryCreditStore(users={"u1": paying_user(5)})
+    ledger = CreditLedger(store)
+
+    async def run():
+        reservation = await ledger.reserve("u1", GENERATION, count=4)
+        await ledger.settle_units(reservation, used=3)
+        return reservation
+
+    reservation = asyncio.run(run())
+
+    assert reservation.status == COMMITTED
+    assert store.users["u1"]["credits"] == 2
+    assert store.users["u1"]["generation_count"] == 4
+
+def test_a_reservation_granted_to_a_cancelled_caller_is_refunded():
+    store = InMemoryCreditStore(users={"u1": paying_user(3)}, latency=0.05)
+    ledger = CreditLedger(store)
+
+    async def run():
+        caller = asyncio.create_task(ledger.reserve("u1", GENERATION))
+        # Cancelled (shutdown, job cancellation) while the transaction is in flight
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        while ledger.stats()["reserving_users"]:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+    assert store.transactions == 1
+    assert store.users["u1"]["credits"] == 3
+    assert store.users["u1"]["generation_count"] == 1
+    assert list(store.ledger.values()) == [REFUNDED]
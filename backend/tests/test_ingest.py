@@ -0,0 +1,89 @@
+import asyncio
+import io
+
+import httpx
+from fastapi import FastAPI, File, UploadFile
+
+from services.ingest import MULTIPART_OVERHEAD_BYTES, UploadLimitMiddleware, open_upload, prepare_image
+
+MAX_BYTES = 256 * 1024
+
+
+def make_app(parsed: list):
+    app = FastAPI()
+    app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_BYTES)
+
+    @app.post("/analyze/")
+    async def analyze(file: UploadFile = File(...)):
+        parsed.append(file.filename)
+        image = prepare_image(open_upload(file, max_bytes=MAX_BYTES))
+        return {"size": list(image.size)}
+
+    return app
+
+
+def png(width: int, height: int) -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 100, 50)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def post(app, **kwargs):
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/analyze/", **kwargs)
+
+    return asyncio.run(run())
+
+
+def multipart(content: bytes) -> tuple:
+    boundary = "test-boundary"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.png\"\r\n"
+        "Content-Type: image/png\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def test_an_upload_within_the_limit_is_decoded():
+    parsed = []
+    response = post(make_app(parsed), files={"file": ("a.png", png(64, 48), "image/png")})
+
+    assert response.status_code == 200
+    assert response.json() == {"size": [64, 48]}
+
+
+def test_an_oversized_content_length_is_refused_before_parsing():
+    parsed = []
+    body, headers = multipart(b"x" * (MAX_BYTES + MULTIPART_OVERHEAD_BYTES + 1))
+
+    response = post(make_app(parsed), content=body, headers=headers)
+
+    assert response.status_code == 413
+    assert parsed == []
+
+
+def test_a_body_without_content_length_is_cut_off_at_the_limit():
+    parsed = []
+    body, headers = multipart(b"x" * (MAX_BYTES + MULTIPART_OVERHEAD_BYTES + 1))
+
+    async def stream():
+        for start in range(0, len(body), 64 * 1024):
+            yield body[start:start + 64 * 1024]
+
+    response = post(make_app(parsed), content=stream(), headers=headers)
+
+    assert response.status_code == 413
+    assert parsed == []
+
+
+def test_a_file_over_the_limit_within_the_overhead_is_refused():
+    parsed = []
+
+    response = post(make_app(parsed), files={"file": ("a.png", b"x" * (MAX_BYTES + 1), "image/png")})
+
+    assert response.status_code == 413
+    assert parsed == ["a.png"]
@@ -0,0 +1,192 @@
+import asyncio
+import time
+
+import pytest
+
+from services import jobs
+from services.jobs import (
+    FAILED,
+    SUCCEEDED,
+    InMemoryJobBackend,
+    InMemoryJobStore,
+    JobError,
+    JobManager,
+    QueueFullError,
+    SharedJobBackend,
+)
+
+USER = {"uid": "u1"}
+
+
+async def echo(payload, user_data):
+    await asyncio.sleep(0.01)
+    return {"echo": payload["value"], "uid": user_data["uid"]}
+
+
+async def poll(manager, job_id: str, timeout: float = 2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = await manager.get(job_id)
+        if job.status in jobs.FINISHED_STATES:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def test_submit_then_poll():
+    async def run():
+        manager = JobManager(concurrency=2, handlers={"echo": echo})
+        await manager.start()
+        try:
+            job = await manager.submit("echo", {"value": 42}, USER)
+            assert (await manager.get(job.id)).status in (jobs.QUEUED, jobs.RUNNING)
+            return await poll(manager, job.id), manager.stats()
+        finally:
+            await manager.stop()
+
+    job, stats = asyncio.run(run())
+
+    assert job.status == SUCCEEDED
+    assert job.result == {"echo": 42, "uid": "u1"}
+    assert job.to_dict()["finishedAt"] >= job.to_dict()["startedAt"]
+    assert stats["completed"] == 1 and stats["dropped"] == 0
+
+
+def test_job_error_is_reported_with_its_status():
+    async def refuse(payload, user_data):
+        raise JobError("Insufficient credits", 402)
+
+    async def run():
+        manager = JobManager(concurrency=1, handlers={"refuse": refuse})
+        await manager.start()
+        try:
+            job = await manager.submit("refuse", {}, USER)
+            return await poll(manager, job.id)
+        finally:
+            await manager.stop()
+
+    job = asyncio.run(run())
+
+    assert job.status == FAILED
+    assert (job.error, job.status_code) == ("Insufficient credits", 402)
+
+
+def test_full_queue_is_refused():
+    async def run():
+        manager = JobManager(backend=InMemoryJobBackend(max_queued=1), handlers={"echo": echo})
+        await manager.submit("echo", {"value": 1}, USER)
+        with pytest.raises(QueueFullError):
+            await manager.submit("echo", {"value": 2}, USER)
+
+    asyncio.run(run())
+
+
+def test_stop_drops_running_and_queued_jobs():
+    started = asyncio.Event()
+
+    async def slow(payload, user_data):
+        started.set()
+        await asyncio.sleep(10)
+
+    async def run():
+        manager = JobManager(concurrency=1, handlers={"slow": slow})
+        await manager.start()
+        running = await manager.submit("slow", {}, USER)
+        queued = await manager.submit("slow", {}, USER)
+        events = manager.events(queued.id)
+        assert (await events.__anext__())["status"] == jobs.QUEUED
+        await started.wait()
+        await manager.stop()
+        # Subscribers are told the job is over
+        final = await events.__anext__()
+        return await manager.get(running.id), await manager.get(queued.id), final, manager.stats()
+
+    running, queued, final, stats = asyncio.run(run())
+
+    for job in (running, queued):
+        assert job.status == FAILED
+        assert job.status_code == 503
+        assert job.finished_at is not None
+    assert final["status"] == FAILED
+    assert stats["dropped"] == 2 and stats["running"] == 0
+
+
+def test_another_instance_sees_the_job_through_the_shared_store():
+    store = InMemoryJobStore()
+
+    async def run():
+        # Two instances: `worker` accepts and runs the job, `other` only answers polls
+        worker = JobManager(backend=SharedJobBackend(store), concurrency=1, handlers={"echo": echo})
+        other = JobManager(backend=SharedJobBackend(store), handlers={"echo": echo}, poll_interval=0.01)
+        await worker.start()
+        try:
+            job = await worker.submit("echo", {"value": 5}, USER)
+            assert (await other.get(job.id)).uid == "u1"
+            states = [state["status"] async for state in other.events(job.id)]
+            return await other.get(job.id), states
+        finally:
+            await worker.stop()
+
+    job, states = asyncio.run(run())
+
+    assert job.status == SUCCEEDED
+    assert job.result == {"echo": 5, "uid": "u1"}
+    assert states[-1] == SUCCEEDED
+    assert asyncio.run(JobManager(backend=SharedJobBackend(store)).get("unknown")) is None
+
+
+def test_jobs_dropped_at_shutdown_are_failed_in_the_shared_store():
+    store = InMemoryJobStore()
+
+    async def slow(payload, user_data):
+        await asyncio.sleep(10)
+
+    async def run():
+        worker = JobManager(backend=SharedJobBackend(store), concurrency=1, handlers={"slow": slow})
+        await worker.start()
+        running = await worker.submit("slow", {}, USER)
+        queued = await worker.submit("slow", {}, USER)
+        await asyncio.sleep(0.05)
+        await worker.stop()
+        other = JobManager(backend=SharedJobBackend(store))
+        return await other.get(running.id), await other.get(queued.id)
+
+    for job in asyncio.run(run()):
+        assert (job.status, job.status_code) == (FAILED, 503)
+
+
+def test_submit_then_poll_over_http():
+    import httpx
+
+    import main
+    from routers import auth
+
+    async def run():
+        # Only the job workers; the rest of the lifespan would reach for Firebase
+        manager = jobs.get_manager()
+        manager.register("character", echo)
+        await manager.start()
+        transport = httpx.ASGITransport(app=main.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                response = await client.post("/generate/character", json={"async": True, "value": 7})
+                assert response.status_code == 202
+                job_id = response.json()["jobId"]
+
+                deadline = time.monotonic() + 2
+                while True:
+                    state = (await client.get(f"/generate/jobs/{job_id}")).json()
+                    if state["status"] in jobs.FINISHED_STATES or time.monotonic() > deadline:
+                        return state
+                    await asyncio.sleep(0.01)
+        finally:
+            await manager.stop()
+
+    main.app.dependency_overrides[auth.verify_token] = lambda: USER
+    try:
+        state = asyncio.run(run())
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert state["status"] == SUCCEEDED
+    assert state["result"]["echo"] == 7
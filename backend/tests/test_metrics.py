@@ -0,0 +1,65 @@
+import asyncio
+
+import httpx
+import pytest
+
+
+def scrape(app, headers=None):
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/metrics", headers=headers or {})
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def main(monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "METRICS_TOKEN", "scrape-secret")
+    return main
+
+
+def test_metrics_need_the_bearer_token(main):
+    assert scrape(main.app).status_code == 404
+    assert scrape(main.app, {"Authorization": "Bearer wrong"}).status_code == 404
+
+    response = scrape(main.app, {"Authorization": "Bearer scrape-secret"})
+
+    assert response.status_code == 200
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+
+
+def test_metrics_are_hidden_on_cloud_run_without_a_token(main, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", None)
+    monkeypatch.setattr(main, "ON_CLOUD_RUN", True)
+
+    assert scrape(main.app).status_code == 404
+
+    monkeypatch.setattr(main, "ON_CLOUD_RUN", False)
+    assert scrape(main.app).status_code == 200
+
+
+def test_analysis_cache_metrics_count_shared_tier_hits(main, monkeypatch):
+    from services.analysis_cache import AnalysisCache
+
+    class SharedTier:
+        def get(self, key):
+            return {"description": "cached elsewhere"} if key == "shared" else None
+
+    cache = AnalysisCache(shared=SharedTier())
+
+    async def lookups():
+        await cache.get("shared")
+        await cache.get("shared")
+        await cache.get("unknown")
+
+    asyncio.run(lookups())
+    monkeypatch.setattr(main.analysis_cache, "_cache", cache)
+    samples = {(name, labels.get("cache")): value for name, _, _, labels, value in main.service_stats()}
+
+    # One shared hit, one in-memory hit after it was copied over, one miss
+    assert samples[("cache_hits_total", "analysis")] == 2
+    assert samples[("cache_misses_total", "analysis")] == 1
+    assert samples[("analysis_cache_shared_hits_total", None)] == 1
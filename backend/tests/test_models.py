@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+import pytest
+
+from services.models import ModelClient
+
+
+class BlockingModel:
+    """generate_content blocks its pool thread until `release` is set."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def generate_content(self, contents, stream: bool = False):
+        self.calls += 1
+        self.release.wait(5)
+        if stream:
+            return iter(["done"])
+        return "done"
+
+
+async def wait_for_release(client, timeout: float = 2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while client.in_flight and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_timed_out_call_keeps_its_slot_until_the_thread_finishes():
+    async def run():
+        model = BlockingModel()
+        client = ModelClient("blocking", model, concurrency=1, timeout=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await client.generate_content("hi")
+        # The pool thread is still inside generate_content
+        assert client.in_flight == 1
+        assert client.semaphore.locked()
+
+        model.release.set()
+        await wait_for_release(client)
+        assert client.in_flight == 0
+        assert not client.semaphore.locked()
+
+    asyncio.run(run())
+
+
+def test_cancelled_call_keeps_its_slot_until_the_thread_finishes():
+    async def run():
+        model = BlockingModel()
+        client = ModelClient("blocking", model, concurrency=1, timeout=5)
+        task = asyncio.create_task(client.generate_content("hi"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert client.semaphore.locked()
+
+        model.release.set()
+        await wait_for_release(client)
+        assert not client.semaphore.locked()
+        # The next call gets the slot
+        assert await client.generate_content("again") == "done"
+
+    asyncio.run(run())
+
+
+def test_closed_stream_keeps_its_slot_until_the_thread_finishes():
+    async def run():
+        model = BlockingModel()
+        client = ModelClient("blocking", model, concurrency=1, timeout=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            async for _ in client.stream_content("hi"):
+                pass
+        assert client.semaphore.locked()
+
+        model.release.set()
+        await wait_for_release(client)
+        assert not client.semaphore.locked()
+
+    asyncio.run(run())
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+
+from services import credit_ledger
+from services.credit_ledger import GENERATION, REFUNDED, CreditLedger, InMemoryCreditStore
+from services.pipeline import GeneratedImage, PipelineError, Strategy, run_strategies
+
+
+class FakeProvider:
+    """Answers (or fails) after `latency` seconds, recording when it started and whether it was cancelled."""
+
+    def __init__(self, name: str, latency: float, fail: bool = False):
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+        self.started_at = None
+        self.cancelled = False
+
+    async def __call__(self) -> GeneratedImage:
+        self.started_at = time.monotonic()
+        try:
+            await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.fail:
+            raise RuntimeError(f"{self.name} unavailable")
+        return GeneratedImage(url=f"https://example.com/{self.name}.png")
+
+
+def strategies(imagen, svg, unsplash, imagen_deadline=None):
+    return [
+        Strategy("imagen", imagen, deadline=imagen_deadline),
+        Strategy("svg", svg),
+        Strategy("unsplash", unsplash, hedge=False, billable=False),
+    ]
+
+
+def run(providers, hedge_delay: float, **kwargs):
+    async def go():
+        start = time.monotonic()
+        result = await run_strategies(strategies(*providers, **kwargs), hedge_delay=hedge_delay)
+        elapsed = time.monotonic() - start
+        # Let cancellations land
+        await asyncio.sleep(0)
+        return start, result, elapsed
+
+    return asyncio.run(go())
+
+
+def test_a_fast_svg_wins_over_a_slow_imagen_after_the_hedge_delay():
+    imagen, svg, unsplash = FakeProvider("imagen", 5), FakeProvider("svg", 0.01), FakeProvider("unsplash", 0)
+
+    start, result, elapsed = run((imagen, svg, unsplash), hedge_delay=0.1)
+
+    assert result.tier == "svg"
+    assert result.billable
+    assert 0.1 <= elapsed < 0.5
+    assert svg.started_at - start == pytest.approx(0.1, abs=0.05)
+    # The losing Imagen call is cancelled and the last resort never runs
+    assert imagen.cancelled
+    assert unsplash.started_at is None
+
+
+def test_the_hedge_is_cancelled_when_imagen_answers_first():
+    imagen, svg, unsplash = FakeProvider("imagen", 0.15), FakeProvider("svg", 5), FakeProvider("unsplash", 0)
+
+    _, result, elapsed = run((imagen, svg, unsplash), hedge_delay=0.05)
+
+    assert result.tier == "imagen"
+    assert elapsed < 0.5
+    assert svg.started_at is not None and svg.cancelled
+
+
+def test_a_strategy_past_its_deadline_hands_off_to_the_next():
+    imagen, svg, unsplash = FakeProvider("imagen", 5), FakeProvider("svg", 0.01), FakeProvider("unsplash", 0)
+
+    start, result, elapsed = run((imagen, svg, unsplash), hedge_delay=10, imagen_deadline=0.1)
+
+    assert result.tier == "svg"
+    assert elapsed < 0.5
+    # Started by the deadline, not the (much longer) hedge delay
+    assert svg.started_at - start == pytest.approx(0.1, abs=0.05)
+    assert "deadline" in result.errors["imagen"]
+
+
+def test_unsplash_only_runs_once_every_earlier_strategy_has_failed():
+    imagen = FakeProvider("imagen", 0.1, fail=True)
+    svg = FakeProvider("svg", 0.2, fail=True)
+    unsplash = FakeProvider("unsplash", 0)
+
+    _, result, _ = run((imagen, svg, unsplash), hedge_delay=0.01)
+
+    assert result.tier == "unsplash"
+    assert not result.billable
+    assert set(result.errors) == {"imagen", "svg"}
+    # Not hedged: it waited for the SVG attempt to fail, well past the hedge delay
+    assert unsplash.started_at >= svg.started_at + svg.latency
+
+
+def test_all_strategies_failing_raises():
+    providers = [FakeProvider(name, 0.01, fail=True) for name in ("imagen", "svg", "unsplash")]
+
+    with pytest.raises(PipelineError) as raised:
+        run(providers, hedge_delay=0.01)
+
+    assert set(raised.value.errors) == {"imagen", "svg", "unsplash"}
+
+
+def test_failed_strategies_are_not_billed():
+    store = InMemoryCreditStore(users={"u1": dict(credit_ledger.INITIAL_USER, credits=2, generation_count=1)})
+    ledger = CreditLedger(store)
+    imagen, svg = FakeProvider("imagen", 0.01, fail=True), FakeProvider("svg", 0.01, fail=True)
+
+    async def generate():
+        # What /generate/character does: reserve, run the pipeline, settle on `billable`
+        reservation = await ledger.reserve("u1", GENERATION)
+        result = await run_strategies(strategies(imagen, svg, FakeProvider("unsplash", 0)), hedge_delay=0.01)
+        await ledger.settle(reservation, result.billable)
+        return reservation
+
+    reservation = asyncio.run(generate())
+
+    assert reservation.status == REFUNDED
+    assert store.users["u1"]["credits"] == 2
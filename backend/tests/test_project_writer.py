@@ -0,0 +1,105 @@
+import asyncio
+import json
+import os
+
+from google.api_core import exceptions
+
+from services.project_writer import DEAD_LETTER_FILE, ProjectWriter
+
+
+class FakeProjectStore:
+    """Writes atomically per batch, like a Firestore batched write."""
+
+    def __init__(self, reject=(), unavailable=False):
+        self.reject = set(reject)
+        self.unavailable = unavailable
+        self.documents = {}
+        self.writes = 0
+
+    def write(self, records):
+        self.writes += 1
+        if self.unavailable:
+            raise exceptions.ServiceUnavailable("Firestore unavailable")
+        for project_id, _ in records:
+            if project_id in self.reject:
+                raise exceptions.InvalidArgument(f"Document {project_id} exceeds the maximum size")
+        for project_id, data in records:
+            self.documents[project_id] = data
+
+
+def make_writer(store, spill_dir, **kwargs):
+    # Flushed by hand in these tests
+    return ProjectWriter(store, spill_dir=str(spill_dir), flush_interval=3600, retry_base_delay=3600, **kwargs)
+
+
+def test_a_rejected_record_is_dead_lettered_and_does_not_block_the_rest(tmp_path):
+    store = FakeProjectStore(reject={"bad"})
+    writer = make_writer(store, tmp_path)
+
+    async def run():
+        await writer.start()
+        await writer.submit("bad", {"userId": "u1", "prompt": "x" * 100})
+        for i in range(5):
+            await writer.submit(f"good-{i}", {"userId": "u2", "prompt": str(i)})
+        flushed = await writer.flush()
+        await writer.stop()
+        return flushed
+
+    assert asyncio.run(run()) is True
+
+    assert sorted(store.documents) == [f"good-{i}" for i in range(5)]
+    assert writer.stats() == {"pending": 0, "written": 5, "failed_flushes": 0, "dead_lettered": 1}
+    with open(tmp_path / DEAD_LETTER_FILE) as f:
+        (buried,) = [json.loads(line) for line in f]
+    assert buried["id"] == "bad"
+    assert "maximum size" in buried["error"]
+    # Nothing left for the next process to retry
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("projects-")]
+
+
+def test_a_retryable_error_keeps_the_batch_pending(tmp_path):
+    store = FakeProjectStore(unavailable=True)
+    writer = make_writer(store, tmp_path)
+
+    async def run():
+        await writer.start()
+        await writer.submit("p1", {"userId": "u1"})
+        assert await writer.flush() is False
+        assert writer.get("p1") is not None
+        store.unavailable = False
+        assert await writer.flush() is True
+        await writer.stop()
+
+    asyncio.run(run())
+
+    assert list(store.documents) == ["p1"]
+    assert writer.stats()["dead_lettered"] == 0
+    assert not os.path.exists(tmp_path / DEAD_LETTER_FILE)
+
+
+def test_records_left_unwritten_are_taken_over_by_the_next_process(tmp_path):
+    down = FakeProjectStore(unavailable=True)
+    first = make_writer(down, tmp_path)
+
+    async def crash():
+        await first.start()
+        await first.submit("p1", {"userId": "u1", "prompt": "cat"})
+        await first.submit("p2", {"userId": "u1", "prompt": "dog"})
+        # Firestore is still down at shutdown: the records stay in the spill file
+        await first.stop()
+
+    asyncio.run(crash())
+    assert first.stats()["pending"] == 2
+
+    store = FakeProjectStore()
+    second = make_writer(store, tmp_path)
+
+    async def recover():
+        await second.start()
+        assert [project_id for project_id, _ in second.pending_for("u1")] == ["p1", "p2"]
+        await second.stop()
+
+    asyncio.run(recover())
+
+    assert store.documents == {"p1": {"userId": "u1", "prompt": "cat"}, "p2": {"userId": "u1", "prompt": "dog"}}
+    assert os.listdir(tmp_path) == []
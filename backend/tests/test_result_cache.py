@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from services.result_cache import GenerationCache
+
+
+def test_identical_requests_share_one_generation():
+    calls = []
+
+    async def produce():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"billable": True, "image": "a"}
+
+    async def run():
+        cache = GenerationCache()
+        results = await asyncio.gather(*(cache.get_or_generate("k", produce) for _ in range(5)))
+        # And from the cache afterwards
+        results.append(await cache.get_or_generate("k", produce))
+        return results, cache.stats()
+
+    results, stats = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(result == {"billable": True, "image": "a"} for result in results)
+    assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 4, 1)
+
+
+def test_cancelling_the_first_caller_does_not_cancel_the_others():
+    async def produce():
+        await asyncio.sleep(0.05)
+        return {"billable": True, "image": "a"}
+
+    async def run():
+        cache = GenerationCache()
+        leader = asyncio.create_task(cache.get_or_generate("k", produce))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.get_or_generate("k", produce))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower, cache.memory.get("k")
+
+    result, cached = asyncio.run(run())
+
+    assert result == cached == {"billable": True, "image": "a"}
+
+
+def test_failures_reach_every_caller_and_are_not_cached():
+    async def produce():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("provider down")
+
+    async def run():
+        cache = GenerationCache()
+        results = await asyncio.gather(*(cache.get_or_generate("k", produce) for _ in range(3)),
+                                       return_exceptions=True)
+        return results, cache.memory.get("k")
+
+    results, cached = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cached is None
@@ -0,0 +1,164 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+import stripe
+from fastapi import FastAPI
+
+from services import stripe_events
+from services.stripe_events import APPLIED, PURCHASE_CREDITS, InMemoryEventStore, WebhookProcessor
+
+SECRET = "whsec_test"
+
+
+def checkout_event(event_id: str, uid: str = "u1") -> dict:
+    return {
+        "id": event_id,
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": f"cs_{event_id}", "client_reference_id": uid}},
+    }
+
+
+def signed(event: dict) -> tuple:
+    payload = json.dumps(event)
+    return payload, {"Stripe-Signature": stripe.WebhookSignature.generate_signature_header(payload, SECRET)}
+
+
+class FlakyEventStore(InMemoryEventStore):
+    """Fails the first `failures` grants, as Firestore might."""
+
+    def __init__(self, failures: int, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.grant_attempts = 0
+
+    def apply_grant(self, event_id: str, uid: str, credits: int) -> bool:
+        self.grant_attempts += 1
+        if self.grant_attempts <= self.failures:
+            raise RuntimeError("Firestore unavailable")
+        return super().apply_grant(event_id, uid, credits)
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    """The /payments/webhook route, signed with SECRET, recording into `store`."""
+    from routers import payments
+
+    def make(store):
+        processor = WebhookProcessor(store, workers=1, retry_base_delay=0.01)
+        monkeypatch.setattr(payments, "STRIPE_WEBHOOK_SECRET", SECRET)
+        monkeypatch.setattr(stripe_events, "_processor", processor)
+        app = FastAPI()
+        app.include_router(payments.router)
+        return app, processor
+
+    return make
+
+
+async def deliver(app, *requests):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return [await client.post("/payments/webhook", content=payload, headers=headers)
+                for payload, headers in requests]
+
+
+def test_a_duplicate_delivery_grants_once(webhook):
+    store = InMemoryEventStore()
+    app, processor = webhook(store)
+    delivery = signed(checkout_event("evt_1"))
+
+    async def run():
+        await processor.start()
+        try:
+            responses = await deliver(app, delivery, delivery)
+            await processor.drain()
+            return responses
+        finally:
+            await processor.stop()
+
+    first, second = asyncio.run(run())
+
+    assert first.json()["outcome"] == "accepted"
+    assert second.json()["outcome"] == "duplicate"
+    assert store.users["u1"]["credits"] == PURCHASE_CREDITS
+    assert store.events["evt_1"]["status"] == APPLIED
+    assert processor.stats()["applied"] == 1
+
+
+def test_a_bad_signature_is_refused(webhook):
+    store = InMemoryEventStore()
+    app, _ = webhook(store)
+    payload, _ = signed(checkout_event("evt_1"))
+    forged = {"Stripe-Signature": stripe.WebhookSignature.generate_signature_header(payload, "whsec_other")}
+
+    (response,) = asyncio.run(deliver(app, (payload, forged)))
+
+    assert response.status_code == 400
+    assert store.events == {}
+
+
+def test_a_failed_grant_is_retried_and_applied_once(webhook):
+    store = FlakyEventStore(failures=2)
+    app, processor = webhook(store)
+
+    async def run():
+        await processor.start()
+        try:
+            await deliver(app, signed(checkout_event("evt_1")))
+            await processor.drain()
+        finally:
+            await processor.stop()
+
+    asyncio.run(run())
+
+    # Two failures, then the grant; the startup replay may try once more and find it applied
+    assert store.grant_attempts >= 3
+    assert store.users["u1"]["credits"] == PURCHASE_CREDITS
+    assert store.events["evt_1"]["status"] == APPLIED
+
+
+def test_a_grant_that_already_landed_is_not_applied_again():
+    store = InMemoryEventStore()
+    processor = WebhookProcessor(store, workers=2)
+
+    async def run():
+        await processor.submit(checkout_event("evt_1"))
+        # A retry racing a slow first attempt
+        processor.queue.put_nowait(("evt_1", "u1", PURCHASE_CREDITS))
+        await processor.start()
+        try:
+            await processor.drain()
+        finally:
+            await processor.stop()
+
+    asyncio.run(run())
+
+    assert store.users["u1"]["credits"] == PURCHASE_CREDITS
+    assert processor.stats()["applied"] == 1
+
+
+def test_unapplied_events_are_replayed_at_startup():
+    store = InMemoryEventStore()
+    # Left behind by an instance that gave up on one event and stopped before
+    # a worker picked up the other
+    store.record("evt_failed", "checkout.session.completed", "u1", PURCHASE_CREDITS)
+    store.mark_failed("evt_failed", 5, "Firestore unavailable")
+    store.record("evt_pending", "checkout.session.completed", "u2", PURCHASE_CREDITS)
+    processor = WebhookProcessor(store, workers=1)
+
+    async def run():
+        await processor.start()
+        try:
+            # start() replays in the background
+            while processor.stats()["applied"] < 2:
+                await asyncio.sleep(0.01)
+        finally:
+            await processor.stop()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=2))
+
+    assert store.users["u1"]["credits"] == store.users["u2"]["credits"] == PURCHASE_CREDITS
+    assert {event["status"] for event in store.events.values()} == {APPLIED}
+    # Redelivered afterwards, they are recognised as duplicates
+    assert asyncio.run(processor.submit(checkout_event("evt_pending", uid="u2"))) == "duplicate"
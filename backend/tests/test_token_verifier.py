@@ -0,0 +1,117 @@
+import datetime
+import time
+
+import pytest
+
+from services.token_verifier import InvalidTokenError, TokenVerifier
+
+PROJECT_ID = "test-project"
+
+
+def make_key():
+    """An RSA key as PEM and a self-signed certificate for it."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test-securetoken")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("ascii")
+    return key_pem, cert.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+
+def sign(key_pem: str, key_id: str, uid: str = "u1") -> str:
+    from google.auth import crypt, jwt
+
+    now = int(time.time())
+    return jwt.encode(crypt.RSASigner.from_string(key_pem, key_id=key_id), {
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+        "aud": PROJECT_ID,
+        "sub": uid,
+        "auth_time": now - 60,
+        "iat": now - 60,
+        "exp": now + 3600,
+    }).decode("ascii")
+
+
+class FakeCertStore:
+    """Serves `published` on refresh, counting the fetches."""
+
+    def __init__(self, published: dict):
+        self.published = published
+        self.certs = dict(published)
+        self.fetches = 0
+
+    def fresh(self) -> bool:
+        return True
+
+    def refresh(self):
+        self.fetches += 1
+        self.certs = dict(self.published)
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return make_key(), make_key()
+
+
+def test_forged_key_ids_force_at_most_one_fetch_per_cooldown(keys):
+    (key_pem, cert_pem), _ = keys
+    store = FakeCertStore({"k1": cert_pem})
+    verifier = TokenVerifier(PROJECT_ID, cert_store=store, refresh_cooldown=60)
+
+    for i in range(50):
+        with pytest.raises(InvalidTokenError):
+            verifier.verify_and_cache(sign(key_pem, key_id=f"forged-{i}"))
+
+    assert store.fetches == 1
+    # Real tokens still verify without another fetch
+    assert verifier.verify_and_cache(sign(key_pem, key_id="k1"))["uid"] == "u1"
+    assert store.fetches == 1
+
+
+def test_a_rotated_key_is_picked_up_by_a_forced_refresh(keys):
+    (old_pem, old_cert), (new_pem, new_cert) = keys
+    store = FakeCertStore({"old": old_cert})
+    verifier = TokenVerifier(PROJECT_ID, cert_store=store, refresh_cooldown=60)
+    # Google rotates keys before our scheduled refresh
+    store.published = {"old": old_cert, "new": new_cert}
+
+    claims = verifier.verify_and_cache(sign(new_pem, key_id="new", uid="u2"))
+
+    assert claims["uid"] == "u2"
+    assert store.fetches == 1
+
+
+def test_forced_refreshes_resume_after_the_cooldown(keys):
+    (key_pem, cert_pem), _ = keys
+    store = FakeCertStore({"k1": cert_pem})
+    verifier = TokenVerifier(PROJECT_ID, cert_store=store, refresh_cooldown=0.2)
+    token = sign(key_pem, key_id="unknown")
+
+    for _ in range(2):
+        with pytest.raises(InvalidTokenError):
+            verifier.verify_and_cache(token)
+    assert store.fetches == 1
+
+    time.sleep(0.25)
+    with pytest.raises(InvalidTokenError):
+        verifier.verify_and_cache(token)
+    assert store.fetches == 2
@@ -17,7 +17,7 @@ interface AuthContextType {
     user: User | null;
     profile: UserProfile | null;
     loading: boolean;
-    refreshProfile: () => Promise<void>;
+    refreshProfile: (fresh?: boolean) => Promise<void>;
     signInWithGoogle: () => Promise<void>;
     signInWithEmail: (email: string, pass: string) => Promise<void>;
     signUpWithEmail: (email: string, pass: string) => Promise<void>;
@@ -31,10 +31,10 @@ export const AuthProvider: React.FC<{ children: React.ReactNode }> = ({ children
     const [profile, setProfile] = useState<UserProfile | null>(null);
     const [loading, setLoading] = useState(true);
 
-    const refreshProfile = async () => {
+    const refreshProfile = async (fresh: boolean = false) => {
         if (auth.currentUser) {
             try {
-                const data = await getUserProfile();
+                const data = await getUserProfile(fresh);
                 setProfile(data);
             } catch (error) {
                 console.error("Failed to fetch profile", error);
@@ -46,7 +46,9 @@ export const AuthProvider: React.FC<{ children: React.ReactNode }> = ({ children
         const unsubscribe = onAuthStateChanged(auth, async (user) => {
             setUser(user);
             if (user) {
-                await refreshProfile();
+                // Coming back from Stripe checkout: make sure the new credits show up
+                const fromCheckout = new URLSearchParams(window.location.search).has('success');
+                await refreshProfile(fromCheckout);
             } else {
                 setProfile(null);
             }
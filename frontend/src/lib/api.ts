@@ -25,6 +25,52 @@ export const analyzeImage = async (file: File) => {
     return response.data;
 };
 
+export class ApiError extends Error {
+    status: number;
+    retryAfter: string | null;
+
+    constructor(status: number, retryAfter: string | null, message: string) {
+        super(message);
+        this.status = status;
+        this.retryAfter = retryAfter;
+    }
+}
+
+// Streams /analyze/stream: onDescription gets description text as it arrives,
+// the promise resolves with the final { description, style }.
+export const analyzeImageStream = async (file: File, onDescription: (text: string) => void) => {
+    const formData = new FormData();
+    formData.append('file', file);
+    const headers: Record<string, string> = {};
+    const user = auth.currentUser;
+    if (user) {
+        headers.Authorization = `Bearer ${await user.getIdToken()}`;
+    }
+    const response = await fetch(`${API_URL}/analyze/stream`, { method: 'POST', body: formData, headers });
+    if (!response.ok || !response.body) {
+        throw new ApiError(response.status, response.headers.get('retry-after'), 'Analysis failed');
+    }
+
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += value;
+        let end;
+        while ((end = buffer.indexOf('\n\n')) >= 0) {
+            const message = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            const event = message.match(/^event: (.*)$/m)?.[1];
+            const data = JSON.parse(message.match(/^data: (.*)$/m)?.[1] ?? '{}');
+            if (event === 'description') onDescription(data.text);
+            else if (event === 'result') return data as { description: string; style: string };
+            else if (event === 'error') throw new ApiError(500, null, data.detail);
+        }
+    }
+    throw new ApiError(500, null, 'Analysis stream ended early');
+};
+
 export const generateCharacter = async (prompt: string, style: string, type: string = 'basic') => {
     const response = await api.post('/generate/character', { prompt, style, type });
     return response.data;
@@ -40,12 +86,17 @@ export const createCheckoutSession = async () => {
     return response.data;
 };
 
-export const getProjects = async () => {
-    const response = await api.get('/projects/');
+export const getProjects = async (cursor?: string, fields?: string[], limit?: number) => {
+    const response = await api.get('/projects/', {
+        params: { cursor, limit, fields: fields?.join(',') },
+    });
     return response.data;
 };
 
-export const getUserProfile = async () => {
-    const response = await api.get('/auth/me');
+// `fresh` skips the server-side profile cache; use it right after credits change
+export const getUserProfile = async (fresh: boolean = false) => {
+    const response = await api.get('/auth/me', {
+        headers: fresh ? { 'Cache-Control': 'no-cache' } : undefined,
+    });
     return response.data;
 };
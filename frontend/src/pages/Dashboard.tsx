@@ -1,6 +1,6 @@
 import React, { useState } from 'react';
 import { useAuth } from '../contexts/AuthContext';
-import { analyzeImage, generateCharacter, createCheckoutSession } from '../lib/api';
+import { analyzeImageStream, ApiError, generateCharacter, createCheckoutSession } from '../lib/api';
 import { Loader2, Wand2, Coffee, Zap, Download, RefreshCw, Image as ImageIcon } from 'lucide-react';
 
 const STYLE_TAGS = [
@@ -15,6 +15,8 @@ const Dashboard: React.FC = () => {
     const [prompt, setPrompt] = useState('');
     const [selectedStyle, setSelectedStyle] = useState<string | null>(null);
     const [generatedImage, setGeneratedImage] = useState<string | null>(null);
+    // Project the generated image belongs to; modifications build on it
+    const [currentProjectId, setCurrentProjectId] = useState<string | null>(null);
     const [loading, setLoading] = useState(false);
     const [isAnalyzing, setIsAnalyzing] = useState(false);
 
@@ -30,12 +32,18 @@ const Dashboard: React.FC = () => {
             const file = e.target.files[0];
             setIsAnalyzing(true);
             try {
-                const result = await analyzeImage(file);
+                setPrompt('');
+                // Show the description as it streams in, then settle on the parsed result
+                const result = await analyzeImageStream(file, (text) => setPrompt((current) => current + text));
                 setPrompt(result.description);
                 if (result.style) setSelectedStyle(result.style);
             } catch (error) {
                 console.error("Analysis failed", error);
-                alert("Failed to analyze image.");
+                if (error instanceof ApiError && error.status === 429) {
+                    alert(`Too many requests. Please try again in ${error.retryAfter || 'a few'} seconds.`);
+                } else {
+                    alert("Failed to analyze image.");
+                }
             } finally {
                 setIsAnalyzing(false);
             }
@@ -57,11 +65,14 @@ const Dashboard: React.FC = () => {
             const style = selectedStyle || "3D Render";
             const result = await generateCharacter(prompt, style, "basic");
             setGeneratedImage(result.image_url);
-            await refreshProfile(); // Update counts
+            setCurrentProjectId(result.projectId);
+            await refreshProfile(true); // Update counts
         } catch (error: any) {
             console.error("Generation failed", error);
             if (error.response?.status === 402) {
                 alert("Insufficient credits!");
+            } else if (error.response?.status === 429) {
+                alert(`Too many requests. Please try again in ${error.response.headers['retry-after'] || 'a few'} seconds.`);
             } else {
                 alert("Generation failed. Please try again.");
             }
@@ -87,7 +98,7 @@ const Dashboard: React.FC = () => {
 
     // Handle Modification
     const handleModify = async () => {
-        if (!modificationPrompt) return;
+        if (!modificationPrompt || !currentProjectId) return;
 
         // Check Limits
         if (!isPremium && modCount >= 1 && credits < 1) {
@@ -97,18 +108,19 @@ const Dashboard: React.FC = () => {
 
         setModifying(true);
         try {
-            // We need a dummy project ID for now since we aren't tracking project history in frontend state perfectly yet
-            // In a real app, we'd pass the actual project ID of the current image
-            const dummyProjectId = "current-session-project";
-            const result = await import('../lib/api').then(m => m.modifyCharacter(dummyProjectId, modificationPrompt));
+            const result = await import('../lib/api').then(m => m.modifyCharacter(currentProjectId, modificationPrompt));
             setGeneratedImage(result.image_url);
-            await refreshProfile();
+            // Further modifications build on this version
+            setCurrentProjectId(result.projectId);
+            await refreshProfile(true);
             setIsModifyModalOpen(false);
             setModificationPrompt('');
         } catch (error: any) {
             console.error("Modification failed", error);
             if (error.response?.status === 402) {
                 alert("Insufficient credits!");
+            } else if (error.response?.status === 429) {
+                alert(`Too many requests. Please try again in ${error.response.headers['retry-after'] || 'a few'} seconds.`);
             } else {
                 alert("Modification failed. Please try again.");
             }
@@ -9,6 +9,8 @@ interface Project {
     id: string;
     prompt: string;
     image_url: string;
+    thumbnails?: { width: number; url: string }[];
+    raster_url?: string;
     style: string;
     createdAt: string;
 }
@@ -19,13 +21,18 @@ const MyPage: React.FC = () => {
     const navigate = useNavigate();
     const [projects, setProjects] = useState<Project[]>([]);
     const [loading, setLoading] = useState(true);
+    const [loadingMore, setLoadingMore] = useState(false);
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
     const [selectedProject, setSelectedProject] = useState<Project | null>(null);
 
+    const PROJECT_FIELDS = ['prompt', 'image_url', 'thumbnails', 'raster_url', 'style', 'createdAt'];
+
     useEffect(() => {
         const fetchProjects = async () => {
             try {
-                const data = await getProjects();
+                const data = await getProjects(undefined, PROJECT_FIELDS);
                 setProjects(data.projects);
+                setNextCursor(data.nextCursor);
             } catch (error) {
                 console.error("Failed to fetch projects", error);
             } finally {
@@ -36,6 +43,20 @@ const MyPage: React.FC = () => {
         fetchProjects();
     }, []);
 
+    const loadMore = async () => {
+        if (!nextCursor) return;
+        setLoadingMore(true);
+        try {
+            const data = await getProjects(nextCursor, PROJECT_FIELDS);
+            setProjects(prev => [...prev, ...data.projects]);
+            setNextCursor(data.nextCursor);
+        } catch (error) {
+            console.error("Failed to fetch projects", error);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     const handleDownload = async (imageUrl: string, filename: string) => {
         try {
             const response = await fetch(imageUrl);
@@ -86,7 +107,14 @@ const MyPage: React.FC = () => {
                                 className="glass-panel rounded-2xl overflow-hidden group hover:scale-[1.02] transition-transform cursor-pointer"
                             >
                                 <div className="aspect-square relative">
-                                    <img src={project.image_url} alt={project.prompt} className="w-full h-full object-cover" />
+                                    <img
+                                        src={project.thumbnails?.[0]?.url ?? project.image_url}
+                                        srcSet={project.thumbnails?.map((thumb) => `${thumb.url} ${thumb.width}w`).join(', ')}
+                                        sizes="(min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw"
+                                        alt={project.prompt}
+                                        loading="lazy"
+                                        className="w-full h-full object-cover"
+                                    />
                                     <div className="absolute inset-0 bg-gradient-to-t from-black/80 via-transparent to-transparent opacity-0 group-hover:opacity-100 transition-opacity p-4 flex flex-col justify-end">
                                         <p className="text-white font-medium line-clamp-2">{project.prompt}</p>
                                         <span className="text-xs text-gray-300 mt-2 bg-white/20 px-2 py-1 rounded-full w-fit">
@@ -102,6 +130,17 @@ const MyPage: React.FC = () => {
                         ))}
                     </div>
                 )}
+                {nextCursor && (
+                    <div className="text-center mt-8">
+                        <button
+                            onClick={loadMore}
+                            disabled={loadingMore}
+                            className="px-6 py-3 rounded-xl bg-white/10 hover:bg-white/20 transition-colors disabled:opacity-50"
+                        >
+                            {loadingMore ? 'Loading...' : 'Load more'}
+                        </button>
+                    </div>
+                )}
             </main>
 
             {/* Detail Modal */}
@@ -137,7 +176,7 @@ const MyPage: React.FC = () => {
                             </div>
 
                             <button
-                                onClick={() => handleDownload(selectedProject.image_url, `antigravity-${selectedProject.id}.png`)}
+                                onClick={() => handleDownload(selectedProject.raster_url ?? selectedProject.image_url, `antigravity-${selectedProject.id}.png`)}
                                 className="mt-8 w-full bg-primary hover:bg-primary/90 text-white font-bold py-4 rounded-xl transition-all flex items-center justify-center gap-2"
                             >
                                 Download Image